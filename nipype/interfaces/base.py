@@ -22,10 +22,11 @@ from enthought.traits.trait_handlers import TraitDictObject, TraitListObject
 from nipype.interfaces.traits import Undefined
 
 from nipype.utils.filemanip import md5, hash_infile, FileNotFoundError, \
-    hash_timestamp
+    hash_timestamp, filename_to_list
 from nipype.utils.misc import is_container
 from enthought.traits.trait_errors import TraitError
 from nipype.utils.config import config
+from nipype.utils.hashcache import hash_file
 from nipype.utils.misc import isdefined
 from ConfigParser import NoOptionError
 
@@ -40,7 +41,20 @@ __docformat__ = 'restructuredtext'
 #    from enthought.traits.api import File, Directory
 #except:
 #    warn('traitsUI unavailable')
-from nipype.interfaces.traits import File, Directory
+from nipype.interfaces.traits import File, Directory, BaseFile
+
+def _hash_s3_uri(uri):
+    """Return the ETag of a s3:// input or None if it is unknown
+
+    The inputs are downloaded after the node is hashed, so the ETag stands
+    in for the content hash of the file.
+    """
+    # imported here, the pipeline package depends on this module
+    from nipype.pipeline.s3_node_wrapper import s3_etag
+    etag = s3_etag(uri)
+    if etag is None:
+        return None
+    return 's3:%s' % etag.strip('"')
 
 def load_template(name):
     """Load a template from the script_templates directory
@@ -142,15 +156,7 @@ class Bunch(object):
         file_list = []
         for afile in stuff:
             if os.path.isfile(afile):
-                md5obj = md5()
-                fp = file(afile, 'rb')
-                while True:
-                    data = fp.read(8192)
-                    if not data:
-                        break
-                    md5obj.update(data)
-                fp.close()
-                md5hex = md5obj.hexdigest()
+                md5hex = hash_file(afile, method='content')
             else:
                 md5hex = None
             file_list.append((afile, md5hex))
@@ -367,12 +373,7 @@ class BaseTraitedSpec(traits.HasTraits):
                 hashlist = self._hash_infile({'infiles':afile}, 'infiles')
                 hash = [val[1] for val in hashlist]
             else:
-                if config.get('execution', 'hash_method').lower() == 'timestamp':
-                    hash = hash_timestamp(afile)
-                elif config.get('execution', 'hash_method').lower() == 'content':
-                    hash = hash_infile(afile)
-                else:
-                    raise Exception("Unknown hash method: %s" % config.get('execution', 'hash_method'))
+                hash = hash_file(afile)
             file_list.append((afile, hash))
         return file_list
 
@@ -435,10 +436,47 @@ class BaseTraitedSpec(traits.HasTraits):
             The md5 hash value of the traited spec
 
         """
-        dict_withhash = self._get_sorteddict(self.get(),True)
-        dict_nofilename = self._get_sorteddict(self.get())
+        dict_withhash, dict_nofilename = self._get_sorteddicts(self.get())
         return (dict_withhash, md5(str(dict_nofilename)).hexdigest())
 
+    def _get_sorteddicts(self, object):
+        """Return the values of `_get_sorteddict` with and without file names
+
+        Both are computed in a single pass, so that every file is hashed only
+        once.
+        """
+        if isinstance(object, dict):
+            withhash = {}
+            nofilename = {}
+            for key, val in sorted(object.items()):
+                if isdefined(val):
+                    withhash[key], nofilename[key] = self._get_sorteddicts(val)
+        elif isinstance(object, (list,tuple)):
+            withhash = []
+            nofilename = []
+            for val in object:
+                if isdefined(val):
+                    outs = self._get_sorteddicts(val)
+                    withhash.append(outs[0])
+                    nofilename.append(outs[1])
+            if isinstance(object, tuple):
+                withhash = tuple(withhash)
+                nofilename = tuple(nofilename)
+        else:
+            if isdefined(object):
+                hash = None
+                if isinstance(object, str) and os.path.isfile(object):
+                    hash = hash_file(object)
+                elif isinstance(object, str) and object.startswith('s3://'):
+                    hash = _hash_s3_uri(object)
+                if hash is not None:
+                    withhash = (object, hash)
+                    nofilename = hash
+                else:
+                    withhash = object
+                    nofilename = object
+        return withhash, nofilename
+
     def _get_sorteddict(self, object, dictwithhash=False):
         if isinstance(object, dict):
             out = {}
@@ -454,13 +492,12 @@ class BaseTraitedSpec(traits.HasTraits):
                 out = tuple(out)
         else:
             if isdefined(object):
+                hash = None
                 if isinstance(object, str) and os.path.isfile(object):
-                    if config.get('execution', 'hash_method').lower() == 'timestamp':
-                        hash = hash_timestamp(object)
-                    elif config.get('execution', 'hash_method').lower() == 'content':
-                        hash = hash_infile(object)
-                    else:
-                        raise Exception("Unknown hash method: %s" % config.get('execution', 'hash_method'))
+                    hash = hash_file(object)
+                elif isinstance(object, str) and object.startswith('s3://'):
+                    hash = _hash_s3_uri(object)
+                if hash is not None:
                     if dictwithhash:
                         out = (object, hash)
                     else:
@@ -516,6 +553,9 @@ class Interface(object):
     input_spec = None # A traited input specification
     output_spec = None # A traited output specification
     can_resume = False # defines if the interface can reuse partial results after interruption
+    run_without_submitting = False # cheap interfaces are run by the scheduler instead of a worker
+    result_cacheable = True # results only depend on the inputs and may be shared through the result cache
+    io_bound = False # mostly waits for storage or the network, e.g., data sources that fetch files
 
     def __init__(self, **inputs):
         """Initialize command with given args and inputs."""
@@ -560,6 +600,35 @@ class Interface(object):
         """
         raise NotImplementedError
 
+_minimal_environ = ['PATH', 'LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH',
+                    'PYTHONPATH', 'FSLDIR', 'FSLOUTPUTTYPE', 'FREESURFER_HOME',
+                    'SUBJECTS_DIR', 'MATLABCMD']
+_environ_snapshots = {}
+
+def environ_snapshot(environ=None):
+    """Return the environment to record in the runtime of a run
+
+    The provenance option of the execution section of the config file
+    selects whether the full environment (default: os.environ), a minimal
+    set of variables or nothing (None) is recorded. Equal snapshots are
+    shared, so that many results do not hold copies of the same
+    environment. Snapshots must therefore not be modified.
+    """
+    level = config.get('execution', 'provenance').lower()
+    if level == 'none':
+        return None
+    if environ is None:
+        environ = os.environ
+    if level == 'full':
+        environ = dict(environ)
+    elif level == 'minimal':
+        environ = dict([(key, environ[key]) for key in _minimal_environ \
+                            if key in environ])
+    else:
+        raise ValueError('Unknown provenance level: %s' % level)
+    key = md5(str(sorted(environ.items()))).hexdigest()
+    return _environ_snapshots.setdefault(key, environ)
+
 class BaseInterface(Interface):
     """Implements common interface functionality.
 
@@ -715,6 +784,32 @@ class BaseInterface(Interface):
                                              transient=None).items():
             self._check_requires(spec, name, getattr(self.inputs, name))
 
+    def _check_remote_inputs(self):
+        """ Raises an exception if an input that must be an existing file is
+        an s3:// URI
+
+        Such URIs are accepted as inputs so that nodes can download them into
+        their working directory before running the interface.
+        """
+        for name, spec in self.inputs.traits(transient=None).items():
+            trait_types = [spec.trait_type] + \
+                [inner.trait_type for inner in \
+                     getattr(spec, 'inner_traits', None) or ()]
+            if not [trait_type for trait_type in trait_types \
+                        if isinstance(trait_type, BaseFile) and \
+                        trait_type.exists]:
+                continue
+            value = getattr(self.inputs, name)
+            if not isdefined(value):
+                continue
+            for item in filename_to_list(value):
+                if isinstance(item, str) and item.startswith('s3://'):
+                    msg = "%s input '%s' is not an existing file: %s. S3 " \
+                        "files are only downloaded when the interface is " \
+                        "run by a node." % (self.__class__.__name__, name,
+                                            item)
+                    raise ValueError(msg)
+
     def _run_interface(self, runtime):
         """ Core function that executes interface
         """
@@ -737,16 +832,18 @@ class BaseInterface(Interface):
         """
         self.inputs.set(**inputs)
         self._check_mandatory_inputs()
-        # initialize provenance tracking
-        env = deepcopy(os.environ.data)
+        self._check_remote_inputs()
+        # initialize provenance tracking; the environment is also used to
+        # execute command lines
         runtime = Bunch(cwd=os.getcwd(),
                         returncode=None,
                         duration=None,
-                        environ=env,
+                        environ=dict(os.environ),
                         hostname=gethostname())
         t = time()
         runtime = self._run_interface(runtime)
         runtime.duration = time() - t
+        runtime.environ = environ_snapshot(runtime.environ)
         results = InterfaceResult(deepcopy(self), runtime)
         if results.runtime.returncode is None:
             raise Exception('Returncode from an interface cannot be None')
@@ -19,8 +19,11 @@
 """
 from copy import deepcopy
 import glob
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
+from tempfile import gettempdir
+import threading
 from warnings import warn
 
 from enthought.traits.trait_errors import TraitError
@@ -37,7 +40,11 @@ from nipype.interfaces.base import (Interface, CommandLine, Bunch,
                                     BaseTraitedSpec, Undefined)
 from nipype.utils.misc import isdefined
 from nipype.utils.filemanip import (copyfile, list_to_filename,
-                                    filename_to_list, FileNotFoundError)
+                                    filename_to_list, FileNotFoundError,
+                                    load_json)
+from nipype.utils.downloadcache import get_download_cache
+from nipype.utils.hashcache import hash_file
+from nipype.utils.fileindex import FileIndex, get_file_index
 
 import logging
 iflogger = logging.getLogger('interface')
@@ -60,6 +67,8 @@ def add_traits(base, names, trait_type=None):
     return base
 
 class IOBase(BaseInterface):
+    result_cacheable = False
+    io_bound = True
 
     def _run_interface(self, runtime):
         runtime.returncode = 0
@@ -85,6 +94,14 @@ class DataSinkInputSpec(DynamicTraitedSpec):
                                    desc=('List of 2-tuples reflecting string'
                                          'to substitute and string to replace'
                                          'it with'))
+    skip_identical = traits.Bool(False, usedefault=True,
+                                 desc=('do not copy files whose destination '
+                                       'has the same size and content'))
+    hardlink = traits.Bool(False, usedefault=True,
+                           desc=('hard link files on the same file system '
+                                 'instead of copying them'))
+    n_threads = traits.Int(1, usedefault=True,
+                           desc='number of threads copying files')
     _outputs = traits.Dict(traits.Str, value={}, usedefault=True)
     
     def __setattr__(self, key, value):
@@ -120,7 +137,15 @@ class DataSink(IOBase):
         >>> setattr(ds.inputs, 'contrasts.@con', ['cont1.nii', 'cont2.nii'])
         >>> setattr(ds.inputs, 'contrasts.alt', ['cont1a.nii', 'cont2a.nii'])
         >>> ds.run() # doctest: +SKIP
-        
+
+        Reruns that store many files can skip the files that are already
+        stored, hard link the others and copy them in parallel:
+
+        >>> ds.inputs.skip_identical = True
+        >>> ds.inputs.hardlink = True
+        >>> ds.inputs.n_threads = 4
+        >>> ds.run() # doctest: +SKIP
+
     """
     input_spec = DataSinkInputSpec
 
@@ -151,6 +176,42 @@ class DataSink(IOBase):
                 iflogger.debug('new: ' + pathstr)
         return pathstr
         
+    def _is_identical(self, src, dst):
+        """Whether `dst` already has the size and content of `src`
+
+        The header and mat files of analyze images are compared as well.
+        This is called from the copying threads; the file hash cache is
+        thread safe.
+        """
+        srcfiles = [src]
+        dstfiles = [dst]
+        if src.endswith('.img'):
+            for ext in ['.hdr', '.mat']:
+                if os.path.exists(src[:-4] + ext):
+                    srcfiles.append(src[:-4] + ext)
+                    dstfiles.append(dst[:-4] + ext)
+        for srcfile, dstfile in zip(srcfiles, dstfiles):
+            if not os.path.isfile(dstfile) or os.path.islink(dstfile) or \
+                    os.path.getsize(srcfile) != os.path.getsize(dstfile):
+                return False
+            if os.path.samefile(srcfile, dstfile):
+                continue
+            if hash_file(srcfile, method='content') != \
+                    hash_file(dstfile, method='content'):
+                return False
+        return True
+
+    def _sink_file(self, files):
+        src, dst = files
+        if self.inputs.skip_identical and self._is_identical(src, dst):
+            iflogger.debug("identical: %s %s"%(src, dst))
+            return
+        iflogger.debug("copyfile: %s %s"%(src, dst))
+        staging = None
+        if self.inputs.hardlink:
+            staging = 'hardlink'
+        copyfile(src, dst, copy=True, staging=staging)
+
     def _list_outputs(self):
         """Execute this module.
         """
@@ -162,6 +223,7 @@ class DataSink(IOBase):
             outdir = os.path.join(outdir, self.inputs.container)
         if not os.path.exists(outdir):
             os.makedirs(outdir)
+        filestosink = []
         for key,files in self.inputs._outputs.items():
             iflogger.debug("key: %s files: %s"%(key, str(files)))
             files = filename_to_list(files)
@@ -186,8 +248,7 @@ class DataSink(IOBase):
                     path,_ = os.path.split(dst)
                     if not os.path.exists(path):
                         os.makedirs(path)
-                    iflogger.debug("copyfile: %s %s"%(src, dst))
-                    copyfile(src, dst, copy=True)
+                    filestosink.append((src, dst))
                 elif os.path.isdir(src):
                     dst = self._get_dst(os.path.join(src,''))
                     dst = os.path.join(tempoutdir, dst)
@@ -200,6 +261,16 @@ class DataSink(IOBase):
                         shutil.rmtree(dst)
                     iflogger.debug("copydir: %s %s"%(src, dst))
                     shutil.copytree(src, dst)
+        if self.inputs.n_threads > 1 and len(filestosink) > 1:
+            pool = ThreadPool(min(self.inputs.n_threads, len(filestosink)))
+            try:
+                pool.map(self._sink_file, filestosink)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for files in filestosink:
+                self._sink_file(files)
         return None
 
 
@@ -214,6 +285,17 @@ class DataGrabberInputSpec(DynamicTraitedSpec): #InterfaceInputSpec):
                                 traits.List(traits.List),
                                 value=dict(outfiles=[]), usedefault=True,
                                 desc='Information to plug into template')
+    use_index = traits.Bool(False, usedefault=True,
+                            desc=('match the templates against cached '
+                                  'listings of base_directory instead of '
+                                  'listing the directories every run'))
+    batch = traits.Bool(False, usedefault=True,
+                        desc=('resolve the templates of all parameterized '
+                              'copies of this node in one run'))
+    batch_inputs = traits.List(traits.Dict,
+                               desc=('values of the infields to resolve the '
+                                     'templates for (set by the workflow '
+                                     'in batch mode)'))
 
 class DataGrabber(IOBase):
     """ Generic datagrabber module that wraps around glob in an
@@ -264,6 +346,20 @@ class DataGrabber(IOBase):
         >>> dg.inputs.field_template = dict(struct='%s/struct.nii')
         >>> dg.inputs.template_args['struct'] = [['sid']]
 
+        Match the templates against cached listings of the base directory,
+        e.g., when it is on a network file system
+
+        >>> dg.inputs.use_index = True
+
+        In a workflow, the copies of a DataGrabber whose infields are set by
+        iterables (of the DataGrabber or of IdentityInterface nodes
+        preceding it) can be replaced by a single node, which resolves the
+        templates for all values at once and provides the files of every
+        copy to its successors. If the files of one copy are missing, all
+        copies fail.
+
+        >>> dg.inputs.batch = True
+
     """
     input_spec = DataGrabberInputSpec
     output_spec = DynamicTraitedSpec
@@ -311,17 +407,72 @@ class DataGrabber(IOBase):
         """
         return add_traits(base, self.inputs.template_args.keys())
 
+    def batch_interface(self, inputsets):
+        """Return a copy of this interface that resolves the templates for
+        every dict of input values in `inputsets`
+
+        The outputs of the copy are lists with one item per dict. Returns
+        None if batch is not set or if the dicts differ in other inputs
+        than the infields.
+        """
+        if not self.inputs.batch or not self._infields:
+            return None
+        for inputs in inputsets[1:]:
+            for key, val in inputs.items():
+                if key not in self._infields and \
+                        val != inputsets[0].get(key):
+                    return None
+        interface = deepcopy(self)
+        interface.inputs.batch_inputs = [dict([(key, inputs.get(key)) \
+                                                   for key in self._infields]) \
+                                             for inputs in inputsets]
+        return interface
+
     def _list_outputs(self):
+        index = None
+        if isdefined(self.inputs.base_directory):
+            if self.inputs.use_index:
+                index = get_file_index(self.inputs.base_directory)
+            elif isdefined(self.inputs.batch_inputs):
+                # list the directories once for all values
+                index = FileIndex(self.inputs.base_directory)
+        if isdefined(self.inputs.batch_inputs):
+            outputs = {}
+            for key in self.inputs.template_args.keys():
+                outputs[key] = []
+            for values in self.inputs.batch_inputs:
+                for key, val in self._grab(values, index).items():
+                    outputs[key].append(val)
+        else:
+            outputs = self._grab({}, index)
+        if index:
+            index.save()
+        return outputs
+
+    def _grab(self, values, index=None):
+        """Resolve the templates
+
+        The infields are taken from `values` if they are set there and
+        from the inputs otherwise.
+        """
+        def getinput(name):
+            if name in values:
+                return values[name]
+            return getattr(self.inputs, name)
+
         # infields are mandatory, however I could not figure out how to set 'mandatory' flag dynamically
         # hence manual check
         if self._infields:
             for key in self._infields:
-                value = getattr(self.inputs,key)
+                value = getinput(key)
                 if not isdefined(value):
                     msg = "%s requires a value for input '%s' because it was listed in 'infields'" % \
                     (self.__class__.__name__, key)
                     raise ValueError(msg)
                 
+        globfunc = glob.glob
+        if index:
+            globfunc = index.glob
         outputs = {}
         for key, args in self.inputs.template_args.items():
             outputs[key] = []
@@ -335,7 +486,7 @@ class DataGrabber(IOBase):
             else:
                 template = os.path.abspath(template)
             if not args:
-                filelist = glob.glob(template)
+                filelist = globfunc(template)
                 if len(filelist) == 0:
                     msg = 'Output key: %s Template: %s returned no files'%(key, template)
                     if self.inputs.raise_on_empty:
@@ -347,8 +498,9 @@ class DataGrabber(IOBase):
             for argnum, arglist in enumerate(args):
                 maxlen = 1
                 for arg in arglist:
-                    if isinstance(arg, str) and hasattr(self.inputs, arg):
-                        arg = getattr(self.inputs, arg)
+                    if isinstance(arg, str) and (arg in values or \
+                                                     hasattr(self.inputs, arg)):
+                        arg = getinput(arg)
                     if isinstance(arg, list):
                         if (maxlen > 1) and (len(arg) != maxlen):
                             raise ValueError('incompatible number of arguments for %s' % key)
@@ -358,8 +510,9 @@ class DataGrabber(IOBase):
                 for i in range(maxlen):
                     argtuple = []
                     for arg in arglist:
-                        if isinstance(arg, str) and hasattr(self.inputs, arg):
-                            arg = getattr(self.inputs, arg)
+                        if isinstance(arg, str) and \
+                                (arg in values or hasattr(self.inputs, arg)):
+                            arg = getinput(arg)
                         if isinstance(arg, list):
                             argtuple.append(arg[i])
                         else:
@@ -367,7 +520,7 @@ class DataGrabber(IOBase):
                     filledtemplate = template
                     if argtuple:
                         filledtemplate = template%tuple(argtuple)
-                    outfiles = glob.glob(filledtemplate)
+                    outfiles = globfunc(filledtemplate)
                     if len(outfiles) == 0:
                         msg = 'Output key: %s Template: %s returned no files'%(key, filledtemplate)
                         if self.inputs.raise_on_empty:
@@ -494,6 +647,63 @@ class XNATSourceInputSpec(DynamicTraitedSpec): #InterfaceInputSpec):
                                 traits.List(traits.List),
                                 value=dict(outfiles=[]), usedefault=True,
                                 desc='Information to plug into template')
+    n_threads = traits.Int(4, usedefault=True,
+                           desc='number of concurrent queries and downloads')
+
+_xnat_sessions = {}
+_xnat_sessions_lock = threading.Lock()
+# idle sessions kept open per server and user
+_xnat_max_idle_sessions = 8
+
+def _acquire_xnat_session(config_info, cachedir):
+    """Return an idle XNAT session of this process or open a new one
+
+    Sessions are kept open after use and shared by all XNATSources of a
+    process with the same server and user. Files are downloaded to an
+    explicit destination, so `cachedir` is only used by new sessions.
+    """
+    key = (config_info['url'], config_info['username'])
+    _xnat_sessions_lock.acquire()
+    try:
+        idle = _xnat_sessions.setdefault(key, [])
+        if idle:
+            return key, idle.pop()
+    finally:
+        _xnat_sessions_lock.release()
+    return key, XNATInterface(config_info['url'], config_info['username'],
+                              config_info['password'], cachedir=cachedir)
+
+def _release_xnat_session(key, session):
+    """Return a session to the idle sessions or close it if there are
+    already enough of them"""
+    _xnat_sessions_lock.acquire()
+    try:
+        idle = _xnat_sessions.setdefault(key, [])
+        if len(idle) < _xnat_max_idle_sessions:
+            idle.append(session)
+            return
+    finally:
+        _xnat_sessions_lock.release()
+    if hasattr(session, 'disconnect'):
+        try:
+            session.disconnect()
+        except Exception:
+            pass
+
+def _xnat_file_version(file_object):
+    """Return the checksum the server reports for a file
+
+    Returns None if the server does not report a checksum (before XNAT
+    1.6), in which case the file is not cached: a reprocessed image often
+    keeps its size, so the size does not identify its content.
+    """
+    try:
+        attributes = file_object.attributes()
+    except Exception:
+        return None
+    if attributes.get('digest'):
+        return 'digest:%s' % attributes['digest']
+    return None
 
 class XNATSource(IOBase):
     """ Generic XNATSource module that wraps around glob in an
@@ -525,6 +735,12 @@ class XNATSource(IOBase):
         >>> dg.inputs.query_template_args['func'] = [['sid','EPI_faces']]
         >>> dg.inputs.sid = 'IMAGEN_000000001274'
 
+        The queries of a run and the downloads of their files are run on
+        n_threads threads. If download_cache_dir is set in the config file,
+        downloaded files are stored there by URI and checksum and linked or
+        copied into the working directory by later runs.
+
+        >>> dg.inputs.n_threads = 8
 
     """
     input_spec = XNATSourceInputSpec
@@ -573,12 +789,49 @@ class XNATSource(IOBase):
         """
         return add_traits(base, self.inputs.query_template_args.keys())
 
+    def _fetch_files(self, query, config_info, cachedir, cache):
+        """Return the local paths of the files matching `query`
+        """
+        key, xnat = _acquire_xnat_session(config_info, cachedir)
+        try:
+            file_objects = xnat.select(query).request_objects()
+            if file_objects == []:
+                raise IOError('Template %s returned no files'%query)
+            return [self._fetch_file(file_object, cache) \
+                        for file_object in file_objects]
+        finally:
+            _release_xnat_session(key, xnat)
+
+    def _fetch_file(self, file_object, cache):
+        uri = getattr(file_object, '_uri', None)
+        if not uri:
+            return str(file_object.get())
+        # the sessions are shared, so every file is downloaded to the
+        # working directory of this node
+        fname = os.path.join(os.getcwd(), uri.lstrip('/'))
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError:
+            # exists or was created by another thread
+            pass
+        version = None
+        if cache:
+            version = _xnat_file_version(file_object)
+        if version is None:
+            file_object.get(fname)
+            return fname
+        cached = cache.get(uri, version, lambda dest: file_object.get(dest))
+        copyfile(cached, fname, copy=True, staging='hardlink')
+        return fname
+
     def _list_outputs(self):
         # infields are mandatory, however I could not figure out how to set 'mandatory' flag dynamically
         # hence manual check
         config_info = load_json(self.inputs.config_file)
-        cwd = os.getcwd()
-        xnat = XNATInterface(config_info['url'], config_info['username'], config_info['password'], cachedir=cwd)
+        cache = get_download_cache()
+        cachedir = os.path.join(gettempdir(), 'nipype_xnat')
+        if cache:
+            cachedir = os.path.join(cache.root, 'xnat')
         if self._infields:
             for key in self._infields:
                 value = getattr(self.inputs,key)
@@ -587,19 +840,16 @@ class XNATSource(IOBase):
                     (self.__class__.__name__, key)
                     raise ValueError(msg)
                 
-        outputs = {}
+        # collect the queries of all outputs and run them concurrently
+        queries = []
         for key, args in self.inputs.query_template_args.items():
-            outputs[key] = []
             template = self.inputs.query_template
             if hasattr(self.inputs, 'field_template') and \
                     isdefined(self.inputs.field_template) and \
                     self.inputs.field_template.has_key(key):
                 template = self.inputs.field_template[key]
             if not args:
-                file_objects = xnat.select(template).request_objects()
-                if file_objects == []:
-                    raise IOError('Template %s returned no files'%template)
-                outputs[key] = list_to_filename([str(file_object.get()) for file_object in file_objects])
+                queries.append((key, None, template))
             for argnum, arglist in enumerate(args):
                 maxlen = 1
                 for arg in arglist:
@@ -610,7 +860,6 @@ class XNATSource(IOBase):
                             raise ValueError('incompatible number of arguments for %s' % key)
                         if len(arg)>maxlen:
                             maxlen = len(arg)
-                outfiles = []
                 for i in range(maxlen):
                     argtuple = []
                     for arg in arglist:
@@ -621,16 +870,29 @@ class XNATSource(IOBase):
                         else:
                             argtuple.append(arg)
                     if argtuple:
-                        file_objects = xnat.select(template%tuple(argtuple)).request_objects()
-                        if file_objects == []:
-                            raise IOError('Template %s returned no files'%(template%tuple(argtuple)))
-                        outfiles = list_to_filename([str(file_object.get()) for file_object in file_objects])
+                        queries.append((key, i, template%tuple(argtuple)))
                     else:
-                        file_objects = xnat.select(template).request_objects()
-                        if file_objects == []:
-                            raise IOError('Template %s returned no files'%template)
-                        outfiles = list_to_filename([str(file_object.get()) for file_object in file_objects])
-                    outputs[key].insert(i,outfiles)
+                        queries.append((key, i, template))
+        fetch = lambda query: self._fetch_files(query[2], config_info,
+                                                cachedir, cache)
+        if self.inputs.n_threads > 1 and len(queries) > 1:
+            pool = ThreadPool(min(self.inputs.n_threads, len(queries)))
+            try:
+                files = pool.map(fetch, queries)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            files = map(fetch, queries)
+        outputs = {}
+        for key in self.inputs.query_template_args.keys():
+            outputs[key] = []
+        for (key, i, _), outfiles in zip(queries, files):
+            if i is None:
+                outputs[key] = list_to_filename(outfiles)
+            else:
+                outputs[key].insert(i, list_to_filename(outfiles))
+        for key in outputs.keys():
             if len(outputs[key]) == 0:
                 outputs[key] = None
             elif len(outputs[key]) == 1:
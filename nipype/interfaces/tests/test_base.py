@@ -140,7 +140,33 @@ def test_TraitedSpec_withFile():
     infields = spec2(moo=tmp_infile,doo=[tmp_infile])
     if config.get('execution', 'hash_method').lower() == 'content':
         yield assert_equal, infields.hashval[1], '8c227fb727c32e00cd816c31d8fea9b9'
+    yield assert_equal, infields.hashval[0], \
+        infields._get_sorteddict(infields.get(), True)
     teardown_file(tmpd)
+
+def test_TraitedSpec_withS3File():
+    class spec2(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+    # remote files are staged by the node
+    infields = spec2(moo='s3://bucket/data/func.nii')
+    yield assert_equal, infields.moo, 's3://bucket/data/func.nii'
+    yield assert_raises, nib.traits.TraitError, setattr, infields, 'moo', \
+        '/nonexistent/func.nii'
+
+    class InputSpec(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.InputMultiPath(nib.File(exists=True))
+    class DerivedInterface(nib.BaseInterface):
+        input_spec = InputSpec
+        def _run_interface(self, runtime):
+            runtime.returncode = 0
+            return runtime
+    # interfaces run outside of a node do not download them
+    yield assert_raises, ValueError, \
+        DerivedInterface(moo='s3://bucket/data/func.nii').run
+    yield assert_raises, ValueError, \
+        DerivedInterface(doo=['s3://bucket/data/func.nii']).run
+    yield assert_equal, DerivedInterface().run().outputs, None
     
 def test_Interface():
     yield assert_equal, nib.Interface.input_spec, None
@@ -220,6 +246,26 @@ def test_BaseInterface():
     nib.BaseInterface.input_spec = None
     yield assert_raises, Exception, nib.BaseInterface
 
+def test_environ_snapshot():
+    class DerivedInterface(nib.BaseInterface):
+        input_spec = nib.TraitedSpec
+        def _run_interface(self, runtime):
+            runtime.returncode = 0
+            return runtime
+    runtime = DerivedInterface().run().runtime
+    yield assert_equal, runtime.environ, dict(os.environ)
+    yield assert_true, DerivedInterface().run().runtime.environ is \
+        runtime.environ
+    try:
+        config.set('execution', 'provenance', 'minimal')
+        environ = DerivedInterface().run().runtime.environ
+        yield assert_true, set(environ.keys()) <= set(nib._minimal_environ)
+        yield assert_equal, environ.get('PATH'), os.environ.get('PATH')
+        config.set('execution', 'provenance', 'none')
+        yield assert_equal, DerivedInterface().run().runtime.environ, None
+    finally:
+        config.set('execution', 'provenance', 'full')
+
 def test_Commandline():
     yield assert_raises, Exception, nib.CommandLine
     ci = nib.CommandLine(command='which')
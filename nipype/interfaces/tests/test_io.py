@@ -3,9 +3,12 @@
 import os
 import shutil
 from tempfile import mkdtemp
+from time import sleep
 from nipype.testing import assert_equal, assert_true
 import nipype.interfaces.io as nio
 from nipype.interfaces.base import Undefined 
+from nipype.utils.config import config
+from nipype.utils.filemanip import save_json
 
 def test_datagrabber():
     dg = nio.DataGrabber()
@@ -13,6 +16,25 @@ def test_datagrabber():
     yield assert_equal, dg.inputs.base_directory, Undefined
     yield assert_equal, dg.inputs.template_args,{'outfiles': []} 
 
+def test_datagrabber_index():
+    temp_dir = mkdtemp(prefix='test_io_')
+    for sid in ['s1', 's2']:
+        os.makedirs(os.path.join(temp_dir, sid))
+        for fname in ['f3.nii', 'f5.nii', 'struct.nii']:
+            open(os.path.join(temp_dir, sid, fname), 'wt').close()
+    dg = nio.DataGrabber(infields=['sid'], outfields=['func', 'struct'])
+    dg.inputs.base_directory = temp_dir
+    dg.inputs.template = '%s/%s.nii'
+    dg.inputs.template_args['func'] = [['sid', ['f3', 'f5']]]
+    dg.inputs.template_args['struct'] = [['sid', 'str*']]
+    dg.inputs.sid = 's2'
+    outputs = dg._list_outputs()
+    dg.inputs.use_index = True
+    yield assert_equal, dg._list_outputs(), outputs
+    yield assert_equal, outputs['struct'], os.path.join(temp_dir, 's2',
+                                                        'struct.nii')
+    shutil.rmtree(temp_dir)
+
 def test_datasink():
     ds = nio.DataSink()
     yield assert_true, ds.inputs.parameterization
@@ -22,6 +44,173 @@ def test_datasink():
     ds = nio.DataSink(base_directory = 'foo')
     yield assert_equal, ds.inputs.base_directory, 'foo'
 
+def test_datasink_bulk():
+    temp_dir = mkdtemp(prefix='test_io_')
+    files = []
+    for i in range(4):
+        files.append(os.path.join(temp_dir, 'file%d.txt' % i))
+        open(files[-1], 'wt').write(str(i))
+    outdir = os.path.join(temp_dir, 'out')
+    ds = nio.DataSink(base_directory=outdir, n_threads=2)
+    setattr(ds.inputs, 'files', files)
+    ds.run()
+    sunk = os.path.join(outdir, 'files', 'file3.txt')
+    yield assert_equal, open(sunk).read(), '3'
+    yield assert_true, os.stat(sunk).st_ino != os.stat(files[3]).st_ino
+    # identical files are not copied again
+    mtime = int(os.path.getmtime(sunk)) - 10
+    os.utime(sunk, (mtime, mtime))
+    open(files[0], 'wt').write('changed')
+    ds.inputs.skip_identical = True
+    # the copying threads share the hash cache and its database
+    config.set('execution', 'hash_cache_file',
+               os.path.join(temp_dir, 'hashes.db'))
+    try:
+        ds.run()
+    finally:
+        config.set('execution', 'hash_cache_file', '')
+    yield assert_equal, os.path.getmtime(sunk), mtime
+    yield assert_equal, open(os.path.join(outdir, 'files',
+                                          'file0.txt')).read(), 'changed'
+    ds.inputs.skip_identical = False
+    ds.inputs.hardlink = True
+    ds.run()
+    yield assert_equal, os.stat(sunk).st_ino, os.stat(files[3]).st_ino
+    shutil.rmtree(temp_dir)
+
+class FakeXNATFile(object):
+    def __init__(self, attributes):
+        self._attributes = attributes
+
+    def attributes(self):
+        return self._attributes
+
+class FakeXNATSession(object):
+    closed = False
+
+    def disconnect(self):
+        self.closed = True
+
+def test_xnat_sessions():
+    # only the checksum identifies the content of a file
+    yield assert_equal, nio._xnat_file_version(
+        FakeXNATFile({'digest': 'abc', 'Size': '10'})), 'digest:abc'
+    yield assert_equal, nio._xnat_file_version(FakeXNATFile({'Size': '10'})), \
+        None
+    config_info = dict(url='http://xnat', username='user', password='pw')
+    key = ('http://xnat', 'user')
+    sessions = [FakeXNATSession() \
+                    for _ in range(nio._xnat_max_idle_sessions + 1)]
+    try:
+        for session in sessions:
+            nio._release_xnat_session(key, session)
+        yield assert_equal, len(nio._xnat_sessions[key]), \
+            nio._xnat_max_idle_sessions
+        yield assert_true, sessions[-1].closed
+        # the sessions are shared by all working directories
+        _, session = nio._acquire_xnat_session(config_info, '/tmp/a')
+        yield assert_true, session is sessions[-2]
+    finally:
+        del nio._xnat_sessions[key]
+
+class FakeXNATServerFile(FakeXNATFile):
+    def __init__(self, uri, files):
+        self._uri = uri
+        self._files = files
+        super(FakeXNATServerFile, self).__init__(dict(digest=files[uri][1]))
+
+    def get(self, dest):
+        # the first files are the slowest, so the queries finish out of order
+        sleep(0.01 * (len(self._files) - sorted(self._files).index(self._uri)))
+        FakeXNATInterface.downloads.append(self._uri)
+        open(dest, 'wt').write(self._files[self._uri][0])
+
+class FakeXNATInterface(FakeXNATSession):
+    """Answers a query with the file named by the query plus '.nii' from
+    `files` ({uri: (content, digest)})
+    """
+    files = {}
+    opened = 0
+    downloads = []
+
+    def __init__(self, url, username, password, cachedir=None):
+        FakeXNATInterface.opened += 1
+        self._query = None
+
+    def select(self, query):
+        self._query = query
+        return self
+
+    def request_objects(self):
+        return [FakeXNATServerFile(self._query + '.nii',
+                                   FakeXNATInterface.files)]
+
+def test_xnat_source():
+    temp_dir = mkdtemp(prefix='test_io_')
+    cur_dir = os.getcwd()
+    config_file = os.path.join(temp_dir, 'xnat.json')
+    save_json(config_file, dict(url='http://xnat', username='user',
+                                password='pw'))
+    key = ('http://xnat', 'user')
+    FakeXNATInterface.files = {'/data/s1/struct.nii': ('struct', 'd0')}
+    for i in range(1, 4):
+        FakeXNATInterface.files['/data/s1/f%d.nii' % i] = ('f%d' % i,
+                                                           'd%d' % i)
+    old_interface = getattr(nio, 'XNATInterface', None)
+    nio.XNATInterface = FakeXNATInterface
+    config.set('execution', 'download_cache_dir',
+               os.path.join(temp_dir, 'cache'))
+    try:
+        outputs = []
+        for run in range(3):
+            if run == 2:
+                # the file changed on the server
+                FakeXNATInterface.files['/data/s1/f2.nii'] = ('new', 'd4')
+            os.makedirs(os.path.join(temp_dir, 'run%d' % run))
+            os.chdir(os.path.join(temp_dir, 'run%d' % run))
+            FakeXNATInterface.downloads = []
+            src = nio.XNATSource(infields=['sid'],
+                                 outfields=['struct', 'func'])
+            src.inputs.config_file = config_file
+            src.inputs.query_template = '/data/%s/%s'
+            src.inputs.query_template_args['struct'] = [['sid', 'struct']]
+            src.inputs.query_template_args['func'] = [['sid',
+                                                       ['f1', 'f2', 'f3']]]
+            src.inputs.sid = 's1'
+            outputs.append(src._list_outputs())
+            outputs[-1]['downloads'] = sorted(FakeXNATInterface.downloads)
+        rundir = os.path.realpath(os.path.join(temp_dir, 'run0'))
+        yield assert_equal, outputs[0]['struct'], \
+            os.path.join(rundir, 'data', 's1', 'struct.nii')
+        # the outputs keep the order of the queries
+        yield assert_equal, outputs[0]['func'], \
+            [os.path.join(rundir, 'data', 's1', 'f%d.nii' % i) \
+                 for i in range(1, 4)]
+        yield assert_equal, [open(fname).read() \
+                                 for fname in outputs[0]['func']], \
+                                 ['f1', 'f2', 'f3']
+        yield assert_equal, len(outputs[0]['downloads']), 4
+        # the sessions are reused by the later runs
+        yield assert_true, FakeXNATInterface.opened <= 4
+        yield assert_equal, len(nio._xnat_sessions[key]), \
+            FakeXNATInterface.opened
+        # the second run reads the cache and only the changed file is
+        # downloaded by the third
+        yield assert_equal, outputs[1]['downloads'], []
+        yield assert_equal, open(outputs[1]['func'][1]).read(), 'f2'
+        yield assert_equal, outputs[2]['downloads'], ['/data/s1/f2.nii']
+        yield assert_equal, open(outputs[2]['func'][1]).read(), 'new'
+        yield assert_equal, open(outputs[2]['func'][2]).read(), 'f3'
+    finally:
+        os.chdir(cur_dir)
+        config.set('execution', 'download_cache_dir', '')
+        if old_interface is None:
+            del nio.XNATInterface
+        else:
+            nio.XNATInterface = old_interface
+        nio._xnat_sessions.pop(key, None)
+        FakeXNATInterface.opened = 0
+        shutil.rmtree(temp_dir)
 
 def test_freesurfersource():
     fss = nio.FreeSurferSource()
@@ -68,6 +68,10 @@ class BaseFile ( traits.BaseStr ):
             return validated_value
         elif os.path.isfile( value ):
             return validated_value
+        elif value.startswith( 's3://' ):
+            # staged into the working directory by the node; interfaces
+            # refuse to run with such inputs (_check_remote_inputs)
+            return validated_value
 
         self.error( object, name, value )
 
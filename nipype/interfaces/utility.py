@@ -33,6 +33,7 @@ class IdentityInterface(IOBase):
     """
     input_spec = DynamicTraitedSpec
     output_spec = DynamicTraitedSpec
+    run_without_submitting = True
     
     def __init__(self, fields=None, **inputs):
         super(IdentityInterface, self).__init__(**inputs)
@@ -81,6 +82,7 @@ class Merge(IOBase):
     """
     input_spec = MergeInputSpec
     output_spec = MergeOutputSpec
+    run_without_submitting = True
     
     def __init__(self, numinputs=0, **inputs):
         super(Merge, self).__init__(**inputs)
@@ -130,6 +132,7 @@ class Split(IOBase):
 
     input_spec = SplitInputSpec
     output_spec = DynamicTraitedSpec
+    run_without_submitting = True
         
     def _add_output_traits(self, base):
         undefined_traits = {}
@@ -184,6 +187,7 @@ class Select(IOBase):
 
     input_spec = SelectInputSpec
     output_spec = SelectOutputSpec
+    run_without_submitting = True
     
     def _list_outputs(self):
         outputs = self._outputs().get()
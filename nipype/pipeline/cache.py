@@ -0,0 +1,372 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Central cache of node results shared by workflows
+
+A node only reuses its results if they are in its own output directory.
+When the ``result_cache_dir`` option of the execution section of the config
+file is set, the output directory of every node that finishes is also
+stored in that directory, keyed by the class of the interface and the hash
+of the inputs. A node with the same interface and inputs in another
+workflow or base directory then places copies (copy-on-write clones where
+the file system supports them) of the stored files into its output
+directory instead of running the interface.
+
+The cache can be inspected and pruned from the command line::
+
+    python -m nipype.pipeline.cache [-d DIR] list
+    python -m nipype.pipeline.cache [-d DIR] prune MAX_GB
+    python -m nipype.pipeline.cache [-d DIR] clear
+
+"""
+from glob import glob
+import logging
+from optparse import OptionParser
+import os
+import shutil
+import sys
+from time import ctime
+
+from nipype.utils.config import config
+from nipype.utils.filemanip import (load_json, save_json, md5,
+                                    _reflink)
+from nipype.pipeline.utils import save_resultfile, load_resultfile
+
+logger = logging.getLogger('workflow')
+
+def result_key(interface, hashvalue, hashed_inputs):
+    """Return the cache key of a node
+
+    The key combines the class of the interface, the hash of the inputs
+    and the names (but not the directories) of the input files, which
+    often determine the names of the outputs.
+    """
+    names = []
+    _collect_filenames(hashed_inputs, names)
+    cls = interface.__class__
+    keystr = '%s.%s:%s:%s' % (cls.__module__, cls.__name__, hashvalue,
+                              sorted(names))
+    return md5(keystr).hexdigest()
+
+def _collect_filenames(object, names):
+    if isinstance(object, dict):
+        for val in object.values():
+            _collect_filenames(val, names)
+    elif isinstance(object, (list, tuple)):
+        # files are stored as (filename, hash) in the hashed inputs
+        if len(object) == 2 and isinstance(object[0], str) and \
+                os.path.isfile(object[0]):
+            names.append(os.path.basename(object[0]))
+        else:
+            for val in object:
+                _collect_filenames(val, names)
+
+def _replace_prefix(object, old, new):
+    """Replace the directory `old` in the paths contained in `object`"""
+    if isinstance(object, dict):
+        return dict([(key, _replace_prefix(val, old, new)) \
+                         for key, val in object.items()])
+    elif isinstance(object, (list, tuple)):
+        out = [_replace_prefix(val, old, new) for val in object]
+        if isinstance(object, tuple):
+            out = tuple(out)
+        return out
+    elif isinstance(object, str) and \
+            (object == old or object.startswith(old + os.sep)):
+        return new + object[len(old):]
+    return object
+
+def _is_metadata(fname):
+    """Files that nipype rewrites in an output directory"""
+    return (fname.startswith('result_') and fname.endswith('.pklz')) or \
+        (fname.startswith('_0x') and fname.endswith('.json'))
+
+def _link_tree(src, dst, link, skip=None):
+    """Recreate the tree `src` in `dst` by linking or copying the files
+
+    `link` is one of 'reflink' (copy-on-write clones, falling back to
+    copying), 'hardlink', 'symlink' or 'copy'. Symbolic links are recreated
+    as such. Returns the size of the files.
+    """
+    size = 0
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    for name in os.listdir(src):
+        if skip and skip(name):
+            continue
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        if os.path.islink(srcname):
+            os.symlink(os.readlink(srcname), dstname)
+        elif os.path.isdir(srcname):
+            size += _link_tree(srcname, dstname, link)
+        else:
+            size += os.path.getsize(srcname)
+            if link == 'symlink':
+                os.symlink(srcname, dstname)
+                continue
+            if link == 'hardlink':
+                try:
+                    os.link(srcname, dstname)
+                    continue
+                except OSError:
+                    # e.g., the cache is on another file system
+                    pass
+            if link == 'reflink' and _reflink(srcname, dstname):
+                shutil.copystat(srcname, dstname)
+                continue
+            shutil.copy2(srcname, dstname)
+    return size
+
+class ResultCache(object):
+    """Content addressed store of node output directories
+
+    Parameters
+    ----------
+    root : str
+        directory of the cache
+    max_gb : float
+        size of the cache above which the least recently used entries are
+        removed when a new entry is stored (default: 0, unlimited)
+    link : str
+        how files are placed into and out of the cache: reflink
+        (copy-on-write clones, falls back to copying), copy, hardlink or
+        symlink. Hard and symbolic links share the data between the cache
+        and the output directories, so nodes must not modify their outputs
+        in place.
+
+    Examples
+    --------
+
+    >>> cache = ResultCache('/data/nipype_cache', max_gb=100) # doctest: +SKIP
+    >>> for entry in cache.entries(): # doctest: +SKIP
+    ...     print entry['interface'], entry['size']
+
+    """
+
+    # stores after which the size of the cache is read again from the
+    # entries, which other processes may have added or removed
+    rescan_interval = 100
+
+    def __init__(self, root, max_gb=0, link='reflink'):
+        if link not in ['reflink', 'copy', 'hardlink', 'symlink']:
+            raise ValueError('Unknown result cache link: %s' % link)
+        self.root = os.path.abspath(root)
+        self.max_gb = max_gb
+        self.link = link
+        self._size = None
+        self._stores = 0
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def load_result(self, key, outdir=None):
+        """Return the stored result of `key` or None if it is not stored
+
+        The paths in the outputs are changed to `outdir` (default: the
+        stored files), which must contain the stored files.
+        """
+        entrydir = self._entry_dir(key)
+        infofile = os.path.join(entrydir, 'info.json')
+        if not os.path.exists(infofile):
+            return None
+        if outdir is None:
+            outdir = os.path.join(entrydir, 'files')
+        try:
+            info = load_json(infofile)
+            result = load_resultfile(os.path.join(entrydir, 'files',
+                                                  info['resultsfile']))
+            if result.outputs:
+                outputs = result.outputs.get()
+                newoutputs = _replace_prefix(outputs, str(info['outdir']),
+                                             outdir)
+                for name, val in newoutputs.items():
+                    if val != outputs[name]:
+                        setattr(result.outputs, name, val)
+        except Exception, e:
+            logger.warn('Could not read cached result %s: %s' % (key, e))
+            return None
+        return result
+
+    def fetch(self, key, outdir, resultsfile):
+        """Place the stored output directory of `key` into `outdir`
+
+        The paths in the stored result are changed to `outdir` and the
+        result is written to `resultsfile`. Returns False if `key` is not
+        in the cache.
+        """
+        entrydir = self._entry_dir(key)
+        if not os.path.exists(os.path.join(entrydir, 'info.json')):
+            return False
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        _link_tree(os.path.join(entrydir, 'files'), outdir, self.link,
+                   skip=_is_metadata)
+        result = self.load_result(key, outdir)
+        if result is None:
+            return False
+        save_resultfile(resultsfile, result)
+        # the modification time of the info file orders the entries by use
+        os.utime(os.path.join(entrydir, 'info.json'), None)
+        return True
+
+    def store(self, key, outdir, resultsfile, interface):
+        """Store the output directory of a node that finished
+
+        The result and hash files are copied, the other files are linked
+        as configured. The environment the result refers to is saved into
+        the stored result, since the workflow directory may be removed. The least recently used entries are removed once the
+        tracked size of the cache exceeds `max_gb`.
+        """
+        entrydir = self._entry_dir(key)
+        if os.path.exists(entrydir):
+            return
+        tmpdir = os.path.join(self.root, 'tmp', '%s.%d' % (key, os.getpid()))
+        link = self.link
+        if link == 'symlink':
+            # the working directory may be removed
+            link = 'hardlink'
+        try:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+            size = _link_tree(outdir, os.path.join(tmpdir, 'files'), link,
+                              skip=_is_metadata)
+            for fname in os.listdir(outdir):
+                if not _is_metadata(fname):
+                    continue
+                dst = os.path.join(tmpdir, 'files', fname)
+                if fname == os.path.basename(resultsfile):
+                    save_resultfile(dst, load_resultfile(resultsfile))
+                else:
+                    shutil.copy2(os.path.join(outdir, fname), dst)
+                size += os.path.getsize(dst)
+            cls = interface.__class__
+            save_json(os.path.join(tmpdir, 'info.json'),
+                      dict(interface='%s.%s' % (cls.__module__, cls.__name__),
+                           outdir=outdir, size=size,
+                           resultsfile=os.path.basename(resultsfile)))
+            if not os.path.exists(os.path.dirname(entrydir)):
+                os.makedirs(os.path.dirname(entrydir))
+            os.rename(tmpdir, entrydir)
+        except (IOError, OSError), e:
+            # another process may have stored the same result
+            logger.debug('Could not store result %s: %s' % (key, e))
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        if self.max_gb and \
+                self._track_size(size) > self.max_gb * 1024 ** 3:
+            self.prune(self.max_gb)
+
+    def _track_size(self, size):
+        """Add the size of a stored entry to the size of the cache
+
+        The size is read from all entries on the first store and every
+        `rescan_interval` stores. Returns the size in bytes.
+        """
+        if self._size is None or self._stores % self.rescan_interval == 0:
+            self._size = sum([entry['size'] for entry in self.entries()])
+        else:
+            self._size += size
+        self._stores += 1
+        return self._size
+
+    def entries(self):
+        """Return the cache entries, least recently used first
+
+        Every entry is a dict with the keys key, interface, outdir, size
+        (bytes) and atime (last use).
+        """
+        entries = []
+        for infofile in glob(os.path.join(self.root, '??', '*', 'info.json')):
+            try:
+                info = load_json(infofile)
+                info['atime'] = os.path.getmtime(infofile)
+            except (IOError, OSError, ValueError):
+                continue
+            info['key'] = os.path.basename(os.path.dirname(infofile))
+            entries.append(info)
+        entries.sort(key=lambda entry: entry['atime'])
+        return entries
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def prune(self, max_gb):
+        """Remove the least recently used entries until the cache is
+        smaller than `max_gb`. Returns the number of removed entries.
+        """
+        entries = self.entries()
+        total = sum([entry['size'] for entry in entries])
+        maxsize = max_gb * 1024 ** 3
+        removed = 0
+        for entry in entries:
+            if total <= maxsize:
+                break
+            self.remove(entry['key'])
+            total -= entry['size']
+            removed += 1
+        self._size = total
+        return removed
+
+    def clear(self):
+        """Remove all entries"""
+        for entry in self.entries():
+            self.remove(entry['key'])
+        self._size = 0
+
+_cache = None
+
+def get_result_cache():
+    """Return the result cache configured in the config file or None
+
+    The cache is shared by the nodes of a process, so that its size is
+    tracked across stores. The timestamp and fast hashes of input files
+    only cover their size and modification time, which different files
+    (e.g., the images of two subjects) can share, so the cache is only used
+    with content hashes.
+    """
+    global _cache
+    root = config.get('execution', 'result_cache_dir').strip()
+    if not root:
+        return None
+    if config.get('execution', 'hash_method').lower() != 'content':
+        return None
+    root = os.path.abspath(os.path.expanduser(root))
+    link = config.get('execution', 'result_cache_link').strip().lower()
+    if _cache is None or _cache.root != root or _cache.link != link:
+        _cache = ResultCache(root, link=link)
+    _cache.max_gb = config.getfloat('execution', 'result_cache_max_gb')
+    return _cache
+
+def main(argv):
+    parser = OptionParser(usage='%prog [-d DIR] list | prune MAX_GB | clear')
+    parser.add_option('-d', '--dir', dest='root',
+                      help='cache directory (default: result_cache_dir of '
+                      'the config file)')
+    options, args = parser.parse_args(argv)
+    if options.root:
+        cache = ResultCache(options.root)
+    else:
+        cache = get_result_cache()
+    if cache is None:
+        parser.error('result_cache_dir is not set in the config file')
+    if not args or args[0] not in ['list', 'prune', 'clear'] or \
+            (args[0] == 'prune' and len(args) != 2):
+        parser.error('expected list, prune MAX_GB or clear')
+    if args[0] == 'list':
+        entries = cache.entries()
+        for entry in entries:
+            print '%s %10.1f MB  %s  %s' % (entry['key'],
+                                            entry['size'] / 1024. ** 2,
+                                            ctime(entry['atime']),
+                                            entry['interface'])
+        print '%d entries, %.2f GB' % (len(entries),
+                                       sum([entry['size'] for entry \
+                                                in entries]) / 1024. ** 3)
+    elif args[0] == 'prune':
+        print 'Removed %d entries' % cache.prune(float(args[1]))
+    else:
+        cache.clear()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
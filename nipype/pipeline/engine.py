@@ -12,7 +12,7 @@ The `Pipeline` class provides core functionality for batch processing.
 
 """
 
-from copy import deepcopy
+from copy import copy, deepcopy
 import logging.handlers
 import os
 import pwd
@@ -20,37 +20,39 @@ from shutil import rmtree
 from socket import gethostname
 import sys
 from tempfile import mkdtemp
-from time import sleep, strftime
+from time import strftime, time
 from traceback import format_exception
 from warnings import warn
 
-from enthought.traits.trait_handlers import TraitDictObject, TraitListObject
 import numpy as np
 
 from nipype.utils.misc import package_check
 import shutil
-import cPickle
-import gzip
 package_check('networkx', '1.0')
 import networkx as nx
-try:
-    from IPython.kernel.contexts import ConnectionRefusedError
-except:
-    pass
 
 from nipype.interfaces.base import (traits, File, Directory, InputMultiPath,
                                     CommandLine, Undefined,
                                     OutputMultiPath, TraitedSpec,
                                     DynamicTraitedSpec,
-                                    Bunch, InterfaceResult)
+                                    Bunch, InterfaceResult, environ_snapshot)
 from nipype.utils.misc import isdefined
 from nipype.utils.filemanip import (save_json, FileNotFoundError,
                                     filename_to_list, list_to_filename,
                                     copyfiles, fnames_presuffix)
 
-from nipype.pipeline.utils import (_generate_expanded_graph,
+from nipype.pipeline.cache import get_result_cache, result_key
+from nipype.pipeline.utils import (_generate_expanded_graph, _clone_graph,
+                                   _generate_expanded_batches,
+                                   _merge_batch_nodes,
                                    _create_pickleable_graph, export_graph,
-                                   _report_nodes_not_run, make_output_dir)
+                                   make_output_dir, save_resultfile,
+                                   load_resultfile)
+from nipype.pipeline.plugins.base import _get_runtime, _set_node_input
+from nipype.pipeline.s3_node_wrapper import stage_s3_files
+from nipype.pipeline.plugins import (PluginBase, LinearPlugin,
+                                     MultiProcPlugin, IPythonPlugin,
+                                     SGEPlugin, PBSPlugin, SLURMPlugin)
 from nipype.utils.config import config
 
 #Sets up logging for pipeline and nodewrapper execution
@@ -200,20 +202,6 @@ class Workflow(WorkflowBase):
     def __init__(self, **kwargs):
         super(Workflow, self).__init__(**kwargs)
         self._graph = nx.DiGraph()
-        self.ipyclient = None
-        self.taskclient = None
-        try:
-            name = 'IPython.kernel.client'
-            __import__(name)
-            self.ipyclient = sys.modules[name]
-        except ImportError:
-            warn("Ipython kernel not found.  Parallel execution will be" \
-                     "unavailable", ImportWarning)
-        # attributes for running with manager
-        self.procs = None
-        self.depidx = None
-        self.proc_done = None
-        self.proc_pending = None
         self._flatgraph = None
         self._execgraph = None
 
@@ -385,10 +373,12 @@ class Workflow(WorkflowBase):
         if graph2use == 'exec':
             graph = self._execgraph
             if graph is None:
-                graph = _generate_expanded_graph(deepcopy(self._flatgraph))
+                graph = _generate_expanded_graph(
+                    _clone_graph(self._flatgraph)[0])
         export_graph(graph, self.base_dir, dotfilename=dotfilename)
 
-    def run(self, inseries=False):
+    def run(self, inseries=False, plugin=None, plugin_args=None,
+            updatehash=False):
         """ Execute the workflow
 
         Parameters
@@ -396,18 +386,122 @@ class Workflow(WorkflowBase):
         
         inseries: Boolean
             Execute workflow in series
+        plugin: plugin name or object
+            Plugin to use for execution. You can create your own plugins for
+            execution. Available plugins are 'Linear', 'MultiProc' and
+            'IPython' (default).
+        plugin_args : dictionary containing arguments to be sent to plugin
+            constructor. see individual plugin doc strings for details.
+        updatehash: Boolean
+            Update the hashes of the nodes without executing them
         """
+        t0 = time()
         self._create_flat_graph()
-        self._execgraph = _generate_expanded_graph(deepcopy(self._flatgraph))
-        for node in self._execgraph.nodes():
-            node.config = self.config
-        if inseries == True:
-            self._execute_in_series()
+        if inseries or config.getboolean('execution', 'run_in_series'):
+            plugin = 'Linear'
+        batch_size = config.getint('execution', 'iterables_batch_size')
+        if batch_size > 0:
+            execgraphs = _generate_expanded_batches(self._flatgraph,
+                                                    batch_size)
         else:
-            self._execute_with_manager()
-        
+            execgraphs = [_generate_expanded_graph(
+                    _clone_graph(self._flatgraph)[0])]
+        # plugins are reusable, so all batches run on the same one
+        runner = self._get_plugin(plugin, plugin_args)
+        for execgraph in execgraphs:
+            execgraph = _merge_batch_nodes(execgraph)
+            logger.info('Expanded workflow %s into %d nodes in %.2f seconds' \
+                            % (self.name, execgraph.number_of_nodes(),
+                               time() - t0))
+            # only the graph of the current batch is kept
+            self._execgraph = execgraph
+            for node in self._execgraph.nodes():
+                node.config = self.config
+                self._set_output_directory_base(node)
+                node._environ_dir = os.path.join(self.base_dir, '_environ')
+            runner.run(self._execgraph, updatehash=updatehash)
+            t0 = time()
+
+    def cache_report(self):
+        """Report which nodes a run would execute without running any node
+
+        The workflow is expanded and the hash of every node is compared to
+        the hash file in its output directory (or looked up in the result
+        cache). The outputs of cached nodes are read from their result files
+        to set the inputs of their dependents. Nodes that depend on a node
+        that is rerun are rerun as well.
+
+        Returns
+        -------
+        report : dict
+            `cached` and `rerun` contain the names of the nodes, `runtime` is
+            the duration (in seconds) of the previous runs of the nodes to
+            rerun and `unknown_runtime` the number of these nodes that have
+            not run before
+        """
+        self._create_flat_graph()
+        execgraph = _merge_batch_nodes(_generate_expanded_graph(
+                _clone_graph(self._flatgraph)[0]))
+        report = dict(cached=[], rerun=[], runtime=0., unknown_runtime=0)
+        rerun = set()
+        for node in nx.topological_sort(execgraph):
+            node.config = self.config
+            self._set_output_directory_base(node)
+            result = None
+            if not node.overwrite and \
+                    not rerun.intersection(execgraph.predecessors(node)):
+                for edge in execgraph.in_edges_iter(node):
+                    data = execgraph.get_edge_data(*edge)
+                    for sourceinfo, destname in data['connect']:
+                        _set_node_input(node, destname, edge[0], sourceinfo)
+                result = node._load_result()
+            if result is None:
+                rerun.add(node)
+                report['rerun'].append(str(node))
+                runtime = _get_runtime(node)
+                if runtime is None:
+                    report['unknown_runtime'] += 1
+                else:
+                    report['runtime'] += runtime
+            else:
+                node._result = result
+                report['cached'].append(str(node))
+        logger.info('Workflow %s: %d nodes cached, %d nodes to run (%.0f '
+                    'seconds in previous runs, %d nodes without previous '
+                    'runs)' % (self.name, len(report['cached']),
+                               len(report['rerun']), report['runtime'],
+                               report['unknown_runtime']))
+        return report
+
+    
     # PRIVATE API AND FUNCTIONS
 
+    def _get_plugin(self, plugin, plugin_args):
+        """Return an instance of the requested execution plugin
+
+        Without an explicit plugin the IPython plugin is tried and the
+        workflow falls back to serial execution if no IPython controller is
+        available.
+        """
+        if isinstance(plugin, PluginBase):
+            return plugin
+        if plugin is None:
+            try:
+                return IPythonPlugin(plugin_args=plugin_args)
+            except Exception, e:
+                warn("%s. Running serially for now." % str(e))
+                return LinearPlugin(plugin_args=plugin_args)
+        plugins = dict([(name.lower(), cls) for name, cls in \
+                            [('Linear', LinearPlugin),
+                             ('MultiProc', MultiProcPlugin),
+                             ('IPython', IPythonPlugin),
+                             ('SGE', SGEPlugin),
+                             ('PBS', PBSPlugin),
+                             ('SLURM', SLURMPlugin)]])
+        if plugin.lower() not in plugins:
+            raise ValueError('Unknown execution plugin: %s' % plugin)
+        return plugins[plugin.lower()](plugin_args=plugin_args)
+
     def _check_nodes(self, nodes):
         "docstring for _check_nodes"
         node_names = [node.name for node in self._graph.nodes()]
@@ -488,29 +582,22 @@ class Workflow(WorkflowBase):
     def _set_input(self, object, name, newvalue):
         object.traits()[name].node.set_input(name, newvalue)
 
-    def _set_node_input(self, node, param, source, sourceinfo):
-        """Set inputs of a node given the edge connection"""
-        if isinstance(sourceinfo, str):
-            val = source.get_output(sourceinfo)
-        elif isinstance(sourceinfo, tuple):
-            if callable(sourceinfo[1]):
-                val = sourceinfo[1](source.get_output(sourceinfo[0]),
-                                    *sourceinfo[2:])
-        newval = val
-        if isinstance(val, TraitDictObject):
-            newval = dict(val)
-        if isinstance(val, TraitListObject):
-            newval = val[:]
-        logger.debug('setting node input: %s->%s', param, str(newval))
-        node.set_input(param, deepcopy(newval))
-
     def _create_flat_graph(self):
         self._flatgraph = None
         self._execgraph = None
-        workflowcopy = deepcopy(self)
+        workflowcopy = self._lazy_copy()
         workflowcopy._generate_execgraph()
         self._flatgraph = workflowcopy._graph
 
+    def _lazy_copy(self):
+        """Copy the workflow and its graph without copying interfaces
+        """
+        clone = copy(self)
+        clone._graph, _ = _clone_graph(self._graph)
+        clone._flatgraph = None
+        clone._execgraph = None
+        return clone
+
     def _reset_hierarchy(self):
         for node in self._graph.nodes():
             if isinstance(node, Workflow):
@@ -561,67 +648,6 @@ class Workflow(WorkflowBase):
         if nodes2remove:
             self._graph.remove_nodes_from(nodes2remove)
 
-    def _execute_in_series(self, updatehash=False, force_execute=None):
-        """Executes a pre-defined pipeline in a serial order.
-
-        Parameters
-        ----------
-        updatehash : boolean
-            Allows one to rerun a pipeline and update all the hashes without
-            actually executing any of the underlying interfaces. This is useful
-            when moving the working directory from one location to another. It
-            is also useful when the hashing function itself changes (although
-            we hope that this will not happen often). default [False]
-        force_execute : list of strings
-            This forces execution of a node even if updatehash is True
-        """
-        # In the absence of a dirty bit on the object, generate the
-        # parameterization each time before running
-        logger.info("Running serially.")
-        old_wd = os.getcwd()
-        notrun = []
-        donotrun = []
-        for node in nx.topological_sort(self._execgraph):
-            # Assign outputs from dependent executed nodes to current node.
-            # The dependencies are stored as data on edges connecting
-            # nodes.
-            try:
-                if node in donotrun:
-                    continue
-                for edge in self._execgraph.in_edges_iter(node):
-                    data = self._execgraph.get_edge_data(*edge)
-                    logger.debug('setting input: %s->%s %s',
-                                 edge[0], edge[1], str(data))
-                    for sourceinfo, destname in data['connect']:
-                        self._set_node_input(node, destname,
-                                             edge[0], sourceinfo)
-                self._set_output_directory_base(node)
-                redo = None
-                if force_execute:
-                    if isinstance(force_execute, str):
-                        force_execute = [force_execute]
-                    redo = any([node.name.lower()==l.lower() \
-                                    for l in force_execute])
-                if updatehash and not redo:
-                    node.run(updatehash=updatehash)
-                else:
-                    node.run(force_execute=redo)
-            except:
-                os.chdir(old_wd)
-                if config.getboolean('execution', 'stop_on_first_crash'):
-                    raise
-                # bare except, but i really don't know where a
-                # node might fail
-                crashfile = node._report_crash(execgraph=self._execgraph)
-                # remove dependencies from queue
-                subnodes = nx.dfs_preorder(self._execgraph, node)
-                notrun.append(dict(node = node,
-                                   dependents = subnodes,
-                                   crashfile = crashfile))
-                donotrun.extend(subnodes)
-        _report_nodes_not_run(notrun)
-
-
     def _set_output_directory_base(self, node):
         """Determine output directory and create it
         """
@@ -637,165 +663,6 @@ class Workflow(WorkflowBase):
             os.makedirs(outputdir)
         node.base_dir = os.path.abspath(outputdir)
 
-    def _generate_dependency_list(self):
-        """ Generates a dependency list for a list of graphs. Adds the
-        following attributes to the pipeline:
-
-        New attributes:
-        ---------------
-
-        procs: list (N) of underlying interface elements to be
-        processed
-        proc_done: a boolean vector (N) signifying whether a process
-        has been executed
-        proc_pending: a boolean vector (N) signifying whether a
-        process is currently running.
-        Note: A process is finished only when both proc_done==True and
-        proc_pending==False
-        depidx: a boolean matrix (NxN) storing the dependency
-        structure accross processes. Process dependencies are derived
-        from each column.
-        """
-        if not self._execgraph:
-            raise Exception('Execution graph has not been generated')
-        self.procs = self._execgraph.nodes()
-        self.depidx = nx.adj_matrix(self._execgraph).__array__()
-        self.proc_done    = np.zeros(len(self.procs), dtype=bool)
-        self.proc_pending = np.zeros(len(self.procs), dtype=bool)
-
-    def _remove_node_deps(self, jobid, crashfile):
-        subnodes = nx.dfs_preorder(self._execgraph, self.procs[jobid])
-        for node in subnodes:
-            idx = self.procs.index(node)
-            self.proc_done[idx] = True
-            self.proc_pending[idx] = False
-        return dict(node = self.procs[jobid],
-                    dependents = subnodes,
-                    crashfile = crashfile)
-
-    def _execute_with_manager(self):
-        """Executes a pre-defined pipeline is distributed approaches
-        based on IPython's parallel processing interface
-        """
-        if config.getboolean('execution', 'run_in_series'):
-            self._execute_in_series()
-            return
-        # retrieve clients again
-        if not self.taskclient:
-            try:
-                self.taskclient = self.ipyclient.TaskClient()
-            except Exception, e:
-                if isinstance(e, ConnectionRefusedError):
-                    warn("No clients found, running serially for now.")
-                if isinstance(e, ValueError):
-                    warn("Ipython kernel not installed")
-                self._execute_in_series()
-                return
-        logger.info("Running in parallel.")
-        # self.taskclient.clear()
-        # in the absence of a dirty bit on the object, generate the
-        # parameterization each time before running
-        # Generate appropriate structures for worker-manager model
-        self._generate_dependency_list()
-        # get number of ipython clients available
-        self.pending_tasks = []
-        self.readytorun = []
-        # setup polling
-        notrun = []
-        while np.any(self.proc_done==False) | np.any(self.proc_pending==True):
-            toappend = []
-            # trigger callbacks for any pending results
-            while self.pending_tasks:
-                taskid, jobid = self.pending_tasks.pop()
-                try:
-                    res = self.taskclient.get_task_result(taskid, block=False)
-                    if res:
-                        if res['traceback']:
-                            self.procs[jobid]._result = res['result']
-                            self.procs[jobid]._traceback = res['traceback']
-                            crashfile = self.procs[jobid]._report_crash(traceback=res['traceback'],
-                                                                        execgraph=self._execgraph)
-                            # remove dependencies from queue
-                            notrun.append(self._remove_node_deps(jobid, crashfile))
-                        else:
-                            self._task_finished_cb(res['result'], jobid)
-                    else:
-                        toappend.insert(0, (taskid, jobid))
-                except:
-                    crashfile = self.procs[jobid]._report_crash(execgraph=self._execgraph)
-                    # remove dependencies from queue
-                    notrun.append(self._remove_node_deps(jobid, crashfile))
-            if toappend:
-                self.pending_tasks.extend(toappend)
-            #else:
-            #    self.taskclient.clear()
-            self._send_procs_to_workers()
-            sleep(2)
-        #self.taskclient.clear()
-        _report_nodes_not_run(notrun)
-
-    def _send_procs_to_workers(self):
-        """ Sends jobs to workers using ipython's taskclient interface
-        """
-        while np.any(self.proc_done == False):
-            # Check to see if a job is available
-            jobids = np.flatnonzero((self.proc_done == False) & \
-                                        np.all(self.depidx==0, axis=0))
-            if len(jobids)>0:
-                # send all available jobs
-                logger.info('Submitting %d jobs' % len(jobids))
-                for jobid in jobids:
-                    # change job status in appropriate queues
-                    self.proc_done[jobid] = True
-                    self.proc_pending[jobid] = True
-                    self._set_output_directory_base(self.procs[jobid])
-                    # Send job to task manager and add to pending tasks
-                    _, hashvalue = self.procs[jobid]._get_hashval()
-                    logger.info('Executing: %s ID: %d H:%s' % \
-                                    (self.procs[jobid]._id, jobid, hashvalue))
-                    cmdstr = """import sys
-from traceback import format_exception
-traceback=None
-try:
-    result = task.run()
-except:
-    etype, eval, etr = sys.exc_info()
-    traceback = format_exception(etype,eval,etr)
-    result = task.result
-"""
-                    task = self.ipyclient.StringTask(cmdstr,
-                                                     push = dict(task=self.procs[jobid]),
-                                                     pull = ['result','traceback'])
-                    tid = self.taskclient.run(task, block = False)
-                    #logger.info('Task id: %d' % tid)
-                    self.pending_tasks.insert(0, (tid, jobid))
-            else:
-                break
-
-    def _task_finished_cb(self, result, jobid):
-        """ Extract outputs and assign to inputs of dependent tasks
-
-        This is called when a job is completed.
-        """
-        logger.info('[Job finished] jobname: %s jobid: %d' % \
-                        (self.procs[jobid]._id, jobid))
-        # Update job and worker queues
-        self.proc_pending[jobid] = False
-        if self.procs[jobid]._result != result:
-            self.procs[jobid]._result = result
-        # Update the inputs of all tasks that depend on this job's outputs
-        graph = self._execgraph
-        for edge in graph.out_edges_iter(self.procs[jobid]):
-            data = graph.get_edge_data(*edge)
-            for sourceinfo, destname in data['connect']:
-                logger.debug('%s %s %s %s',edge[1], destname, self.procs[jobid], sourceinfo)
-                self._set_node_input(edge[1], destname,
-                                     self.procs[jobid], sourceinfo)
-        # update the job dependency structure
-        self.depidx[jobid, :] = 0.
-
-
-
 class Node(WorkflowBase):
     """Wraps interface objects for use in pipeline
 
@@ -812,6 +679,22 @@ class Node(WorkflowBase):
         of tuples
         node.iterables = ('frac',[0.5,0.6,0.7])
         node.iterables = [('fwhm',[2,4]),('fieldx',[0.5,0.6,0.7])]
+    estimated_memory_gb : float
+        memory (in GB) the interface is expected to use (default: 0.25). The
+        distributed plugins do not start a node unless this much of their
+        memory budget is free.
+    num_threads : int
+        number of threads/cpus the interface uses (default: 1)
+    run_without_submitting : boolean
+        let the distributed plugins run the node in the scheduling process
+        instead of submitting it to a worker (default: the
+        `run_without_submitting` attribute of the interface, which is True
+        for the interfaces in nipype.interfaces.utility)
+    io_bound : boolean
+        let the distributed plugins run the node on their prefetch pool
+        ahead of the compute jobs (default: the `io_bound` attribute of the
+        interface, which is True for the data sources and sinks in
+        nipype.interfaces.io)
 
     Notes
     -----
@@ -830,7 +713,9 @@ class Node(WorkflowBase):
     >>> realign.run() # doctest: +SKIP
 
     """
-    def __init__(self, interface, iterables={}, **kwargs):
+    def __init__(self, interface, iterables={}, estimated_memory_gb=0.25,
+                 num_threads=1, run_without_submitting=None, io_bound=None,
+                 **kwargs):
         # interface can only be set at initialization
         super(Node, self).__init__(**kwargs)
         if interface is None:
@@ -838,6 +723,17 @@ class Node(WorkflowBase):
         self._interface  = interface
         self._result     = None
         self.iterables  = iterables
+        self._interface_shared = False
+        self._hashvalue = None
+        self._environ_dir = None
+        self.estimated_memory_gb = estimated_memory_gb
+        self.num_threads = num_threads
+        if run_without_submitting is None:
+            run_without_submitting = interface.run_without_submitting
+        self.run_without_submitting = run_without_submitting
+        if io_bound is None:
+            io_bound = interface.io_bound
+        self.io_bound = io_bound
         self.parameterization = None
 
     @property
@@ -856,12 +752,45 @@ class Node(WorkflowBase):
     def outputs(self):
         return self._interface._outputs()
 
+    def __getstate__(self):
+        # pickled and deep copied nodes own their interface
+        state = self.__dict__.copy()
+        state['_interface_shared'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # trait listeners are not copied with the inputs
+        if self.__dict__.get('_hashvalue') is not None:
+            self._watch_inputs()
+
+    def _lazy_copy(self):
+        """Return a copy that shares the interface with this node
+
+        The copy creates its own interface before it modifies it (see
+        `_own_interface`), so that expanding a workflow does not copy the
+        interfaces of nodes that are never modified.
+        """
+        clone = copy(self)
+        clone._interface_shared = True
+        clone._hashvalue = None
+        return clone
+
+    def _own_interface(self):
+        """Copy a shared interface before modifying it
+        """
+        if self._interface_shared:
+            self._interface = deepcopy(self._interface)
+            self._interface_shared = False
+            self._hashvalue = None
+
     def set_input(self, parameter, val):
         """ Set interface input value or nodewrapper attribute
 
         Priority goes to interface.
         """
         logger.debug('setting nodelevel input %s = %s' % (parameter, str(val)))
+        self._own_interface()
         setattr(self.inputs, parameter, deepcopy(val))
 
     def get_output(self, parameter):
@@ -871,8 +800,27 @@ class Node(WorkflowBase):
         return val
 
     def _get_hashval(self):
+        """Return the hashed inputs and the hash value of the node
+
+        The hash is computed once and reused by the execution plugins and
+        `run` until an input changes or the node has run.
+        """
+        if self._hashvalue is None:
+            self._hashvalue = self._compute_hashval()
+            self._watch_inputs()
+        return self._hashvalue
+
+    def _compute_hashval(self):
         return self.inputs.hashval
 
+    def _watch_inputs(self):
+        """Forget the hash when an input changes"""
+        self.inputs.on_trait_change(self._reset_hashval)
+        self._interface.inputs.on_trait_change(self._reset_hashval)
+
+    def _reset_hashval(self):
+        self._hashvalue = None
+
     def _save_hashfile(self, hashfile, hashed_inputs):
         try:
             save_json(hashfile, hashed_inputs)
@@ -892,30 +840,58 @@ class Node(WorkflowBase):
                                     hashfile)
 
 
+    def hash_exists(self):
+        """Check if the hash file of the current inputs exists
+
+        Returns
+        -------
+        exists : boolean
+        hashvalue : str
+        hashfile : str
+            path of the hash file in the output directory
+        hashed_inputs : dict
+            inputs with the hashes of the files they refer to
+        """
+        # Get a dictionary with hashed filenames and a hashvalue
+        # of the dictionary itself.
+        hashed_inputs, hashvalue = self._get_hashval()
+        outdir = self._output_directory()
+        hashfile = os.path.join(outdir, '_0x%s.json' % hashvalue)
+        return os.path.exists(hashfile), hashvalue, hashfile, hashed_inputs
+
     def run(self, updatehash=None, force_execute=False):
         """Executes an interface within a directory.
         """
         # check to see if output directory and hash exist
         logger.info("Node: %s"%self._id)
+        self._own_interface()
         outdir = self._output_directory()
         outdir = make_output_dir(outdir)
         logger.info("in dir: %s"%outdir)
-        # Get a dictionary with hashed filenames and a hashvalue
-        # of the dictionary itself.
-        hashed_inputs, hashvalue = self._get_hashval()
-        hashfile = os.path.join(outdir, '_0x%s.json' % hashvalue)
+        hash_exists, hashvalue, hashfile, hashed_inputs = self.hash_exists()
+        # the input files may change before the next run
+        self._reset_hashval()
+        cache = self._result_cache()
+        if cache:
+            cachekey = result_key(self._interface, hashvalue, hashed_inputs)
+            if not (force_execute or updatehash or self.overwrite or \
+                        hash_exists) and \
+                        cache.fetch(cachekey, outdir,
+                                    os.path.join(outdir,
+                                                 'result_%s.pklz' % self._id)):
+                logger.info("Reusing cached result %s" % cachekey)
+                self._save_hashfile(hashfile, hashed_inputs)
+                hash_exists = True
         if updatehash:
             #if isinstance(self, MapNode):
             #    self._run_interface(updatehash=True)
             logger.debug("Updating hash: %s" % hashvalue)
             self._save_hashfile(hashfile, hashed_inputs)
-        if force_execute or (not updatehash and (self.overwrite or not os.path.exists(hashfile))):
+        if force_execute or (not updatehash and (self.overwrite or not hash_exists)):
             logger.debug("Node hash: %s"%hashvalue)
             hashfile_unfinished = os.path.join(outdir, '_0x%s_unfinished.json' % hashvalue)
-            if os.path.exists(outdir) and not (os.path.exists(hashfile_unfinished) and self._interface.can_resume):
-                logger.debug("Removing old %s and its contents"%outdir)
-                rmtree(outdir)
-                outdir = make_output_dir(outdir)
+            if os.path.exists(outdir) and not (os.path.exists(hashfile_unfinished) and self._can_resume()):
+                outdir = self._clear_output_directory(outdir)
             else:
                 logger.debug("%s found and can_resume is True - resuming execution" % hashfile_unfinished)
             self._save_hashfile(hashfile_unfinished, hashed_inputs)
@@ -930,6 +906,11 @@ class Node(WorkflowBase):
                 returncode = self._result.runtime.returncode
             if returncode == 0:
                 shutil.move(hashfile_unfinished, hashfile)
+                if cache:
+                    cache.store(cachekey, outdir,
+                                os.path.join(outdir,
+                                             'result_%s.pklz' % self._id),
+                                self._interface)
             else:
                 msg = "Could not run %s" % self.name
                 msg += "\nwith inputs:\n%s" % self.inputs
@@ -941,6 +922,43 @@ class Node(WorkflowBase):
             self._run_interface(execute=False, cwd=outdir)
         return self._result
 
+    def _can_resume(self):
+        """Whether partial results of an interrupted run can be reused"""
+        return self._interface.can_resume
+
+    def _clear_output_directory(self, outdir):
+        """Remove the results of a previous run"""
+        logger.debug("Removing old %s and its contents"%outdir)
+        rmtree(outdir)
+        return make_output_dir(outdir)
+
+    def _result_cache(self):
+        """Return the central result cache if the node may use it"""
+        if self.run_without_submitting or \
+                not self._interface.result_cacheable:
+            return None
+        return get_result_cache()
+
+    def _load_result(self):
+        """Return the result of a previous run with the current inputs
+
+        Returns None if the node would be run. Neither the interface is run
+        nor the output directory modified.
+        """
+        hash_exists, hashvalue, _, hashed_inputs = self.hash_exists()
+        if hash_exists:
+            resultsfile = os.path.join(self._output_directory(),
+                                       'result_%s.pklz' % self._id)
+            try:
+                return load_resultfile(resultsfile)
+            except Exception:
+                return None
+        cache = self._result_cache()
+        if cache:
+            return cache.load_result(result_key(self._interface, hashvalue,
+                                                hashed_inputs))
+        return None
+
     def _run_interface(self, execute=True, cwd=None):
         old_cwd = os.getcwd()
         if not cwd:
@@ -968,7 +986,7 @@ class Node(WorkflowBase):
             try:
                 result = self._interface.run()
             except:
-                runtime = Bunch(returncode = 1, environ = deepcopy(os.environ.data), hostname = gethostname())
+                runtime = Bunch(returncode = 1, environ = environ_snapshot(), hostname = gethostname())
                 result = InterfaceResult(interface=None,
                                          runtime=runtime,
                                          outputs=None)
@@ -980,35 +998,56 @@ class Node(WorkflowBase):
                 self._result = result
                 raise RuntimeError(result.runtime.stderr)
             else:
-                pkl_file = gzip.open(resultsfile, 'wb')
-                cPickle.dump(result, pkl_file)
-                pkl_file.close()
+                save_resultfile(resultsfile, result, self._environ_dir)
 
         else:
             # Likewise, cwd could go in here
             logger.debug("Collecting precomputed outputs:")
             try:
                 if os.path.exists(resultsfile):
-                    pkl_file = gzip.open(resultsfile, 'rb')
-                    result = cPickle.load(pkl_file)
-                    pkl_file.close()
+                    result = load_resultfile(resultsfile)
                 else: # backwards compatibility - does not support var caching
                     aggouts = self._interface.aggregate_outputs()
-                    runtime = Bunch(returncode = 0, environ = deepcopy(os.environ.data), hostname = gethostname())
+                    runtime = Bunch(returncode = 0, environ = environ_snapshot(), hostname = gethostname())
                     result = InterfaceResult(interface=None,
                                              runtime=runtime,
                                              outputs=aggouts)
-                    pkl_file = gzip.open(resultsfile, 'wb')
-                    cPickle.dump(result, pkl_file)
-                    pkl_file.close()
+                    save_resultfile(resultsfile, result, self._environ_dir)
                     
             except FileNotFoundError:
                 logger.debug("Some of the outputs were not found: rerunning node.")
                 result = self._run_command(execute=True, cwd=cwd, copyfiles=False)
         return result
 
+    def _stage_remote_inputs(self, outdir):
+        """Download inputs given as s3:// URIs and change the inputs"""
+        remote = {}
+        for key, val in self.inputs.get().items():
+            if not isdefined(val):
+                continue
+            uris = [uri for uri in filename_to_list(val) or [] \
+                        if isinstance(uri, str) and uri.startswith('s3://')]
+            if uris:
+                remote[key] = uris
+        if not remote:
+            return
+        uris = sorted(set(sum(remote.values(), [])))
+        logger.info('Staging %d files from S3' % len(uris))
+        localfiles = dict(zip(uris, stage_s3_files(uris, outdir)))
+        for key in remote.keys():
+            val = getattr(self.inputs, key)
+            if isinstance(val, str):
+                newval = localfiles[val]
+            else:
+                newval = [localfiles.get(item, item) for item in val]
+                if isinstance(val, tuple):
+                    newval = tuple(newval)
+            setattr(self.inputs, key, newval)
+
     def _copyfiles_to_wd(self, outdir, execute):
         """ copy files over and change the inputs"""
+        if execute:
+            self._stage_remote_inputs(outdir)
         if hasattr(self._interface,'_get_filecopy_info'):
             for info in self._interface._get_filecopy_info():
                 files = self.inputs.get().get(info['key'])
@@ -1025,6 +1064,7 @@ class Node(WorkflowBase):
                     setattr(self.inputs, info['key'], newfiles)
 
     def update(self, **opts):
+        self._own_interface()
         self.inputs.update(**opts)
 
 
@@ -1063,6 +1103,8 @@ class MapNode(Node):
         self._inputs = self._create_dynamic_traits(self._interface.inputs,
                                                    fields=self.iterfield)
         self._inputs.on_trait_change(self._set_mapnode_input)
+        self._overwrite_iterations = False
+        self._iterations_submitted = False
 
     def _create_dynamic_traits(self, basetraits, fields=None, nitems=None):
         """Convert specific fields of a trait to accept multiple inputs
@@ -1086,8 +1128,22 @@ class MapNode(Node):
         Priority goes to interface.
         """
         logger.debug('setting nodelevel input %s = %s' % (parameter, str(val)))
+        self._own_interface()
         self._set_mapnode_input(self.inputs, parameter, deepcopy(val))
 
+    def _own_interface(self):
+        """Copy a shared interface and the iterfield inputs before modifying
+        them
+        """
+        if self._interface_shared:
+            values = self._inputs.get()
+            super(MapNode, self)._own_interface()
+            self._inputs = self._create_dynamic_traits(self._interface.inputs,
+                                                       fields=self.iterfield)
+            for name, value in values.items():
+                setattr(self._inputs, name, value)
+            self._inputs.on_trait_change(self._set_mapnode_input)
+
     def _set_mapnode_input(self, object, name, newvalue):
         logger.debug('setting mapnode input: %s -> %s' %(name, str(newvalue)))
         if name in self.iterfield:
@@ -1095,7 +1151,7 @@ class MapNode(Node):
         else:
             setattr(self._interface.inputs, name, newvalue)
 
-    def _get_hashval(self):
+    def _compute_hashval(self):
         """ Compute hash including iterfield lists
         """
         hashinputs = deepcopy(self._interface.inputs)
@@ -1117,49 +1173,133 @@ class MapNode(Node):
         else:
             return None
 
-    def _run_interface(self, execute=True, cwd=None):
-        old_cwd = os.getcwd()
-        if not cwd:
-            cwd = self._output_directory()
-        os.chdir(cwd)
+    def run(self, updatehash=None, force_execute=False):
+        """Executes the iterations within a directory.
+
+        Iterations whose inputs did not change are reused unless the node is
+        overwritten or `force_execute` is set. The iterations that an
+        execution plugin ran after `get_subnodes` are only collected.
+        """
+        self._overwrite_iterations = (self.overwrite or force_execute) and \
+            not self._iterations_submitted
+        self._iterations_submitted = False
+        try:
+            return super(MapNode, self).run(updatehash=updatehash,
+                                            force_execute=force_execute)
+        finally:
+            self._overwrite_iterations = False
+
+    def _can_resume(self):
+        """Iterations are hashed individually, so the ones that finished
+        before an interruption are reused"""
+        return True
+
+    def _clear_output_directory(self, outdir):
+        """Remove the results of a previous run except for the iterations
 
+        The iterations are hashed individually, so that only those whose
+        inputs changed are rerun.
+        """
+        logger.debug("Removing old %s except for the iterations"%outdir)
+        nitems = len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
+        iterdirs = set(['_%s%d' % (self.name, i) for i in range(nitems)])
+        for name in os.listdir(outdir):
+            path = os.path.join(outdir, name)
+            if name == 'mapflow' and os.path.isdir(path):
+                for itername in os.listdir(path):
+                    if itername not in iterdirs:
+                        rmtree(os.path.join(path, itername))
+            elif os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+        return outdir
+
+    def _result_cache(self):
+        """The iterations use the result cache individually"""
+        return None
+
+    def _load_result(self):
+        """Collate the results of the iterations of a previous run"""
+        if not self.hash_exists()[0]:
+            return None
+        nodes = self._make_nodes()
+        for node in nodes:
+            node._result = node._load_result()
+            if node._result is None:
+                return None
+        self._collate_results(nodes)
+        return self._result
+
+    def _make_nodes(self, cwd=None, overwrite=False):
+        """Create a node for every iteration over the iterfield inputs
+
+        With `overwrite` the iterations are rerun even if their hash exists.
+        """
+        if cwd is None:
+            cwd = self._output_directory()
         nitems = len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
         newnodes = []
-        nodenames = []
         for i in range(nitems):
-            nodenames.insert(i, '_' + self.name+str(i))
-            newnodes.insert(i, Node(deepcopy(self._interface), name=nodenames[i]))
-            newnodes[i]._interface.inputs.set(**deepcopy(self._interface.inputs.get()))
+            nodename = '_' + self.name + str(i)
+            node = Node(deepcopy(self._interface), name=nodename,
+                        estimated_memory_gb=self.estimated_memory_gb,
+                        num_threads=self.num_threads,
+                        io_bound=self.io_bound,
+                        overwrite=overwrite)
+            node._interface.inputs.set(**deepcopy(self._interface.inputs.get()))
             for field in self.iterfield:
                 fieldvals = filename_to_list(getattr(self.inputs, field))
                 logger.debug('setting input %d %s %s'%(i, field,
-                                                      fieldvals[i])) 
-                setattr(newnodes[i].inputs, field,
-                        fieldvals[i])
-        workflowname = 'mapflow'
-        iterflow = Workflow(name=workflowname)
-        iterflow.base_dir = cwd
-        iterflow.config = self.config
-        iterflow.add_nodes(newnodes)
-        iterflow.run(inseries=True)
+                                                      fieldvals[i]))
+                setattr(node.inputs, field, fieldvals[i])
+            node._hierarchy = 'mapflow'
+            node.config = self.config
+            node._environ_dir = self._environ_dir
+            node.base_dir = os.path.join(cwd, 'mapflow')
+            newnodes.insert(i, node)
+        return newnodes
+
+    def get_subnodes(self):
+        """Prepare the output directory and return the iteration nodes
+
+        This is used by execution plugins that run the iterations
+        themselves. Calling `run` once the iterations have finished collects
+        their results.
+        """
+        outdir = make_output_dir(self._output_directory())
+        _, hashvalue, _, hashed_inputs = self.hash_exists()
+        hashfile_unfinished = os.path.join(outdir,
+                                           '_0x%s_unfinished.json' % hashvalue)
+        if not os.path.exists(hashfile_unfinished):
+            outdir = self._clear_output_directory(outdir)
+        self._save_hashfile(hashfile_unfinished, hashed_inputs)
+        nodes = self._make_nodes(outdir, overwrite=self.overwrite)
+        self._iterations_submitted = True
+        if nodes and not os.path.exists(nodes[0].base_dir):
+            os.makedirs(nodes[0].base_dir)
+        return nodes
+
+    def _collate_results(self, nodes):
+        """Gather the results of the iterations into list valued outputs
+        """
         self._result = InterfaceResult(interface=[], runtime=[],
                                        outputs=self.outputs)
-        for i in range(nitems):
-            node = iterflow.get_exec_node('.'.join((workflowname,
-                                                    nodenames[i])))
-            runtime = Bunch(returncode = 0, environ = deepcopy(os.environ.data), hostname = gethostname())
+        failed = []
+        for i, node in enumerate(nodes):
+            runtime = Bunch(returncode = 0, environ = environ_snapshot(), hostname = gethostname())
             self._result.runtime.insert(i, runtime)
             if node.result and hasattr(node.result, 'runtime'):
                 self._result.runtime[i] = node.result.runtime
                 if node.result.runtime.returncode != 0:
-                    raise Exception('iternode %s:%d did not run'%(node._id, i))
+                    failed.append('%s:%d' % (node._id, i))
                 self._result.interface.insert(i, node.result.interface)
+            elif node.result is None:
+                failed.append('%s:%d' % (node._id, i))
         for key, _ in self.outputs.items():
             values = []
-            for i in range(nitems):
-                node = iterflow.get_exec_node('.'.join((workflowname,
-                                                        nodenames[i])))
-                if node.result.outputs:
+            for i, node in enumerate(nodes):
+                if node.result and node.result.outputs:
                     values.insert(i, node.result.outputs.get()[key])
                 else:
                     values.insert(i, None)
@@ -1168,4 +1308,32 @@ class MapNode(Node):
                 setattr(self._result.outputs, key, values)
             #else:
             #    logger.debug('no values for key %s' %key)
-        os.chdir(old_cwd)
+        if failed:
+            # the outputs of the finished iterations are kept in the result
+            raise Exception('iternodes %s did not run' % ', '.join(failed))
+
+    def _run_interface(self, execute=True, cwd=None):
+        old_cwd = os.getcwd()
+        if not cwd:
+            cwd = self._output_directory()
+        os.chdir(cwd)
+        nodes = self._make_nodes(cwd, overwrite=self._overwrite_iterations)
+        if nodes and not os.path.exists(nodes[0].base_dir):
+            os.makedirs(nodes[0].base_dir)
+        # like the Linear plugin, a failing iteration is reported and the
+        # remaining ones are still run
+        mapflow = nx.DiGraph()
+        mapflow.add_nodes_from(nodes)
+        for node in nodes:
+            try:
+                node.run()
+            except:
+                os.chdir(cwd)
+                if config.getboolean('execution', 'stop_on_first_crash'):
+                    os.chdir(old_cwd)
+                    raise
+                node._report_crash(execgraph=mapflow)
+        try:
+            self._collate_results(nodes)
+        finally:
+            os.chdir(old_cwd)
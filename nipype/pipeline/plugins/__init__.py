@@ -0,0 +1,11 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from nipype.pipeline.plugins.base import (PluginBase, DistributedPluginBase,
+                                          SGELikeBatchManagerBase)
+from nipype.pipeline.plugins.linear import LinearPlugin
+from nipype.pipeline.plugins.ipython import IPythonPlugin
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+from nipype.pipeline.plugins.sge import SGEPlugin
+from nipype.pipeline.plugins.pbs import PBSPlugin
+from nipype.pipeline.plugins.slurm import SLURMPlugin
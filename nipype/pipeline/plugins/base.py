@@ -0,0 +1,835 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Common graph operations for execution
+"""
+
+from copy import deepcopy
+from glob import glob
+import heapq
+import logging
+from multiprocessing import Pool
+import os
+from Queue import Queue, Empty
+import re
+import sys
+from time import time
+from traceback import format_exception
+
+from enthought.traits.trait_handlers import TraitDictObject, TraitListObject
+import numpy as np
+
+from nipype.utils.misc import package_check
+package_check('networkx', '1.0')
+import networkx as nx
+
+from nipype.interfaces.base import CommandLine
+from nipype.utils.filemanip import loadpkl, savepkl
+from nipype.pipeline.utils import _report_nodes_not_run
+
+logger = logging.getLogger('workflow')
+
+def _set_node_input(node, param, source, sourceinfo):
+    """Set inputs of a node given the edge connection"""
+    if isinstance(sourceinfo, str):
+        val = source.get_output(sourceinfo)
+    elif isinstance(sourceinfo, tuple):
+        if callable(sourceinfo[1]):
+            val = sourceinfo[1](source.get_output(sourceinfo[0]),
+                                *sourceinfo[2:])
+    newval = val
+    if isinstance(val, TraitDictObject):
+        newval = dict(val)
+    if isinstance(val, TraitListObject):
+        newval = val[:]
+    logger.debug('setting node input: %s->%s', param, str(newval))
+    node.set_input(param, deepcopy(newval))
+
+def run_node(node, updatehash=False):
+    """Execute a node and capture the traceback of any failure
+
+    This is the unit of work shipped to external workers. It returns a
+    dictionary with the `result` of the node and, if the node crashed, the
+    formatted `traceback`.
+    """
+    result = dict(result=None, traceback=None)
+    try:
+        result['result'] = node.run(updatehash=updatehash)
+    except:
+        etype, eval, etr = sys.exc_info()
+        result['traceback'] = format_exception(etype, eval, etr)
+        result['result'] = node.result
+    return result
+
+def _get_runtime(node):
+    """Return the duration of the last run of a node or None if unknown
+
+    The duration is read from the result file in the output directory of
+    the node. For MapNodes the durations of the iterations are summed.
+    """
+    try:
+        outdir = node._output_directory()
+    except AttributeError:
+        return None
+    resultsfiles = [os.path.join(outdir, 'result_%s.pklz' % node._id)]
+    if not os.path.exists(resultsfiles[0]):
+        # the iterations of a MapNode store their results
+        resultsfiles = glob(os.path.join(outdir, 'mapflow', '*',
+                                         'result_*.pklz'))
+        if not resultsfiles:
+            return None
+    runtime = []
+    try:
+        for resultsfile in resultsfiles:
+            rt = loadpkl(resultsfile).runtime
+            if isinstance(rt, list):
+                runtime.extend(rt)
+            else:
+                runtime.append(rt)
+    except Exception:
+        return None
+    durations = [getattr(rt, 'duration', None) for rt in runtime]
+    if None in durations:
+        return None
+    return sum(durations)
+
+def _output_size_gb(result):
+    """Return the size of the existing files among the outputs of a result
+    """
+    if result is None or result.outputs is None:
+        return 0
+    files = set()
+    values = result.outputs.get().values()
+    while values:
+        value = values.pop()
+        if isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, basestring) and os.path.isfile(value):
+            files.add(os.path.realpath(value))
+    return sum([os.path.getsize(fname) for fname in files]) / 1024. ** 3
+
+class ReadyQueue(object):
+    """Queue of ready jobs that pops the job with the highest priority first
+
+    Jobs with equal priority are returned in the order they were added.
+    Without priorities the queue is first-in first-out.
+    """
+
+    def __init__(self, jobids=[], priority=None):
+        self.priority = priority
+        self._heap = []
+        self._count = 0
+        self.extend(jobids)
+
+    def append(self, jobid):
+        key = 0
+        if self.priority is not None:
+            key = -self.priority[jobid]
+        heapq.heappush(self._heap, (key, self._count, jobid))
+        self._count += 1
+
+    def extend(self, jobids):
+        for jobid in jobids:
+            self.append(jobid)
+
+    def popleft(self):
+        return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return iter([item[2] for item in sorted(self._heap)])
+
+class PluginBase(object):
+    """Base class for plugins"""
+
+    def __init__(self, plugin_args=None):
+        if plugin_args is None:
+            plugin_args = {}
+        self.plugin_args = plugin_args
+
+    def run(self, graph, updatehash=False):
+        """Execute all the nodes of an execution graph
+
+        Parameters
+        ----------
+        graph : networkx DiGraph
+            expanded execution graph whose nodes have their output
+            directories set
+        updatehash : boolean
+            update the hashes of the nodes without executing them
+        """
+        raise NotImplementedError
+
+class DistributedPluginBase(PluginBase):
+    """Execute workflow with a distribution engine
+
+    Keeps track of the dependency structure of the execution graph and
+    submits every job whose dependencies have finished. Derived classes
+    implement `_submit_job` and `_get_result` for a particular engine and
+    call `_task_done` whenever a submitted task finishes.
+
+    Ready jobs are only submitted while their `estimated_memory_gb` and
+    `num_threads` fit into the budget given by the plugin_args:
+
+    - memory_gb : memory available to the running jobs (default: unlimited)
+    - n_procs : threads available to the running jobs (default: unlimited)
+
+    A job that exceeds the whole budget is run once nothing else is running.
+
+    The order in which ready jobs are submitted is set by the `priority`
+    plugin argument:
+
+    - 'critical_path' (default) : jobs with the longest chain of dependent
+      jobs first
+    - 'runtime' : like 'critical_path', but weighs every job by the duration
+      recorded in the result file of a previous run
+    - 'fifo' : in the order in which the jobs became ready
+
+    Nodes with `run_without_submitting` set are run by the scheduler itself
+    as soon as they are ready. The iterations of a MapNode are submitted as
+    separate jobs; once they have finished the MapNode collects their
+    results in the scheduling process.
+
+    Nodes with `io_bound` set, i.e., the data sources, can be run on a
+    separate pool of processes outside of the resource budget, so that the
+    inputs of the next subjects are fetched while the compute jobs of the
+    current ones run:
+
+    - prefetch_depth : number of data sources fetching at the same time
+      (default: 0, data sources are submitted like any other job)
+    - prefetch_disk_gb : size of the fetched files whose dependents have not
+      finished yet above which no further data sources are started
+      (default: unlimited)
+    """
+
+    # seconds to wait for a notification before checking the pending tasks;
+    # also keeps the wait interruptible
+    _check_interval = 60
+
+    def __init__(self, plugin_args=None):
+        """Initialize runtime attributes to none
+
+        procs: list (N) of underlying interface elements to be processed
+        proc_done: a boolean vector (N) signifying whether a process has been
+            executed
+        proc_pending: a boolean vector (N) signifying whether a
+            process is currently running. Note: A process is finished only when
+            both proc_done==True and proc_pending==False
+        depcount: an integer vector (N) storing the number of unfinished
+            dependencies of each process
+        children: a list (N) of the indices of the processes that depend on
+            each process
+        readytorun: a queue of indices of processes whose dependencies have
+            finished and which have not been submitted yet
+        priority: a float vector (N) with the length of the longest path of
+            dependent processes starting at each process
+        """
+        super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
+        self.procs = None
+        self.depcount = None
+        self.children = None
+        self.readytorun = None
+        self.priority = None
+        self.proc_done = None
+        self.proc_pending = None
+        self.max_memory_gb = self.plugin_args.get('memory_gb', None)
+        self.max_threads = self.plugin_args.get('n_procs', None)
+        self.prefetch_depth = self.plugin_args.get('prefetch_depth', 0)
+        self.prefetch_disk_gb = self.plugin_args.get('prefetch_disk_gb', None)
+        self._io_pool = None
+
+    def run(self, graph, updatehash=False):
+        """Executes a pre-defined pipeline using distributed approaches
+
+        Jobs are submitted as soon as their dependencies have finished.
+        Engines report finished tasks through `_task_done`, which wakes up
+        the scheduler. Engines without a completion notification (IPython,
+        the batch schedulers) still poll for finished tasks and call
+        `_task_done` for them.
+        """
+        logger.info("Running in parallel.")
+        # Generate appropriate structures for worker-manager model
+        self._generate_dependency_list(graph)
+        self.pending_tasks = {}
+        self._completed = Queue()
+        self._notrun = []
+        self._io_results = {}
+        self._prefetched = {}
+        try:
+            self._send_procs_to_workers(graph, updatehash=updatehash)
+            while self.pending_tasks:
+                taskid = self._wait_for_task()
+                jobid = self.pending_tasks.pop(taskid)
+                io_task = taskid in self._io_results
+                if not io_task:
+                    self._release_resources(jobid)
+                try:
+                    if io_task:
+                        result = self._io_results.pop(taskid).get()
+                    else:
+                        result = self._get_result(taskid)
+                except:
+                    self._notrun.append(self._clean_queue(jobid, graph))
+                else:
+                    if io_task:
+                        self._prefetched[jobid] = \
+                            _output_size_gb(result['result'])
+                    self._process_result(jobid, graph, result)
+                self._send_procs_to_workers(graph, updatehash=updatehash)
+        finally:
+            if self._io_pool is not None:
+                self._io_pool.close()
+                self._io_pool.join()
+                self._io_pool = None
+        _report_nodes_not_run(self._notrun)
+
+    def _process_result(self, jobid, graph, result):
+        """Pass the result of a finished job to its dependents or report the
+        crash
+        """
+        try:
+            if result['traceback']:
+                self._notrun.append(self._clean_queue(jobid, graph,
+                                                      result=result))
+            else:
+                self._task_finished_cb(jobid, graph, result['result'])
+        except:
+            self._notrun.append(self._clean_queue(jobid, graph))
+
+    def _task_done(self, taskid):
+        """Notify the scheduler that a task has finished
+
+        May be called from any thread.
+        """
+        self._completed.put(taskid)
+
+    def _wait_for_task(self):
+        """Block until an engine reports a finished task and return its id
+        """
+        while True:
+            try:
+                return self._completed.get(True, self._check_interval)
+            except Empty:
+                self._check_pending_tasks()
+                self._check_io_tasks()
+
+    def _check_pending_tasks(self):
+        """Report tasks that finished without notifying the scheduler
+
+        Called when no task has finished for a while. Engines that can lose
+        a completion notification should call `_task_done` for such tasks.
+        """
+        pass
+
+    def _check_io_tasks(self):
+        # the pool does not invoke the callback when a task fails outside of
+        # run_node, e.g., when the node cannot be pickled
+        for taskid, taskresult in self._io_results.items():
+            if taskresult.ready() and not taskresult.successful():
+                self._task_done(taskid)
+
+    def _get_result(self, taskid):
+        """Return a dictionary containing the `result` and `traceback` of a
+        finished task.
+        """
+        raise NotImplementedError
+
+    def _submit_job(self, node, updatehash=False):
+        """Submit a node to the engine and return a task id
+        """
+        raise NotImplementedError
+
+    def _clean_queue(self, jobid, graph, result=None):
+        """Report the crash of a job and remove its dependents from the queue
+        """
+        if result:
+            self.procs[jobid]._result = result['result']
+            crashfile = self.procs[jobid]._report_crash(
+                traceback=result['traceback'], execgraph=graph)
+        else:
+            crashfile = self.procs[jobid]._report_crash(execgraph=graph)
+        if jobid in self._parents:
+            # a failed iteration stops the MapNode and its dependents
+            info = self._remove_node_deps(self._parents[jobid], crashfile,
+                                          graph)
+            info['node'] = self.procs[jobid]
+            return info
+        # remove dependencies from queue
+        return self._remove_node_deps(jobid, crashfile, graph)
+
+    def _send_procs_to_workers(self, graph, updatehash=False):
+        """ Sends jobs to workers
+        """
+        if self.readytorun:
+            logger.info('Submitting %d jobs' % len(self.readytorun))
+        deferred = []
+        while self.readytorun:
+            jobid = self.readytorun.popleft()
+            if self.proc_done[jobid]:
+                # removed from the queue after a crash
+                continue
+            if jobid in self._expanded or \
+                    getattr(self.procs[jobid], 'run_without_submitting', False):
+                self._run_locally(jobid, graph, updatehash=updatehash)
+                continue
+            if self._expand_mapnode(jobid, updatehash=updatehash):
+                continue
+            if self.prefetch_depth and \
+                    getattr(self.procs[jobid], 'io_bound', False):
+                if not self._submit_io_job(jobid, updatehash=updatehash):
+                    deferred.append(jobid)
+                continue
+            if not self._claim_resources(jobid):
+                deferred.append(jobid)
+                continue
+            # change job status in appropriate queues
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+            _, hashvalue = self.procs[jobid]._get_hashval()
+            logger.info('Executing: %s ID: %d H:%s' % \
+                            (self.procs[jobid]._id, jobid, hashvalue))
+            # Send job to task manager and add to pending tasks
+            tid = self._submit_job(self.procs[jobid], updatehash=updatehash)
+            self.pending_tasks[tid] = jobid
+        if deferred:
+            logger.debug('Waiting for resources: %d jobs' % len(deferred))
+            self.readytorun.extend(deferred)
+
+    def _run_locally(self, jobid, graph, updatehash=False):
+        """Run a job in the scheduling process
+
+        Dependents that become ready are appended to the ready queue.
+        """
+        self.proc_done[jobid] = True
+        self.proc_pending[jobid] = True
+        logger.info('Executing locally: %s ID: %d' % \
+                        (self.procs[jobid]._id, jobid))
+        result = run_node(self.procs[jobid], updatehash=updatehash)
+        self._process_result(jobid, graph, result)
+
+    def _submit_io_job(self, jobid, updatehash=False):
+        """Run a data source on the prefetch pool
+
+        Returns False if all processes of the pool are busy or the fetched
+        files exceed the disk budget.
+        """
+        if len(self._io_results) >= self.prefetch_depth:
+            return False
+        if self.prefetch_disk_gb is not None and self.pending_tasks and \
+                self._prefetched_gb() >= self.prefetch_disk_gb:
+            return False
+        if self._io_pool is None:
+            self._io_pool = Pool(processes=self.prefetch_depth)
+        self.proc_done[jobid] = True
+        self.proc_pending[jobid] = True
+        logger.info('Fetching: %s ID: %d' % (self.procs[jobid]._id, jobid))
+        # keep the ids apart from the task ids of the engine
+        taskid = ('prefetch', jobid)
+        self._io_results[taskid] = self._io_pool.apply_async(
+            run_node, (self.procs[jobid], updatehash),
+            callback=lambda result: self._task_done(taskid))
+        self.pending_tasks[taskid] = jobid
+        return True
+
+    def _prefetched_gb(self):
+        """Return the size of the fetched files that are still needed
+
+        The files of a data source count until all of its dependents have
+        finished.
+        """
+        for jobid in self._prefetched.keys():
+            if all([self.proc_done[child] and not self.proc_pending[child] \
+                        for child in self.children[jobid]]):
+                del self._prefetched[jobid]
+        return sum(self._prefetched.values())
+
+    def _should_expand(self, node):
+        """Whether the iterations of a MapNode need to be run as jobs
+        """
+        return hasattr(node, 'get_subnodes') and \
+            (node.overwrite or not node.hash_exists()[0])
+
+    def _expand_mapnode(self, jobid, updatehash=False):
+        """Add the iterations of a MapNode to the ready queue
+
+        The iterations become jobs of their own on which the MapNode
+        depends. Returns False if the node is not expanded.
+        """
+        node = self.procs[jobid]
+        if updatehash or not self._should_expand(node):
+            return False
+        subnodes = node.get_subnodes()
+        if not subnodes:
+            return False
+        logger.info('Expanding %s into %d jobs' % (node._id, len(subnodes)))
+        for subnode in subnodes:
+            if not subnode.overwrite and subnode.hash_exists()[0]:
+                # only collect the results of unchanged iterations
+                subnode.run_without_submitting = True
+        subids = range(len(self.procs), len(self.procs) + len(subnodes))
+        self.procs.extend(subnodes)
+        for subid, subnode in zip(subids, subnodes):
+            self._jobids[subnode] = subid
+            self._parents[subid] = jobid
+            self.children.append([jobid])
+        self.depcount = np.append(self.depcount,
+                                  np.zeros(len(subnodes), dtype=int))
+        self.depcount[jobid] = len(subnodes)
+        self.proc_done = np.append(self.proc_done,
+                                   np.zeros(len(subnodes), dtype=bool))
+        self.proc_pending = np.append(self.proc_pending,
+                                      np.zeros(len(subnodes), dtype=bool))
+        if self.priority is not None:
+            self.priority = np.append(self.priority,
+                                      [self.priority[jobid]] * len(subnodes))
+            self.readytorun.priority = self.priority
+        self._expanded.add(jobid)
+        self.readytorun.extend(subids)
+        return True
+
+    def _job_resources(self, jobid):
+        """Return the estimated memory (GB) and number of threads of a job
+        """
+        node = self.procs[jobid]
+        return (getattr(node, 'estimated_memory_gb', 0),
+                getattr(node, 'num_threads', 1))
+
+    def _claim_resources(self, jobid):
+        """Reserve the resources of a job if they fit into the free budget
+        """
+        memory_gb, threads = self._job_resources(jobid)
+        fits = True
+        if self.max_memory_gb is not None and \
+                self.used_memory_gb + memory_gb > self.max_memory_gb:
+            fits = False
+        if self.max_threads is not None and \
+                self.used_threads + threads > self.max_threads:
+            fits = False
+        if not fits:
+            # the prefetch pool is outside of the budget, so an oversized
+            # job only waits for the compute jobs
+            if [taskid for taskid in self.pending_tasks \
+                    if taskid not in self._io_results]:
+                return False
+            logger.warn('%s requires %.2f GB and %d threads, which exceeds '
+                        'the available resources. Running it alone.' % \
+                            (self.procs[jobid]._id, memory_gb, threads))
+        self.used_memory_gb += memory_gb
+        self.used_threads += threads
+        return True
+
+    def _release_resources(self, jobid):
+        memory_gb, threads = self._job_resources(jobid)
+        self.used_memory_gb -= memory_gb
+        self.used_threads -= threads
+
+    def _task_finished_cb(self, jobid, graph, result):
+        """ Extract outputs and assign to inputs of dependent tasks
+
+        This is called when a job is completed.
+        """
+        logger.info('[Job finished] jobname: %s jobid: %d' % \
+                        (self.procs[jobid]._id, jobid))
+        # Update job and worker queues
+        self.proc_pending[jobid] = False
+        if self.procs[jobid]._result != result:
+            self.procs[jobid]._result = result
+        # Update the inputs of all tasks that depend on this job's outputs
+        # (MapNode iterations are not part of the graph)
+        if jobid not in self._parents:
+            for edge in graph.out_edges_iter(self.procs[jobid]):
+                data = graph.get_edge_data(*edge)
+                for sourceinfo, destname in data['connect']:
+                    logger.debug('%s %s %s %s', edge[1], destname,
+                                 self.procs[jobid], sourceinfo)
+                    _set_node_input(edge[1], destname,
+                                    self.procs[jobid], sourceinfo)
+        # update the job dependency structure
+        for childid in self.children[jobid]:
+            self.depcount[childid] -= 1
+            if self.depcount[childid] == 0:
+                self.readytorun.append(childid)
+
+    def _generate_dependency_list(self, graph):
+        """ Generates a dependency list for a list of graphs.
+
+        Only the number of unfinished dependencies of each job is stored, so
+        that the cost of scheduling is proportional to the number of edges
+        leaving a finished job.
+        """
+        self.procs = graph.nodes()
+        self._jobids = dict([(node, jobid) for jobid, node in \
+                                 enumerate(self.procs)])
+        self.depcount = np.array([graph.in_degree(node) \
+                                      for node in self.procs], dtype=int)
+        self.children = [[self._jobids[child] \
+                              for child in graph.successors(node)] \
+                             for node in self.procs]
+        self.priority = self._compute_priority(graph)
+        self.readytorun = ReadyQueue(np.flatnonzero(self.depcount == 0),
+                                     priority=self.priority)
+        self.proc_done = np.zeros(len(self.procs), dtype=bool)
+        self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self.used_memory_gb = 0
+        self.used_threads = 0
+        self._parents = {}
+        self._expanded = set()
+
+    def _compute_priority(self, graph):
+        """Return the critical path priority of every job or None for fifo
+        """
+        policy = self.plugin_args.get('priority', 'critical_path')
+        if policy == 'fifo':
+            return None
+        if policy not in ['critical_path', 'runtime']:
+            raise ValueError('Unknown priority policy: %s' % policy)
+        weight = np.ones(len(self.procs))
+        if policy == 'runtime':
+            runtimes = [_get_runtime(node) for node in self.procs]
+            known = [runtime for runtime in runtimes if runtime is not None]
+            if known:
+                # jobs without a recorded run count as an average job
+                weight[:] = np.mean(known)
+                for jobid, runtime in enumerate(runtimes):
+                    if runtime is not None:
+                        weight[jobid] = runtime
+        priority = np.zeros(len(self.procs))
+        for node in reversed(nx.topological_sort(graph)):
+            jobid = self._jobids[node]
+            priority[jobid] = weight[jobid]
+            if self.children[jobid]:
+                priority[jobid] += priority[self.children[jobid]].max()
+        return priority
+
+    def _remove_node_deps(self, jobid, crashfile, graph):
+        subnodes = nx.dfs_preorder(graph, self.procs[jobid])
+        for node in subnodes:
+            idx = self._jobids[node]
+            self.proc_done[idx] = True
+            self.proc_pending[idx] = False
+        return dict(node = self.procs[jobid],
+                    dependents = subnodes,
+                    crashfile = crashfile)
+
+class SGELikeBatchManagerBase(DistributedPluginBase):
+    """Execute workflow with SGE/PBS/SLURM like batch systems
+
+    Every ready node is pickled into a batch directory next to its output
+    directory and submitted as a job that runs a small python script. The
+    script stores the result and traceback of the node in
+    `result_<id>.pklz`. The state of the submitted jobs is queried every
+    `poll_sleep_duration` seconds.
+
+    The plugin_args input to run can be used to control the batch
+    execution. Currently supported options are:
+
+    - template : job script preamble (a string or the name of a file)
+    - qsub_args : additional arguments to the submission command
+    - poll_sleep_duration : seconds between job status queries (default: 2)
+    - use_arrays : submit the iterations of a MapNode as a single job array
+      (default: True)
+    - result_timeout : seconds to wait for the result file of a job that
+      has left the queue, e.g., until it is visible on a network file
+      system, before the job is considered crashed (default: 30)
+    - submit_cmd, status_cmd : replace the submission and status commands,
+      e.g., by wrapper scripts
+
+    Derived classes set the scheduler specific attributes.
+    """
+
+    _submit_cmd = None
+    _status_cmd = None
+    _default_template = '#!/bin/sh'
+    _array_index_var = None
+    _array_start = 1
+
+    def __init__(self, plugin_args=None):
+        super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
+        template = self.plugin_args.get('template', self._default_template)
+        if os.path.isfile(template):
+            template = open(template).read()
+        if not template.startswith('#!'):
+            template = '\n'.join(('#!/bin/sh', template))
+        self._template = template
+        self._qsub_args = self.plugin_args.get('qsub_args', '')
+        self._submit_cmd = self.plugin_args.get('submit_cmd', self._submit_cmd)
+        self._status_cmd = self.plugin_args.get('status_cmd', self._status_cmd)
+        self._use_arrays = self.plugin_args.get('use_arrays', True)
+        self._check_interval = self.plugin_args.get('poll_sleep_duration', 2)
+        self._result_timeout = self.plugin_args.get('result_timeout', 30)
+        self._taskinfo = {}
+
+    def _should_expand(self, node):
+        # job arrays are submitted by _submit_job
+        if self._use_arrays:
+            return False
+        return super(SGELikeBatchManagerBase, self)._should_expand(node)
+
+    def _submit_job(self, node, updatehash=False):
+        # like _expand_mapnode, the hashes of MapNodes are updated by the
+        # MapNode itself
+        if self._use_arrays and not updatehash and \
+                hasattr(node, 'get_subnodes') and \
+                (node.overwrite or not node.hash_exists()[0]):
+            # the results of unchanged iterations are collected by the
+            # MapNode
+            subnodes = [subnode for subnode in node.get_subnodes() \
+                            if subnode.overwrite or \
+                            not subnode.hash_exists()[0]]
+            if subnodes:
+                return self._submit_array(node, subnodes, updatehash)
+        pyscript, resultsfile = self._create_pyscript(node, updatehash)
+        batchscript = self._create_batchscript(node, 'python %s' % pyscript)
+        taskid = self._submit_batchjob(batchscript, node)
+        self._taskinfo[taskid] = dict(node=node, results=[resultsfile])
+        return taskid
+
+    def _submit_array(self, node, subnodes, updatehash=False):
+        """Submit the iterations of a MapNode as a job array"""
+        batch_dir = self._batch_dir(node)
+        results = []
+        for index, subnode in enumerate(subnodes):
+            name = '%s_%d' % (node._id, index + self._array_start)
+            _, resultsfile = self._create_pyscript(subnode, updatehash,
+                                                   name=name,
+                                                   batch_dir=batch_dir)
+            results.append(resultsfile)
+        pyscript = os.path.join(batch_dir, 'pyscript_%s_$%s.py' % \
+                                    (node._id, self._array_index_var))
+        batchscript = self._create_batchscript(node, 'python %s' % pyscript)
+        taskid = self._submit_batchjob(batchscript, node,
+                                       narray=len(subnodes))
+        self._taskinfo[taskid] = dict(node=node, results=results,
+                                      array=True)
+        return taskid
+
+    def _batch_dir(self, node):
+        batch_dir = os.path.join(node.base_dir, 'batch')
+        if not os.path.exists(batch_dir):
+            os.makedirs(batch_dir)
+        return batch_dir
+
+    def _create_pyscript(self, node, updatehash=False, name=None,
+                         batch_dir=None):
+        """Pickle the node and write the script that executes it"""
+        if batch_dir is None:
+            batch_dir = self._batch_dir(node)
+        if name is None:
+            name = node._id
+        pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % name)
+        savepkl(pkl_file, node)
+        resultsfile = os.path.join(batch_dir, 'result_%s.pklz' % name)
+        cmdstr = """import os
+import sys
+from socket import gethostname
+from traceback import format_exception
+from nipype.utils.filemanip import loadpkl, savepkl
+traceback = None
+result = None
+node = None
+try:
+    node = loadpkl('%s')
+    result = node.run(updatehash=%s)
+except:
+    etype, eval, etr = sys.exc_info()
+    traceback = format_exception(etype, eval, etr)
+    if node:
+        result = node.result
+resultsfile = '%s'
+tmpfile = resultsfile.replace('.pklz', '_tmp.pklz')
+savepkl(tmpfile, dict(result=result, traceback=traceback,
+                      hostname=gethostname()))
+os.rename(tmpfile, resultsfile)
+""" % (pkl_file, updatehash, resultsfile)
+        pyscript = os.path.join(batch_dir, 'pyscript_%s.py' % name)
+        fp = open(pyscript, 'wt')
+        fp.writelines(cmdstr)
+        fp.close()
+        if os.path.exists(resultsfile):
+            os.remove(resultsfile)
+        return pyscript, resultsfile
+
+    def _create_batchscript(self, node, cmd):
+        batch_dir = self._batch_dir(node)
+        batchscript = os.path.join(batch_dir, 'batchscript_%s.sh' % node._id)
+        fp = open(batchscript, 'wt')
+        fp.writelines('\n'.join((self._template,
+                                 'cd %s' % batch_dir,
+                                 cmd.replace('python', sys.executable, 1),
+                                 '')))
+        fp.close()
+        return batchscript
+
+    def _submit_args(self, node, batch_dir, narray=None):
+        """Return the arguments of the submission command"""
+        raise NotImplementedError
+
+    def _submit_batchjob(self, batchscript, node, narray=None):
+        batch_dir = os.path.dirname(batchscript)
+        args = ' '.join((self._qsub_args,
+                         self._submit_args(node, batch_dir, narray=narray),
+                         batchscript))
+        cmd = CommandLine(self._submit_cmd, args=args.strip())
+        result = cmd.run()
+        if result.runtime.returncode:
+            raise RuntimeError('Could not submit %s: %s' % \
+                                   (node._id, result.runtime.stderr))
+        taskid = self._parse_jobid(result.runtime.stdout)
+        logger.info('submitted %s as job %s' % (node._id, taskid))
+        return taskid
+
+    def _parse_jobid(self, output):
+        """Extract the scheduler job id from the output of the submission"""
+        match = re.search('(\d+)', output)
+        if not match:
+            raise RuntimeError('Could not parse job id from: %s' % output)
+        return match.groups()[0]
+
+    def _get_running_jobs(self):
+        """Return the ids of the jobs known to the scheduler"""
+        result = CommandLine(self._status_cmd).run()
+        jobids = set()
+        for line in result.runtime.stdout.split('\n'):
+            match = re.match('\s*(\d+)', line)
+            if match:
+                jobids.add(match.groups()[0])
+        return jobids
+
+    def _check_pending_tasks(self):
+        running = self._get_running_jobs()
+        for taskid, info in self._taskinfo.items():
+            if info.get('done'):
+                continue
+            finished = all([os.path.exists(resultsfile) for resultsfile in \
+                                info['results']])
+            if not finished and taskid not in running:
+                # the result files of a job that has just left the queue
+                # may not be visible yet
+                info.setdefault('left_queue', time())
+                finished = time() - info['left_queue'] >= \
+                    self._result_timeout
+            if finished:
+                info['done'] = True
+                self._task_done(taskid)
+
+    def _get_result(self, taskid):
+        info = self._taskinfo.pop(taskid)
+        results = []
+        for resultsfile in info['results']:
+            if not os.path.exists(resultsfile):
+                msg = 'Job %s of node %s finished without writing %s. ' \
+                    'Check the job output in %s.' % \
+                    (taskid, info['node']._id, resultsfile,
+                     os.path.dirname(resultsfile))
+                return dict(result=None, traceback=[msg])
+            results.append(loadpkl(resultsfile))
+        if not info.get('array'):
+            return results[0]
+        for result in results:
+            if result['traceback']:
+                return result
+        # collect the results of the iterations
+        return run_node(info['node'])
@@ -0,0 +1,108 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via IPython controller
+"""
+import sys
+from threading import Event, Lock, Thread
+from traceback import format_exception
+
+from nipype.pipeline.plugins.base import DistributedPluginBase, logger
+
+class IPythonPlugin(DistributedPluginBase):
+    """Execute workflow with ipython's TaskClient interface
+
+    The TaskClient has no completion callback, so a single watcher thread
+    polls the submitted tasks every `poll_sleep_duration` seconds
+    (plugin_args, default: 0.5) and notifies the scheduler of the finished
+    ones.
+    """
+
+    def __init__(self, plugin_args=None):
+        super(IPythonPlugin, self).__init__(plugin_args=plugin_args)
+        self.ipyclient = None
+        self.taskclient = None
+        self._taskresult = {}
+        self._poll_interval = self.plugin_args.get('poll_sleep_duration', 0.5)
+        self._outstanding = set()
+        self._outstanding_lock = Lock()
+        try:
+            name = 'IPython.kernel.client'
+            __import__(name)
+            self.ipyclient = sys.modules[name]
+        except ImportError:
+            raise ImportError("Ipython kernel not found. Parallel execution " \
+                                  "will be unavailable")
+        try:
+            self.taskclient = self.ipyclient.TaskClient()
+        except Exception, e:
+            if isinstance(e, ValueError):
+                raise Exception("Ipython kernel not installed")
+            raise
+
+    def run(self, graph, updatehash=False):
+        self._outstanding = set()
+        stop = Event()
+        watcher = Thread(target=self._watch_tasks, args=(stop,))
+        watcher.setDaemon(True)
+        watcher.start()
+        try:
+            super(IPythonPlugin, self).run(graph, updatehash=updatehash)
+        finally:
+            stop.set()
+            watcher.join()
+
+    def _get_result(self, taskid):
+        return self._taskresult.pop(taskid)
+
+    def _watch_tasks(self, stop):
+        """Poll the outstanding tasks and notify the scheduler of the
+        finished ones
+        """
+        while not stop.isSet():
+            self._outstanding_lock.acquire()
+            try:
+                taskids = list(self._outstanding)
+            finally:
+                self._outstanding_lock.release()
+            for taskid in taskids:
+                try:
+                    result = self.taskclient.get_task_result(taskid,
+                                                             block=False)
+                    if result is None:
+                        continue
+                except:
+                    etype, eval, etr = sys.exc_info()
+                    result = dict(result=None,
+                                  traceback=format_exception(etype, eval,
+                                                             etr))
+                self._outstanding_lock.acquire()
+                try:
+                    self._outstanding.discard(taskid)
+                finally:
+                    self._outstanding_lock.release()
+                self._taskresult[taskid] = result
+                self._task_done(taskid)
+            stop.wait(self._poll_interval)
+
+    def _submit_job(self, node, updatehash=False):
+        cmdstr = """import sys
+from traceback import format_exception
+traceback=None
+try:
+    result = task.run(updatehash=updatehash)
+except:
+    etype, eval, etr = sys.exc_info()
+    traceback = format_exception(etype,eval,etr)
+    result = task.result
+"""
+        task = self.ipyclient.StringTask(cmdstr,
+                                         push = dict(task=node,
+                                                     updatehash=updatehash),
+                                         pull = ['result','traceback'])
+        taskid = self.taskclient.run(task, block = False)
+        self._outstanding_lock.acquire()
+        try:
+            self._outstanding.add(taskid)
+        finally:
+            self._outstanding_lock.release()
+        return taskid
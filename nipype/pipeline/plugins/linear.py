@@ -0,0 +1,66 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Local serial workflow execution
+"""
+import os
+
+from nipype.utils.misc import package_check
+package_check('networkx', '1.0')
+import networkx as nx
+
+from nipype.utils.config import config
+from nipype.pipeline.utils import _report_nodes_not_run
+from nipype.pipeline.plugins.base import (PluginBase, logger,
+                                          _set_node_input)
+
+class LinearPlugin(PluginBase):
+    """Execute workflow in series
+    """
+
+    def run(self, graph, updatehash=False):
+        """Executes a pre-defined pipeline in a serial order.
+
+        Parameters
+        ----------
+        graph : networkx digraph
+            defines order of execution
+        updatehash : boolean
+            Allows one to rerun a pipeline and update all the hashes without
+            actually executing any of the underlying interfaces. This is useful
+            when moving the working directory from one location to another. It
+            is also useful when the hashing function itself changes (although
+            we hope that this will not happen often). default [False]
+        """
+        logger.info("Running serially.")
+        old_wd = os.getcwd()
+        notrun = []
+        donotrun = []
+        for node in nx.topological_sort(graph):
+            # Assign outputs from dependent executed nodes to current node.
+            # The dependencies are stored as data on edges connecting
+            # nodes.
+            try:
+                if node in donotrun:
+                    continue
+                for edge in graph.in_edges_iter(node):
+                    data = graph.get_edge_data(*edge)
+                    logger.debug('setting input: %s->%s %s',
+                                 edge[0], edge[1], str(data))
+                    for sourceinfo, destname in data['connect']:
+                        _set_node_input(node, destname,
+                                        edge[0], sourceinfo)
+                node.run(updatehash=updatehash)
+            except:
+                os.chdir(old_wd)
+                if config.getboolean('execution', 'stop_on_first_crash'):
+                    raise
+                # bare except, but i really don't know where a
+                # node might fail
+                crashfile = node._report_crash(execgraph=graph)
+                # remove dependencies from queue
+                subnodes = nx.dfs_preorder(graph, node)
+                notrun.append(dict(node = node,
+                                   dependents = subnodes,
+                                   crashfile = crashfile))
+                donotrun.extend(subnodes)
+        _report_nodes_not_run(notrun)
@@ -0,0 +1,82 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via multiprocessing
+"""
+
+from multiprocessing import Pool, cpu_count
+import os
+
+from nipype.pipeline.plugins.base import (DistributedPluginBase, logger,
+                                          run_node)
+
+def _system_memory_gb():
+    """Return the physical memory of the machine in GB or None if unknown
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / \
+            1024. ** 3
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class MultiProcPlugin(DistributedPluginBase):
+    """Execute workflow with multiprocessing
+
+    The plugin_args input to run can be used to control the multiprocessing
+    execution. Currently supported options are:
+
+    - n_procs : number of processes to use (default: number of cpus). Nodes
+      with `num_threads` > 1 occupy several of them.
+    - memory_gb : memory available to the running nodes (default: physical
+      memory of the machine)
+
+    Examples
+    --------
+
+    >>> workflow.run(plugin='MultiProc', plugin_args={'n_procs': 8}) # doctest: +SKIP
+    >>> workflow.run(plugin='MultiProc',
+    ...              plugin_args={'n_procs': 8, 'memory_gb': 16}) # doctest: +SKIP
+
+    """
+
+    def __init__(self, plugin_args=None):
+        super(MultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        self._taskresult = {}
+        self._taskid = 0
+        self._n_procs = self.plugin_args.get('n_procs', cpu_count())
+        self.max_threads = self._n_procs
+        if self.max_memory_gb is None:
+            self.max_memory_gb = _system_memory_gb()
+        self.pool = None
+
+    def run(self, graph, updatehash=False):
+        # every run has its own pool, so that the plugin can be reused
+        logger.debug('Starting multiprocessing pool with %d processes' % \
+                         self._n_procs)
+        self.pool = Pool(processes=self._n_procs)
+        try:
+            super(MultiProcPlugin, self).run(graph, updatehash=updatehash)
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _get_result(self, taskid):
+        if taskid not in self._taskresult:
+            raise RuntimeError('Multiproc task %d not found' % taskid)
+        return self._taskresult.pop(taskid).get()
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        taskid = self._taskid
+        callback = lambda result: self._task_done(taskid)
+        self._taskresult[taskid] = self.pool.apply_async(run_node,
+                                                         (node, updatehash,),
+                                                         callback=callback)
+        return taskid
+
+    def _check_pending_tasks(self):
+        # the pool does not invoke the callback when a task fails outside of
+        # run_node, e.g., when the node cannot be pickled
+        for taskid, taskresult in self._taskresult.items():
+            if taskresult.ready() and not taskresult.successful():
+                self._task_done(taskid)
@@ -0,0 +1,33 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via PBS/Torque
+"""
+
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+
+class PBSPlugin(SGELikeBatchManagerBase):
+    """Execute workflow with PBS/Torque
+
+    The plugin_args input to run can be used to control the PBS execution.
+    See SGELikeBatchManagerBase for the supported options. Job arrays use
+    the Torque syntax.
+
+    Examples
+    --------
+
+    >>> workflow.run(plugin='PBS', plugin_args={'qsub_args': '-q many'}) # doctest: +SKIP
+
+    """
+
+    _submit_cmd = 'qsub'
+    _status_cmd = 'qstat'
+    _default_template = '#PBS -V'
+    _array_index_var = 'PBS_ARRAYID'
+    _array_start = 0
+
+    def _submit_args(self, node, batch_dir, narray=None):
+        # PBS job names are limited to 15 characters
+        args = '-N %s -o %s -e %s' % (node._id[:15], batch_dir, batch_dir)
+        if narray:
+            args = '-t 0-%d %s' % (narray - 1, args)
+        return args
@@ -0,0 +1,31 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via SGE
+"""
+
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+
+class SGEPlugin(SGELikeBatchManagerBase):
+    """Execute workflow with SGE (OGE/Univa Grid Engine)
+
+    The plugin_args input to run can be used to control the SGE execution.
+    See SGELikeBatchManagerBase for the supported options.
+
+    Examples
+    --------
+
+    >>> workflow.run(plugin='SGE', plugin_args={'qsub_args': '-q many'}) # doctest: +SKIP
+
+    """
+
+    _submit_cmd = 'qsub'
+    _status_cmd = 'qstat'
+    _default_template = '#$ -V\n#$ -S /bin/sh'
+    _array_index_var = 'SGE_TASK_ID'
+    _array_start = 1
+
+    def _submit_args(self, node, batch_dir, narray=None):
+        args = '-N %s -o %s -e %s' % (node._id, batch_dir, batch_dir)
+        if narray:
+            args = '-t 1-%d %s' % (narray, args)
+        return args
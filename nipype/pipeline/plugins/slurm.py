@@ -0,0 +1,35 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via SLURM
+"""
+import os
+
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+
+class SLURMPlugin(SGELikeBatchManagerBase):
+    """Execute workflow with SLURM
+
+    The plugin_args input to run can be used to control the SLURM
+    execution. See SGELikeBatchManagerBase for the supported options;
+    qsub_args are passed on to sbatch.
+
+    Examples
+    --------
+
+    >>> workflow.run(plugin='SLURM', plugin_args={'qsub_args': '-p many'}) # doctest: +SKIP
+
+    """
+
+    _submit_cmd = 'sbatch'
+    _status_cmd = 'squeue -h -o %i'
+    _default_template = '#!/bin/sh'
+    _array_index_var = 'SLURM_ARRAY_TASK_ID'
+    _array_start = 0
+
+    def _submit_args(self, node, batch_dir, narray=None):
+        args = '-J %s -o %s -e %s' % (node._id,
+                                      os.path.join(batch_dir, 'slurm-%j.out'),
+                                      os.path.join(batch_dir, 'slurm-%j.err'))
+        if narray:
+            args = '--array=0-%d %s' % (narray - 1, args)
+        return args
@@ -0,0 +1,263 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the distributed plugin base
+"""
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, parametric
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import IdentityInterface
+from nipype.pipeline.plugins.base import DistributedPluginBase, run_node
+from nipype.pipeline.plugins.tests.test_multiproc import TestInterface
+
+class InProcessPlugin(DistributedPluginBase):
+    """Runs every job immediately and records the order of submission
+    """
+
+    def __init__(self, plugin_args=None):
+        super(InProcessPlugin, self).__init__(plugin_args=plugin_args)
+        self._taskresult = {}
+        self.submitted = []
+
+    def _submit_job(self, node, updatehash=False):
+        taskid = len(self.submitted)
+        self.submitted.append(node._id)
+        self._taskresult[taskid] = run_node(node, updatehash)
+        self._task_done(taskid)
+        return taskid
+
+    def _get_result(self, taskid):
+        return self._taskresult.pop(taskid)
+
+@parametric
+def test_run_event_driven():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.Node(interface=TestInterface(),name='mod2')
+    mod3 = pe.Node(interface=TestInterface(),name='mod3')
+    pipe.connect([(mod1,mod2,[(('output1', lambda x: x[1]),'input1')]),
+                  (mod2,mod3,[(('output1', lambda x: x[1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 3
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted, ['mod1', 'mod2', 'mod3'])
+    yield assert_equal(runner.pending_tasks, {})
+    node = pipe.get_exec_node('pipe.mod3')
+    yield assert_equal(node.get_output('output1'), [1, 3])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class ResourcePlugin(InProcessPlugin):
+    """Records the peak resource usage at submission
+    """
+
+    def __init__(self, plugin_args=None):
+        super(ResourcePlugin, self).__init__(plugin_args=plugin_args)
+        self.peak = (0, 0)
+
+    def _submit_job(self, node, updatehash=False):
+        self.peak = (max(self.peak[0], self.used_memory_gb),
+                     max(self.peak[1], self.used_threads))
+        return super(ResourcePlugin, self)._submit_job(node, updatehash)
+
+def _make_budget_workflow(name, big=False):
+    pipe = pe.Workflow(name=name)
+    nodes = []
+    for i in range(4):
+        nodes.append(pe.Node(interface=TestInterface(), name='mod%d' % i,
+                             estimated_memory_gb=3, num_threads=2))
+        nodes[-1].inputs.input1 = i
+    if big:
+        # exceeds the budget and therefore runs alone
+        nodes.append(pe.Node(interface=TestInterface(), name='big',
+                             estimated_memory_gb=10))
+        nodes[-1].inputs.input1 = 4
+    pipe.add_nodes(nodes)
+    pipe.base_dir = os.getcwd()
+    return pipe
+
+@parametric
+def test_run_resource_budget():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = _make_budget_workflow('pipe', big=True)
+    runner = ResourcePlugin(plugin_args={'memory_gb': 8, 'n_procs': 3})
+    pipe.run(plugin=runner)
+    yield assert_equal(len(runner.submitted), 5)
+    yield assert_equal(runner.peak, (10, 2))
+    yield assert_equal(runner.used_threads, 0)
+    pipe = _make_budget_workflow('pipe2')
+    runner = ResourcePlugin(plugin_args={'memory_gb': 8, 'n_procs': 4})
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.peak, (6, 4))
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_claim_resources_ignores_prefetch():
+    runner = InProcessPlugin(plugin_args={'memory_gb': 8})
+    runner.procs = [pe.Node(interface=TestInterface(), name='big',
+                            estimated_memory_gb=10),
+                    pe.Node(interface=TestInterface(), name='mod',
+                            estimated_memory_gb=1)]
+    runner.used_memory_gb = 0
+    runner.used_threads = 0
+    # a running data source does not hold back an oversized job
+    runner._io_results = {('prefetch', 5): None}
+    runner.pending_tasks = {('prefetch', 5): 5}
+    yield assert_equal(runner._claim_resources(0), True)
+    runner._release_resources(0)
+    # a running compute job does
+    runner.pending_tasks[0] = 1
+    yield assert_equal(runner._claim_resources(0), False)
+    yield assert_equal(runner._claim_resources(1), True)
+
+@parametric
+def test_run_critical_path():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    short = pe.Node(interface=TestInterface(),name='short')
+    short.inputs.input1 = 1
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod1.inputs.input1 = 1
+    mod2 = pe.Node(interface=TestInterface(),name='mod2')
+    mod3 = pe.Node(interface=TestInterface(),name='mod3')
+    pipe.add_nodes([short])
+    pipe.connect([(mod1,mod2,[(('output1', lambda x: x[1]),'input1')]),
+                  (mod2,mod3,[(('output1', lambda x: x[1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted[0], 'mod1')
+    yield assert_equal(runner.priority[runner._jobids[
+                pipe.get_exec_node('pipe.mod1')]], 3)
+    runner = InProcessPlugin(plugin_args={'priority': 'runtime'})
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted[0], 'mod1')
+    runner = InProcessPlugin(plugin_args={'priority': 'fifo'})
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.priority, None)
+    yield assert_equal(sorted(runner.submitted),
+                       ['mod1', 'mod2', 'mod3', 'short'])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_run_without_submitting():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    ident = pe.Node(interface=IdentityInterface(fields=['a']),name='ident')
+    mod2 = pe.Node(interface=TestInterface(),name='mod2',
+                   run_without_submitting=True)
+    mod3 = pe.Node(interface=TestInterface(),name='mod3')
+    pipe.connect([(mod1,ident,[(('output1', lambda x: x[1]),'a')]),
+                  (ident,mod2,[('a','input1')]),
+                  (mod2,mod3,[(('output1', lambda x: x[1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 2
+    yield assert_equal(ident.run_without_submitting, True)
+    yield assert_equal(mod1.run_without_submitting, False)
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted, ['mod1', 'mod3'])
+    node = pipe.get_exec_node('pipe.mod3')
+    yield assert_equal(node.get_output('output1'), [1, 2])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class FailOnTwoInterface(TestInterface):
+    def _run_interface(self, runtime):
+        if self.inputs.input1 == 2:
+            raise ValueError('input1 is 2')
+        runtime.returncode = 0
+        return runtime
+
+@parametric
+def test_run_mapnode_iterations():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    pipe.connect([(mod1,mod2,[('output1','input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 3
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted, ['mod1', '_mod20', '_mod21'])
+    node = pipe.get_exec_node('pipe.mod2')
+    yield assert_equal(node.get_output('output1'), [[1, 1], [1, 3]])
+    # unchanged iterations are not submitted again
+    mod1.inputs.input1 = 4
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted, ['mod1', '_mod21'])
+    node = pipe.get_exec_node('pipe.mod2')
+    yield assert_equal(node.get_output('output1'), [[1, 1], [1, 4]])
+    # a failing iteration stops the dependents of the MapNode
+    pipe = pe.Workflow(name='pipe2')
+    mod1 = pe.MapNode(interface=FailOnTwoInterface(),
+                      iterfield=['input1'],
+                      name='mod1')
+    mod1.inputs.input1 = [1, 2]
+    mod2 = pe.Node(interface=TestInterface(),name='mod2')
+    pipe.connect([(mod1,mod2,[(('output1', lambda x: x[0][1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(runner.submitted, ['_mod10', '_mod11'])
+    yield assert_equal(runner.pending_tasks, {})
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class FetchInterface(TestInterface):
+    io_bound = True
+
+@parametric
+def test_run_prefetch():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    for i in range(3):
+        fetch = pe.Node(interface=FetchInterface(), name='fetch%d' % i)
+        fetch.inputs.input1 = i
+        mod = pe.Node(interface=TestInterface(), name='mod%d' % i)
+        pipe.connect([(fetch,mod,[(('output1', lambda x: x[1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    yield assert_equal(fetch.io_bound, True)
+    runner = InProcessPlugin(plugin_args={'prefetch_depth': 2,
+                                          'prefetch_disk_gb': 1})
+    pipe.run(plugin=runner)
+    # the data sources are run on the prefetch pool
+    yield assert_equal(sorted(runner.submitted), ['mod0', 'mod1', 'mod2'])
+    yield assert_equal(runner.pending_tasks, {})
+    yield assert_equal(runner._io_pool, None)
+    node = pipe.get_exec_node('pipe.mod2')
+    yield assert_equal(node.get_output('output1'), [1, 2])
+    runner = InProcessPlugin()
+    pipe.run(plugin=runner)
+    yield assert_equal(len(runner.submitted), 6)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
@@ -0,0 +1,86 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the IPython plugin using a fake TaskClient
+"""
+import os
+import sys
+from tempfile import mkdtemp
+from shutil import rmtree
+from types import ModuleType
+
+from nipype.testing import assert_equal, assert_true, parametric
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.tests.test_multiproc import TestInterface
+
+class StringTask(object):
+    def __init__(self, expression, push=None, pull=None):
+        self.expression = expression
+        self.push = push
+        self.pull = pull
+
+class TaskClient(object):
+    """Runs every task on submission, but only reports its result when it
+    is polled for the second time
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.polls = {}
+
+    def run(self, task, block=True):
+        namespace = dict(task.push)
+        exec task.expression in namespace
+        self.tasks.append(dict([(key, namespace[key]) for key in task.pull]))
+        return len(self.tasks) - 1
+
+    def get_task_result(self, taskid, block=True):
+        self.polls[taskid] = self.polls.get(taskid, 0) + 1
+        if self.polls[taskid] < 2:
+            return None
+        return self.tasks[taskid]
+
+def _install_fake_ipython():
+    names = ['IPython', 'IPython.kernel', 'IPython.kernel.client']
+    saved = dict([(name, sys.modules.get(name)) for name in names])
+    for name in names:
+        sys.modules[name] = ModuleType(name)
+    client = sys.modules['IPython.kernel.client']
+    client.TaskClient = TaskClient
+    client.StringTask = StringTask
+    return saved
+
+def _restore_modules(saved):
+    for name, module in saved.items():
+        if module is None:
+            del sys.modules[name]
+        else:
+            sys.modules[name] = module
+
+@parametric
+def test_run_ipython():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    saved = _install_fake_ipython()
+    try:
+        from nipype.pipeline.plugins.ipython import IPythonPlugin
+        pipe = pe.Workflow(name='pipe')
+        mod1 = pe.Node(interface=TestInterface(),name='mod1')
+        mod2 = pe.MapNode(interface=TestInterface(),
+                          iterfield=['input1'],
+                          name='mod2')
+        pipe.connect([(mod1,mod2,[('output1','input1')])])
+        pipe.base_dir = os.getcwd()
+        mod1.inputs.input1 = 1
+        runner = IPythonPlugin(plugin_args={'poll_sleep_duration': 0.01})
+        yield assert_true(isinstance(runner.taskclient, TaskClient))
+        pipe.run(plugin=runner)
+        # the watcher thread polled every task until it was reported
+        yield assert_equal(runner.taskclient.polls.values(), [2, 2, 2])
+        yield assert_equal(runner._outstanding, set())
+        node = pipe.get_exec_node('pipe.mod2')
+        yield assert_equal(node.get_output('output1'), [[1, 1], [1, 1]])
+    finally:
+        _restore_modules(saved)
+        os.chdir(cur_dir)
+        rmtree(temp_dir)
@@ -0,0 +1,79 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the multiprocessing plugin
+"""
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, assert_raises, parametric
+import nipype.interfaces.base as nib
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins import MultiProcPlugin
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+    input2 = nib.traits.Int(desc='a random int')
+
+class OutputSpec(nib.TraitedSpec):
+    output1 = nib.traits.List(nib.traits.Int, desc='outputs')
+
+class TestInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [1, self.inputs.input1]
+        return outputs
+
+@parametric
+def test_run_multiproc():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    pipe.connect([(mod1,mod2,[('output1','input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    pipe.run(plugin='MultiProc', plugin_args={'n_procs': 2})
+    node = pipe.get_exec_node('pipe.mod1')
+    result = node.get_output('output1')
+    yield assert_equal(result, [1, 1])
+    node = pipe.get_exec_node('pipe.mod2')
+    result = node.get_output('output1')
+    yield assert_equal(result, [[1, 1], [1, 1]])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_reuse_plugin():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 2})
+    for name in ['pipe1', 'pipe2']:
+        pipe = pe.Workflow(name=name)
+        mod1 = pe.Node(interface=TestInterface(),name='mod1')
+        pipe.add_nodes([mod1])
+        pipe.base_dir = os.getcwd()
+        mod1.inputs.input1 = 1
+        pipe.run(plugin=plugin)
+        result = pipe.get_exec_node('%s.mod1' % name).get_output('output1')
+        yield assert_equal(result, [1, 1])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+def test_unknown_plugin():
+    pipe = pe.Workflow(name='pipe')
+    yield assert_raises, ValueError, pipe._get_plugin, 'foo', None
@@ -0,0 +1,138 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the batch plugins using a fake SGE installation
+"""
+import os
+from Queue import Queue
+import sys
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import nipype
+from nipype.testing import assert_equal, assert_true, parametric
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins import SGEPlugin
+from nipype.pipeline.plugins.tests.test_multiproc import TestInterface
+
+# runs the submitted script synchronously, once per array index
+qsub_script = """#!%s
+import os
+import subprocess
+import sys
+args = sys.argv[1:]
+indices = [None]
+if '-t' in args:
+    start, stop = args[args.index('-t') + 1].split('-')
+    indices = range(int(start), int(stop) + 1)
+counter = os.path.join(os.path.dirname(sys.argv[0]), 'jobid')
+jobid = 1
+if os.path.exists(counter):
+    jobid = int(open(counter).read()) + 1
+open(counter, 'w').write(str(jobid))
+env = dict(os.environ)
+for index in indices:
+    if index is not None:
+        env['SGE_TASK_ID'] = str(index)
+    subprocess.call(['sh', args[-1]], env=env)
+print 'Your job %%d ("%%s") has been submitted' %% (jobid,
+                                                args[args.index('-N') + 1])
+"""
+
+qstat_script = """#!%s
+"""
+
+def _write_script(path, content):
+    fp = open(path, 'wt')
+    fp.write(content % sys.executable)
+    fp.close()
+    os.chmod(path, 0755)
+
+@parametric
+def test_run_sge():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    qsub = os.path.join(temp_dir, 'qsub')
+    qstat = os.path.join(temp_dir, 'qstat')
+    _write_script(qsub, qsub_script)
+    _write_script(qstat, qstat_script)
+    pkg_dir = os.path.dirname(os.path.dirname(nipype.__file__))
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    pipe.connect([(mod1,mod2,[('output1','input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    pipe.run(plugin='SGE',
+             plugin_args={'submit_cmd': qsub,
+                          'status_cmd': qstat,
+                          'poll_sleep_duration': 0.1,
+                          'template': 'export PYTHONPATH=%s' % pkg_dir})
+    node = pipe.get_exec_node('pipe.mod1')
+    result = node.get_output('output1')
+    yield assert_equal(result, [1, 1])
+    node = pipe.get_exec_node('pipe.mod2')
+    result = node.get_output('output1')
+    yield assert_equal(result, [[1, 1], [1, 1]])
+    # the two iterations of the MapNode were submitted as one array job
+    yield assert_equal(open(os.path.join(temp_dir, 'jobid')).read(), '2')
+    yield assert_true(os.path.exists(os.path.join(temp_dir, 'pipe', 'batch',
+                                                  'result_mod2_2.pklz')))
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_sge_result_timeout():
+    temp_dir = mkdtemp(prefix='test_engine_')
+    qstat = os.path.join(temp_dir, 'qstat')
+    _write_script(qstat, qstat_script)
+    plugin = SGEPlugin(plugin_args={'status_cmd': qstat,
+                                    'result_timeout': 3600})
+    plugin._completed = Queue()
+    resultsfile = os.path.join(temp_dir, 'result_mod1.pklz')
+    plugin._taskinfo['1'] = dict(node=None, results=[resultsfile])
+    # the job has left the queue, but its result file is not visible yet
+    plugin._check_pending_tasks()
+    yield assert_true(plugin._completed.empty())
+    open(resultsfile, 'wt').close()
+    plugin._check_pending_tasks()
+    yield assert_equal(plugin._completed.get_nowait(), '1')
+    # without a result file the job crashed once the timeout has passed
+    plugin._result_timeout = 0
+    plugin._taskinfo['2'] = dict(node=None, results=[resultsfile + '2'])
+    plugin._check_pending_tasks()
+    yield assert_equal(plugin._completed.get_nowait(), '2')
+    rmtree(temp_dir)
+
+@parametric
+def test_sge_updatehash():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    qsub = os.path.join(temp_dir, 'qsub')
+    qstat = os.path.join(temp_dir, 'qstat')
+    _write_script(qsub, qsub_script)
+    _write_script(qstat, qstat_script)
+    pkg_dir = os.path.dirname(os.path.dirname(nipype.__file__))
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod1')
+    mod1.inputs.input1 = [1, 2]
+    pipe.add_nodes([mod1])
+    pipe.base_dir = os.getcwd()
+    pipe.run(plugin='SGE', updatehash=True,
+             plugin_args={'submit_cmd': qsub,
+                          'status_cmd': qstat,
+                          'poll_sleep_duration': 0.1,
+                          'template': 'export PYTHONPATH=%s' % pkg_dir})
+    # like the other plugins, the MapNode is submitted as a single job
+    yield assert_equal(open(os.path.join(temp_dir, 'jobid')).read(), '1')
+    yield assert_true(os.path.exists(os.path.join(temp_dir, 'pipe', 'batch',
+                                                  'result_mod1.pklz')))
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
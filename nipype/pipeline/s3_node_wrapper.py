@@ -2,20 +2,33 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 '''
 Variant of node_wrapper that fetches and stores data on amazon's S3 using boto
+
+Nodes stage inputs given as ``s3://bucket/key`` URIs into their working
+directory with `stage_s3_files` before running. Downloads are stored in the
+download cache (see `nipype.utils.downloadcache`) by URI and ETag.
 '''
 
+from cStringIO import StringIO
+import logging
+from multiprocessing.pool import ThreadPool
 import os
 from tempfile import mkdtemp
+import threading
 from ConfigParser import RawConfigParser
 
+from nipype.utils.downloadcache import get_download_cache
+from nipype.utils.filemanip import copyfile
+
 # Eventually, we'll want to hoist this stuff to something in nipype.utils
 # But wait 'til it stabilizes here!
 try:
-    from boto.s3 import Connection
-    import tables
+    from boto.s3.connection import S3Connection as Connection
     from boto.s3.key import Key
+    from boto.s3.multipart import MultiPartUpload
 except ImportError:
-    pass
+    Connection = None
+
+logger = logging.getLogger('workflow')
 
 class S3NodeWrapper(object):
     '''
@@ -63,15 +76,54 @@ class S3Transporter(object):
 
     Currently, only s3:// syntax is supported. It should be trivial to
     implement other formats, e.g. http, ftp, scp...
-    
-    There is also no error checking anywhere at this point. This should clearly
-    be added at some point'''
 
-    def __init__(self, working_directory, s3_root, s3env='shell'):
+    Files larger than `part_size_mb` are transferred in parts on `n_threads`
+    threads (ranged requests for downloads, multipart uploads for uploads).
+    `get_many` and `put_many` transfer several files concurrently instead.
+    Every thread uses its own connection. Downloads are stored in `cache`
+    (default: the download cache of the config file) by URI and ETag, so
+    that transporters sharing the cache download every version of a file
+    once.
+
+    Parameters
+    ----------
+    working_directory : string
+        directory local paths are relative to
+    s3_root : string
+        bucket and key prefix, e.g., s3://bucket/prefix or bucket/prefix
+    s3env : string
+        where the credentials are read from: 'shell' (the AWS_ACCESS_KEY and
+        AWS_SECRET_KEY environment variables) or 's3cfg' (~/.s3cfg)
+    n_threads : int
+        number of concurrent transfers
+    part_size_mb : int
+        size of the parts of large files
+    cache : DownloadCache
+        cache of downloaded files
+    connection_args : dict
+        further arguments of the boto connection, e.g., host, port and
+        is_secure to use another S3 compatible server
+
+    Examples
+    --------
+
+    >>> s3 = S3Transporter('/tmp/work', 's3://bucket/study') # doctest: +SKIP
+    >>> s3.get_many(['s1/func.nii', 's2/func.nii']) # doctest: +SKIP
+    >>> s3.put('results/s1/stats.nii', 'stats.nii') # doctest: +SKIP
+
+    '''
+
+    def __init__(self, working_directory, s3_root, s3env='shell',
+                 n_threads=4, part_size_mb=16, cache=None,
+                 connection_args=None):
         '''Set up the environment for dealing with S3'''
+        if Connection is None:
+            raise ImportError('S3Transporter requires boto')
+        self.access_key = None
+        self.secret_key = None
         if s3env == 'shell':
-            self.access_key = os.environ['AWS_ACCESS_KEY']
-            self.secret_key = os.environ['AWS_SECRET_KEY']
+            self.access_key = os.environ.get('AWS_ACCESS_KEY')
+            self.secret_key = os.environ.get('AWS_SECRET_KEY')
         if s3env == 's3cfg':
             rcfg = RawConfigParser()
             rcfg.read(os.environ['HOME'] + '/.s3cfg')
@@ -88,18 +140,35 @@ class S3Transporter(object):
             raise Exception('AWS_SECRET_KEY is not defined')
 
         self.working_directory = working_directory
+        if s3_root.startswith('s3://'):
+            s3_root = s3_root[len('s3://'):]
         try:
             self.s3_bucket, self.s3_key_prefix = \
                     s3_root.strip('/').split('/', 1)
         except ValueError:
-            self.s3_bucket = s3_bucket.strip('/')
+            self.s3_bucket = s3_root.strip('/')
             self.s3_key_prefix = ''
+        self.n_threads = n_threads
+        self.part_size = part_size_mb * 1024 * 1024
+        if cache is None:
+            cache = get_download_cache()
+        self.cache = cache
+        self.connection_args = connection_args or {}
+        self._local = threading.local()
+
+    @property
+    def bucket(self):
+        '''The bucket on the connection of the current thread
+
+        boto connections must not be shared by threads.'''
+        if not hasattr(self._local, 'bucket'):
+            conn = Connection(aws_access_key_id=self.access_key,
+                              aws_secret_access_key=self.secret_key,
+                              **self.connection_args)
+            self._local.bucket = conn.get_bucket(self.s3_bucket)
+        return self._local.bucket
 
-        self.conn = Connection(aws_access_key_id=self.access_key, 
-                       aws_secret_access_key=self.secret_key)
-        self.bucket = self.conn.get_bucket(self.s3_bucket)
-                
-    def get(self, s3_path, local_path=None):
+    def get(self, s3_path, local_path=None, n_threads=None):
         '''Get a file corresponding to uri 
 
         Currently, authentication is handled by the standard amazon S3 environment
@@ -111,33 +180,186 @@ class S3Transporter(object):
             path relative to the s3_root specified at __init__ time
         local_path : string
             Where to put the downloaded file
+        n_threads : int
+            number of threads downloading the parts of a large file
+            (default: n_threads of the transporter)
+
+        Returns
+        -------
+        The path of the downloaded file.
         '''
         if local_path is None:
             local_path = s3_path
+        if n_threads is None:
+            n_threads = self.n_threads
         full_key = os.path.join(self.s3_key_prefix, s3_path)
         key = self.bucket.get_key(full_key)
+        if key is None:
+            raise IOError('s3://%s/%s does not exist' % (self.s3_bucket,
+                                                         full_key))
         full_fname = os.path.join(self.working_directory, local_path)
         self.make_dirs(os.path.dirname(full_fname))
-        f = open(full_fname, 'w')
-        key.get_file(f)
+        if self.cache is None:
+            self._download(key, full_fname, n_threads)
+        else:
+            uri = 's3://%s/%s' % (self.s3_bucket, full_key)
+            cached = self.cache.get(uri, key.etag,
+                                    lambda dest: self._download(key, dest,
+                                                                n_threads))
+            copyfile(cached, full_fname, copy=True, staging='hardlink')
+        return full_fname
+
+    def get_many(self, s3_paths, local_paths=None):
+        '''Get several files concurrently. Returns their paths.'''
+        if local_paths is None:
+            local_paths = s3_paths
+        return self._map(lambda paths: self.get(paths[0], paths[1], 1),
+                         zip(s3_paths, local_paths))
+
+    def _download(self, key, local_path, n_threads):
+        if key.size <= self.part_size or n_threads < 2:
+            f = open(local_path, 'wb')
+            try:
+                key.get_file(f)
+            finally:
+                f.close()
+            return
+        # allocate the file and download its parts with ranged requests
+        f = open(local_path, 'wb')
+        f.truncate(key.size)
         f.close()
+        def get_part(start):
+            end = min(start + self.part_size, key.size) - 1
+            f = open(local_path, 'r+b')
+            try:
+                f.seek(start)
+                Key(self.bucket, key.name).get_file(f, headers={
+                        'Range': 'bytes=%d-%d' % (start, end)})
+            finally:
+                f.close()
+        self._map(get_part, range(0, key.size, self.part_size), n_threads)
 
-    def put(self, s3_path, local_path):
+    def put(self, s3_path, local_path, n_threads=None):
         '''Put file from local path to s3 path'''
         if s3_path is None:
             s3_path = ''
+        if n_threads is None:
+            n_threads = self.n_threads
         full_key = os.path.join(self.s3_key_prefix, s3_path)
-        key = Key(self.bucket)
-        key.key = full_key
-        f = open(local_path, 'r')
-        key.send_file(f)
-        f.close()
+        size = os.path.getsize(local_path)
+        if size <= self.part_size or n_threads < 2:
+            key = Key(self.bucket)
+            key.key = full_key
+            f = open(local_path, 'rb')
+            try:
+                key.send_file(f)
+            finally:
+                f.close()
+            return
+        mp = self.bucket.initiate_multipart_upload(full_key)
+        def put_part(part):
+            # every thread uploads on its own connection
+            upload = MultiPartUpload(self.bucket)
+            upload.key_name = mp.key_name
+            upload.id = mp.id
+            f = open(local_path, 'rb')
+            try:
+                f.seek(part * self.part_size)
+                data = f.read(self.part_size)
+            finally:
+                f.close()
+            upload.upload_part_from_file(StringIO(data), part + 1)
+        try:
+            self._map(put_part,
+                      range((size + self.part_size - 1) / self.part_size),
+                      n_threads)
+        except:
+            mp.cancel_upload()
+            raise
+        mp.complete_upload()
+
+    def put_many(self, s3_paths, local_paths):
+        '''Put several files concurrently'''
+        self._map(lambda paths: self.put(paths[0], paths[1], 1),
+                  zip(s3_paths, local_paths))
+
+    def _map(self, func, items, n_threads=None):
+        if n_threads is None:
+            n_threads = self.n_threads
+        if n_threads < 2 or len(items) < 2:
+            return map(func, items)
+        pool = ThreadPool(min(n_threads, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
 
     def make_dirs(self, path):
         '''Create intervening subdirectories as needed
 
         This should probably be a util function'''
-        if not os.path.exists(path):
+        if path and not os.path.exists(path):
             self.make_dirs(os.path.dirname(path))
-            os.mkdir(path)
-        
+            try:
+                os.mkdir(path)
+            except OSError:
+                # created by another thread
+                if not os.path.isdir(path):
+                    raise
+
+_transporters = {}
+_transporters_lock = threading.Lock()
+
+def _get_transporter(bucket):
+    _transporters_lock.acquire()
+    try:
+        if bucket not in _transporters:
+            _transporters[bucket] = S3Transporter('', 's3://' + bucket)
+        return _transporters[bucket]
+    finally:
+        _transporters_lock.release()
+
+def s3_etag(uri):
+    '''Return the ETag of a s3://bucket/key URI
+
+    Returns None if boto is not available, the object does not exist or
+    cannot be queried (e.g., without credentials). Nodes hash s3:// inputs
+    with their ETag, so that an object replaced at the same key is
+    downloaded and processed again.
+    '''
+    if Connection is None:
+        return None
+    try:
+        bucket, key = uri[len('s3://'):].split('/', 1)
+    except ValueError:
+        return None
+    try:
+        key = _get_transporter(bucket).bucket.get_key(key)
+    except Exception, e:
+        # the node is hashed by the URI and fails when it stages the file
+        logger.warn('Could not get the ETag of %s: %s' % (uri, e))
+        return None
+    if key is None:
+        return None
+    return key.etag
+
+def stage_s3_files(uris, outdir, n_threads=4):
+    '''Download s3://bucket/key URIs concurrently
+
+    The files are placed in _s3/bucket/key in `outdir`. Credentials are
+    read from the environment (see `S3Transporter`). Returns the local
+    paths.
+    '''
+    def stage(uri):
+        bucket, key = uri[len('s3://'):].split('/', 1)
+        return _get_transporter(bucket).get(key, os.path.join(outdir, '_s3',
+                                                              bucket, key), 1)
+    if n_threads < 2 or len(uris) < 2:
+        return map(stage, uris)
+    pool = ThreadPool(min(n_threads, len(uris)))
+    try:
+        return pool.map(stage, uris)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,201 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the central result cache
+"""
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import (assert_equal, assert_not_equal, assert_true,
+                            assert_false, parametric)
+import nipype.interfaces.base as nib
+import nipype.pipeline.engine as pe
+from nipype.pipeline.cache import ResultCache, get_result_cache
+from nipype.pipeline.utils import load_resultfile
+from nipype.utils.config import config
+from nipype.utils.filemanip import savepkl
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+
+class OutputSpec(nib.TraitedSpec):
+    out_file = nib.File(exists=True, desc='a file')
+
+class WriteInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+    runs = 0
+
+    def _run_interface(self, runtime):
+        WriteInterface.runs += 1
+        fp = open('out.txt', 'wt')
+        fp.write(str(self.inputs.input1))
+        fp.close()
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath('out.txt')
+        return outputs
+
+class FileInputSpec(nib.TraitedSpec):
+    in_file = nib.File(exists=True, desc='a file')
+
+class CopyInterface(WriteInterface):
+    input_spec = FileInputSpec
+
+    def _run_interface(self, runtime):
+        WriteInterface.runs += 1
+        open('out.txt', 'wt').write(open(self.inputs.in_file).read())
+        runtime.returncode = 0
+        return runtime
+
+def _run_node(name, base_dir, input1):
+    if not os.path.exists(base_dir):
+        os.mkdir(base_dir)
+    node = pe.Node(interface=WriteInterface(), name=name)
+    node.inputs.input1 = input1
+    node.base_dir = base_dir
+    return node.run().outputs.out_file
+
+@parametric
+def test_result_cache():
+    temp_dir = mkdtemp(prefix='test_cache_')
+    cachedir = os.path.join(temp_dir, 'cache')
+    config.set('execution', 'result_cache_dir', cachedir)
+    try:
+        WriteInterface.runs = 0
+        out1 = _run_node('mod1', os.path.join(temp_dir, 'a'), 1)
+        yield assert_equal(WriteInterface.runs, 1)
+        # the same interface and inputs in another directory are reused
+        out2 = _run_node('mod2', os.path.join(temp_dir, 'b'), 1)
+        yield assert_equal(WriteInterface.runs, 1)
+        yield assert_equal(out2, os.path.join(temp_dir, 'b', 'mod2',
+                                              'out.txt'))
+        yield assert_not_equal(os.stat(out1).st_ino, os.stat(out2).st_ino)
+        yield assert_equal(open(out2).read(), '1')
+        # modifying the reused outputs does not change the cache
+        open(out2, 'wt').write('changed')
+        out3 = _run_node('mod3', os.path.join(temp_dir, 'c'), 1)
+        yield assert_equal(WriteInterface.runs, 1)
+        yield assert_equal(open(out3).read(), '1')
+        # the reused result is found in its own directory afterwards
+        _run_node('mod2', os.path.join(temp_dir, 'b'), 1)
+        yield assert_equal(WriteInterface.runs, 1)
+        _run_node('mod2', os.path.join(temp_dir, 'b'), 2)
+        yield assert_equal(WriteInterface.runs, 2)
+        cache = get_result_cache()
+        entries = cache.entries()
+        yield assert_equal(len(entries), 2)
+        yield assert_equal(entries[0]['interface'],
+                           '%s.WriteInterface' % __name__)
+        yield assert_equal(cache.prune(1), 0)
+        yield assert_equal(cache.prune(0), 2)
+        yield assert_equal(cache.entries(), [])
+    finally:
+        config.set('execution', 'result_cache_dir', '')
+        rmtree(temp_dir)
+
+@parametric
+def test_result_cache_hash_method():
+    temp_dir = mkdtemp(prefix='test_cache_')
+    config.set('execution', 'result_cache_dir',
+               os.path.join(temp_dir, 'cache'))
+    # the images of two subjects with the same name, size and mtime
+    infiles = []
+    for subject in ['s1', 's2']:
+        os.makedirs(os.path.join(temp_dir, subject))
+        infile = os.path.join(temp_dir, subject, 'T1.nii')
+        open(infile, 'wt').write(subject)
+        os.utime(infile, (1000000000, 1000000000))
+        infiles.append(infile)
+    try:
+        for method in ['content', 'timestamp', 'fast']:
+            config.set('execution', 'hash_method', method)
+            WriteInterface.runs = 0
+            for subject, infile in zip(['s1', 's2'], infiles):
+                node = pe.Node(interface=CopyInterface(), name='copy')
+                node.inputs.in_file = infile
+                node.base_dir = os.path.join(temp_dir, method, subject)
+                os.makedirs(node.base_dir)
+                out_file = node.run().outputs.out_file
+                yield assert_equal(open(out_file).read(), subject)
+            yield assert_equal(WriteInterface.runs, 2)
+        yield assert_equal(get_result_cache(), None)
+    finally:
+        config.set('execution', 'hash_method', 'content')
+        config.set('execution', 'result_cache_dir', '')
+        rmtree(temp_dir)
+
+@parametric
+def test_result_cache_environ():
+    temp_dir = mkdtemp(prefix='test_cache_')
+    config.set('execution', 'result_cache_dir',
+               os.path.join(temp_dir, 'cache'))
+    try:
+        WriteInterface.runs = 0
+        for name in ['a', 'b']:
+            pipe = pe.Workflow(name='pipe')
+            mod1 = pe.Node(interface=WriteInterface(), name='mod1')
+            mod1.inputs.input1 = 1
+            pipe.add_nodes([mod1])
+            pipe.base_dir = os.path.join(temp_dir, name)
+            os.makedirs(pipe.base_dir)
+            pipe.run(inseries=True)
+            # the environment snapshot of the first run is gone
+            rmtree(os.path.join(temp_dir, 'a'), ignore_errors=True)
+        yield assert_equal(WriteInterface.runs, 1)
+        result = load_resultfile(os.path.join(temp_dir, 'b', 'pipe', 'mod1',
+                                              'result_mod1.pklz'))
+        yield assert_true(isinstance(result.runtime.environ, dict))
+    finally:
+        config.set('execution', 'result_cache_dir', '')
+        rmtree(temp_dir)
+
+@parametric
+def test_result_cache_link():
+    temp_dir = mkdtemp(prefix='test_cache_')
+    src = os.path.join(temp_dir, 'src')
+    os.makedirs(os.path.join(src, 'sub'))
+    open(os.path.join(src, 'sub', 'a.txt'), 'wt').write('a')
+    result = nib.InterfaceResult(None, nib.Bunch(), None)
+    savepkl(os.path.join(src, 'result_x.pklz'), result)
+    cache = ResultCache(os.path.join(temp_dir, 'cache'), link='symlink')
+    cache.store('abc', src, os.path.join(src, 'result_x.pklz'), result)
+    yield assert_true(cache.fetch('abc', os.path.join(temp_dir, 'dst'),
+                                  os.path.join(temp_dir, 'dst',
+                                               'result_y.pklz')))
+    dst = os.path.join(temp_dir, 'dst', 'sub', 'a.txt')
+    yield assert_true(os.path.islink(dst))
+    yield assert_equal(open(dst).read(), 'a')
+    yield assert_true(os.path.exists(os.path.join(temp_dir, 'dst',
+                                                  'result_y.pklz')))
+    yield assert_false(cache.fetch('abd', os.path.join(temp_dir, 'dst'),
+                                   os.path.join(temp_dir, 'dst',
+                                                'result_y.pklz')))
+    rmtree(temp_dir)
+
+@parametric
+def test_result_cache_prune():
+    temp_dir = mkdtemp(prefix='test_cache_')
+    src = os.path.join(temp_dir, 'src')
+    os.makedirs(src)
+    open(os.path.join(src, 'a.txt'), 'wt').write('a' * 1024)
+    result = nib.InterfaceResult(None, nib.Bunch(), None)
+    savepkl(os.path.join(src, 'result_x.pklz'), result)
+    cache = ResultCache(os.path.join(temp_dir, 'cache'), max_gb=1)
+    cache.store('abc', src, os.path.join(src, 'result_x.pklz'), result)
+    size = cache._size
+    yield assert_true(size > 1024)
+    # the size is tracked without reading the entries again
+    cache.entries = lambda: []
+    cache.store('abd', src, os.path.join(src, 'result_x.pklz'), result)
+    yield assert_equal(cache._size, 2 * size)
+    del cache.entries
+    # entries are removed once the tracked size exceeds the limit
+    cache.max_gb = 1.5 * size / 1024. ** 3
+    cache.store('abe', src, os.path.join(src, 'result_x.pklz'), result)
+    yield assert_equal(len(cache.entries()), 1)
+    yield assert_equal(cache._size, size)
+    rmtree(temp_dir)
@@ -4,17 +4,23 @@
 """
 import os
 from copy import deepcopy
+from glob import glob
 from tempfile import mkdtemp
 from shutil import rmtree
 from nose import with_setup
 
 import networkx as nx
 
-from nipype.testing import (assert_raises, assert_equal, assert_true,
-                            assert_false, skipif, parametric)
+from nipype.testing import (assert_raises, assert_equal, assert_not_equal,
+                            assert_true, assert_false, skipif, parametric)
 import nipype.interfaces.base as nib
-from nipype.utils.filemanip import cleandir
+from nipype.interfaces.io import DataGrabber
+from nipype.interfaces.utility import IdentityInterface
+from nipype.utils.filemanip import cleandir, loadpkl
 import nipype.pipeline.engine as pe
+from nipype.pipeline.utils import load_resultfile, _subgraph
+from nipype.pipeline.plugins import DistributedPluginBase, MultiProcPlugin
+from nipype.utils.config import config
 
 class InputSpec(nib.TraitedSpec):
     input1 = nib.traits.Int(desc='a random int')
@@ -36,6 +42,16 @@ class TestInterface(nib.BaseInterface):
         outputs['output1'] = [1, self.inputs.input1]
         return outputs
 
+class CountingInterface(TestInterface):
+    """Appends a line to `logfile` whenever it runs"""
+    logfile = None
+
+    def _run_interface(self, runtime):
+        open(self.logfile, 'at').write('%d\n' % self.inputs.input1)
+        return super(CountingInterface, self)._run_interface(runtime)
+
+def _count_runs():
+    return len(open(CountingInterface.logfile).readlines())
 
 
 @parametric
@@ -74,12 +90,18 @@ def test_generate_dependency_list():
     pipe.connect([(mod1,mod2,[('output1','input1')])])
     pipe._create_flat_graph()
     pipe._execgraph = pe._generate_expanded_graph(deepcopy(pipe._flatgraph))
-    pipe._generate_dependency_list()
+    runner = DistributedPluginBase()
+    runner._generate_dependency_list(pipe._execgraph)
     yield assert_false(pipe._execgraph == None)
-    yield assert_equal(len(pipe.procs), 2)
-    yield assert_false(pipe.proc_done[1])
-    yield assert_false(pipe.proc_pending[1])
-    yield assert_equal(pipe.depidx[0,1], 1)
+    yield assert_equal(len(runner.procs), 2)
+    yield assert_false(runner.proc_done[1])
+    yield assert_false(runner.proc_pending[1])
+    jobids = [str(node) for node in runner.procs]
+    id1, id2 = jobids.index('pipe.mod1'), jobids.index('pipe.mod2')
+    yield assert_equal(runner.depcount[id1], 0)
+    yield assert_equal(runner.depcount[id2], 1)
+    yield assert_equal(runner.children[id1], [id2])
+    yield assert_equal(list(runner.readytorun), [id1])
 
 @parametric
 def test_run_in_series():
@@ -102,6 +124,299 @@ def test_run_in_series():
     # called at this point in the code, after all of the above is
     # executed!
     yield assert_equal(result, [1, 1])
+    # the environment is saved once per run
+    yield assert_equal(len(os.listdir(os.path.join(temp_dir, '_environ'))), 1)
+    result = loadpkl(os.path.join(temp_dir, 'pipe', 'mod1',
+                                  'result_mod1.pklz'))
+    yield assert_equal(result.runtime.environ, None)
+    # the environment is restored when the result is loaded
+    result = load_resultfile(os.path.join(temp_dir, 'pipe', 'mod1',
+                                          'result_mod1.pklz'))
+    yield assert_equal(result.runtime.environ, node.result.runtime.environ)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_mapnode_reuses_iterations():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    mod1 = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='mod1')
+    mod1.base_dir = temp_dir
+    mod1.inputs.input1 = [1, 2, 3]
+    mod1.run()
+    mapflow = os.path.join(temp_dir, 'mod1', 'mapflow')
+    for i in range(3):
+        open(os.path.join(mapflow, '_mod1%d' % i, 'marker'), 'wt').close()
+    # only the changed iteration is rerun
+    mod1.inputs.input1 = [1, 5, 3]
+    result = mod1.run()
+    yield assert_equal(result.outputs.output1, [[1, 1], [1, 5], [1, 3]])
+    yield assert_equal([os.path.exists(os.path.join(mapflow, '_mod1%d' % i,
+                                                    'marker')) \
+                            for i in range(3)], [True, False, True])
+    mod1.inputs.input1 = [1, 5]
+    mod1.run()
+    yield assert_equal(sorted(os.listdir(mapflow)), ['_mod10', '_mod11'])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_mapnode_overwrite_reruns_iterations():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    CountingInterface.logfile = os.path.join(temp_dir, 'runs.txt')
+
+    mod1 = pe.MapNode(interface=CountingInterface(), iterfield=['input1'],
+                      name='mod1')
+    mod1.base_dir = temp_dir
+    mod1.inputs.input1 = [1, 2, 3]
+    mod1.run()
+    mod1.run()
+    yield assert_equal(_count_runs(), 3)
+    mod1.run(force_execute=True)
+    yield assert_equal(_count_runs(), 6)
+    mod1.overwrite = True
+    mod1.run()
+    yield assert_equal(_count_runs(), 9)
+    for plugin in ['Linear', 'MultiProc']:
+        pipe = pe.Workflow(name='pipe_%s' % plugin.lower())
+        mod2 = pe.MapNode(interface=CountingInterface(), iterfield=['input1'],
+                          name='mod2', overwrite=True)
+        mod2.inputs.input1 = [1, 2, 3]
+        pipe.add_nodes([mod2])
+        pipe.base_dir = temp_dir
+        nruns = _count_runs()
+        pipe.run(plugin=plugin, plugin_args={'n_procs': 2})
+        pipe.run(plugin=plugin, plugin_args={'n_procs': 2})
+        yield assert_equal(_count_runs() - nruns, 6)
+    CountingInterface.logfile = None
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class FailOnTwoInterface(TestInterface):
+    def _run_interface(self, runtime):
+        if self.inputs.input1 == 2:
+            raise ValueError('input1 is 2')
+        return super(FailOnTwoInterface, self)._run_interface(runtime)
+
+@parametric
+def test_mapnode_iteration_crash():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.MapNode(interface=FailOnTwoInterface(), iterfield=['input1'],
+                      name='mod1')
+    mod1.inputs.input1 = [1, 2, 3]
+    pipe.add_nodes([mod1])
+    pipe.base_dir = temp_dir
+    pipe.run(inseries=True)
+    nodedir = os.path.join(temp_dir, 'pipe', 'mod1')
+    # the failing iteration is reported and the remaining ones are run
+    yield assert_equal(len(glob(os.path.join(nodedir, 'crash-*-_mod11.npz'))),
+                       1)
+    yield assert_true(os.path.exists(os.path.join(nodedir, 'mapflow', '_mod12',
+                                                  'result__mod12.pklz')))
+    node = pipe.get_exec_node('pipe.mod1')
+    yield assert_equal(node.result.outputs.output1, [[1, 1], None, [1, 3]])
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_lazy_copy():
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod1.inputs.input1 = 1
+    clone = mod1._lazy_copy()
+    yield assert_true(clone.interface is mod1.interface)
+    clone.set_input('input1', 2)
+    yield assert_false(clone.interface is mod1.interface)
+    yield assert_equal(mod1.inputs.input1, 1)
+    yield assert_equal(clone.inputs.input1, 2)
+    mod2 = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='mod2')
+    mod2.inputs.input1 = [1, 2]
+    mod2.inputs.input2 = 3
+    clone = mod2._lazy_copy()
+    clone.set_input('input1', [3])
+    yield assert_equal(mod2.inputs.input1, [1, 2])
+    yield assert_equal(clone.inputs.input1, [3])
+    yield assert_equal(clone.inputs.input2, 3)
+    clone.inputs.input2 = 4
+    yield assert_equal(clone.interface.inputs.input2, 4)
+    yield assert_equal(mod2.interface.inputs.input2, 3)
+
+@parametric
+def test_node_hash_memoized():
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod1.inputs.input1 = 1
+    hashval = mod1._get_hashval()
+    yield assert_true(mod1._get_hashval() is hashval)
+    mod1.inputs.input1 = 2
+    yield assert_not_equal(mod1._get_hashval()[1], hashval[1])
+    hashval = mod1._get_hashval()
+    # the hash is kept in copies and forgotten when their inputs change
+    clone = deepcopy(mod1)
+    yield assert_equal(clone._get_hashval(), hashval)
+    clone.inputs.input1 = 1
+    yield assert_not_equal(clone._get_hashval()[1], hashval[1])
+    yield assert_true(mod1._get_hashval() is hashval)
+    mod2 = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='mod2')
+    mod2.inputs.input1 = [1, 2]
+    hashval = mod2._get_hashval()
+    mod2.set_input('input2', 3)
+    yield assert_not_equal(mod2._get_hashval()[1], hashval[1])
+
+@parametric
+def test_subgraph():
+    graph = nx.DiGraph()
+    graph.add_edge('a', 'b', {'connect': [('x', 'y')]})
+    graph.add_edge('b', 'c', {'connect': [('y', 'z')]})
+    graph.add_edge('d', 'b', {'connect': [('w', 'y')]})
+    subgraph = _subgraph(graph, ['b', 'c'])
+    yield assert_equal(sorted(subgraph.nodes()), ['b', 'c'])
+    yield assert_equal(subgraph.edges(), [('b', 'c')])
+    yield assert_equal(subgraph.get_edge_data('b', 'c'),
+                       {'connect': [('y', 'z')]})
+
+@parametric
+def test_expansion_copies_on_write():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod1.iterables = ('input1', [1, 2])
+    mod2 = pe.Node(interface=TestInterface(),name='mod2')
+    pipe.connect([(mod1,mod2,[(('output1', lambda x: x[1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    pipe.run(inseries=True)
+    outputs = sorted([node.get_output('output1') \
+                          for node in pipe._execgraph.nodes() \
+                          if node.name == 'mod2'])
+    yield assert_equal(outputs, [[1, 1], [1, 2]])
+    interfaces = set([id(node.interface) for node in pipe._execgraph.nodes()])
+    yield assert_equal(len(interfaces), 4)
+    yield assert_false(mod1.interface in [node.interface for node in \
+                                              pipe._execgraph.nodes()])
+    yield assert_false(nib.isdefined(mod2.inputs.input1))
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_expanded_batches():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod1.iterables = ('input1', [1, 2, 3, 4, 5])
+    mod2 = pe.Node(interface=TestInterface(),name='mod2')
+    mod2.iterables = ('input2', [1, 2])
+    pipe.connect([(mod1,mod2,[(('output1', lambda x: x[1]),'input1')])])
+    pipe._create_flat_graph()
+    sizes = [graph.number_of_nodes() for graph in \
+                 pe._generate_expanded_batches(pipe._flatgraph, 2)]
+    yield assert_equal(sizes, [6, 6, 3])
+    pipe.base_dir = os.getcwd()
+    config.set('execution', 'iterables_batch_size', '2')
+    try:
+        pipe.run(inseries=True)
+    finally:
+        config.set('execution', 'iterables_batch_size', '0')
+    yield assert_equal(len(pipe._execgraph.nodes()), 3)
+    yield assert_equal(len(os.listdir(os.path.join(temp_dir, 'pipe'))), 5)
+    # a plugin instance runs all batches
+    pipe.base_dir = os.path.join(temp_dir, 'multiproc')
+    config.set('execution', 'iterables_batch_size', '2')
+    try:
+        pipe.run(plugin=MultiProcPlugin(plugin_args={'n_procs': 2}))
+    finally:
+        config.set('execution', 'iterables_batch_size', '0')
+    yield assert_equal(len(os.listdir(os.path.join(temp_dir, 'multiproc',
+                                                   'pipe'))), 5)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_cache_report():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='mod2')
+    mod3 = pe.Node(interface=TestInterface(),name='mod3')
+    pipe.connect([(mod1,mod2,[('output1','input1')]),
+                  (mod2,mod3,[(('output1', lambda x: x[1][1]),'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    report = pipe.cache_report()
+    yield assert_equal(report['cached'], [])
+    yield assert_equal(len(report['rerun']), 3)
+    yield assert_equal(report['unknown_runtime'], 3)
+    pipe.run(inseries=True)
+    report = pipe.cache_report()
+    yield assert_equal(sorted(report['cached']),
+                       ['pipe.mod1', 'pipe.mod2', 'pipe.mod3'])
+    yield assert_equal(report['rerun'], [])
+    # the dependents of a changed node are rerun
+    mod1.inputs.input1 = 2
+    report = pipe.cache_report()
+    yield assert_equal(report['cached'], [])
+    yield assert_equal(report['unknown_runtime'], 0)
+    # nothing was run
+    yield assert_equal(len(glob(os.path.join(temp_dir, 'pipe', 'mod1',
+                                             '_0x*.json'))), 1)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+@parametric
+def test_batch_datagrabber():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    for sid in ['s1', 's2', 's3']:
+        os.makedirs(os.path.join(temp_dir, 'data', sid))
+        open(os.path.join(temp_dir, 'data', sid, 'f.txt'), 'wt').close()
+    pipe = pe.Workflow(name='pipe')
+    infosource = pe.Node(interface=IdentityInterface(fields=['sid']),
+                         name='infosource')
+    infosource.iterables = ('sid', ['s1', 's2', 's3'])
+    datasource = pe.Node(interface=DataGrabber(infields=['sid'],
+                                               outfields=['txt']),
+                         name='datasource')
+    datasource.inputs.base_directory = os.path.join(temp_dir, 'data')
+    datasource.inputs.template = '%s/*.txt'
+    datasource.inputs.template_args['txt'] = [['sid']]
+    datasource.inputs.batch = True
+    sink = pe.Node(interface=IdentityInterface(fields=['txt']), name='sink')
+    pipe.connect([(infosource, datasource, [('sid', 'sid')]),
+                  (datasource, sink, [('txt', 'txt')])])
+    pipe.base_dir = os.getcwd()
+    pipe.run(inseries=True)
+    names = [node.name for node in pipe._execgraph.nodes()]
+    yield assert_equal(names.count('datasource'), 1)
+    yield assert_equal(names.count('sink'), 3)
+    for node in pipe._execgraph.nodes():
+        if node.name == 'sink':
+            sid = node.parameterization[0].split('_')[-1]
+            yield assert_equal(node.get_output('txt'),
+                               os.path.join(temp_dir, 'data', sid, 'f.txt'))
+    yield assert_true(os.path.isdir(os.path.join(temp_dir, 'pipe',
+                                                 'datasource')))
+    yield assert_false(os.path.exists(os.path.join(temp_dir, 'pipe',
+                                                   '_sid_s1', 'datasource')))
     os.chdir(cur_dir)
     rmtree(temp_dir)
 
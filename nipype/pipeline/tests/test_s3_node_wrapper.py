@@ -0,0 +1,245 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the S3 transfers using a fake boto bucket
+"""
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, assert_true, parametric
+import nipype.interfaces.base as nib
+import nipype.pipeline.engine as pe
+import nipype.pipeline.s3_node_wrapper as s3
+from nipype.utils.downloadcache import DownloadCache
+from nipype.utils.filemanip import md5
+
+# the objects of the fake buckets ({(bucket, key): data}) and the requests
+# made to them
+_objects = {}
+_calls = []
+
+class FakeConnection(object):
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 **kwargs):
+        pass
+
+    def get_bucket(self, name):
+        if name == 'forbidden':
+            raise Exception('S3ResponseError: 403 Forbidden')
+        return FakeBucket(name)
+
+class FakeBucket(object):
+    def __init__(self, name):
+        self.name = name
+
+    def get_key(self, name):
+        _calls.append(('get_key', name))
+        if (self.name, name) not in _objects:
+            return None
+        key = FakeKey(self, name)
+        key.size = len(_objects[(self.name, name)])
+        key.etag = '"%s"' % md5(_objects[(self.name, name)]).hexdigest()
+        return key
+
+    def initiate_multipart_upload(self, name):
+        _calls.append(('initiate_multipart_upload', name))
+        upload = FakeMultiPartUpload(self)
+        upload.key_name = name
+        upload.id = 'upload-%d' % len(_calls)
+        FakeMultiPartUpload.parts[upload.id] = {}
+        return upload
+
+class FakeKey(object):
+    def __init__(self, bucket, name=None):
+        self.bucket = bucket
+        self.name = name
+
+    def _set_key(self, name):
+        self.name = name
+
+    key = property(lambda self: self.name, _set_key)
+
+    def get_file(self, fp, headers=None):
+        _calls.append(('get_file', self.name, headers))
+        data = _objects[(self.bucket.name, self.name)]
+        if headers and 'Range' in headers:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        fp.write(data)
+
+    def send_file(self, fp):
+        _calls.append(('send_file', self.name))
+        _objects[(self.bucket.name, self.name)] = fp.read()
+
+class FakeMultiPartUpload(object):
+    # the uploaded parts by upload id
+    parts = {}
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    def upload_part_from_file(self, fp, part_num):
+        _calls.append(('upload_part_from_file', self.key_name, part_num))
+        FakeMultiPartUpload.parts[self.id][part_num] = fp.read()
+
+    def complete_upload(self):
+        _calls.append(('complete_upload', self.key_name))
+        parts = FakeMultiPartUpload.parts.pop(self.id)
+        _objects[(self.bucket.name, self.key_name)] = \
+            ''.join([parts[num] for num in sorted(parts)])
+
+    def cancel_upload(self):
+        _calls.append(('cancel_upload', self.key_name))
+        FakeMultiPartUpload.parts.pop(self.id)
+
+def _install_fake_boto():
+    saved = dict(Connection=s3.Connection, Key=getattr(s3, 'Key', None),
+                 MultiPartUpload=getattr(s3, 'MultiPartUpload', None),
+                 AWS_ACCESS_KEY=os.environ.get('AWS_ACCESS_KEY'),
+                 AWS_SECRET_KEY=os.environ.get('AWS_SECRET_KEY'))
+    s3.Connection = FakeConnection
+    s3.Key = FakeKey
+    s3.MultiPartUpload = FakeMultiPartUpload
+    os.environ['AWS_ACCESS_KEY'] = 'access'
+    os.environ['AWS_SECRET_KEY'] = 'secret'
+    s3._transporters.clear()
+    _objects.clear()
+    del _calls[:]
+    return saved
+
+def _restore_boto(saved):
+    for name in ['Connection', 'Key', 'MultiPartUpload']:
+        setattr(s3, name, saved[name])
+    for name in ['AWS_ACCESS_KEY', 'AWS_SECRET_KEY']:
+        if saved[name] is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = saved[name]
+    s3._transporters.clear()
+
+def _get_calls(name):
+    return [call[1:] for call in _calls if call[0] == name]
+
+@parametric
+def test_s3_get():
+    temp_dir = mkdtemp(prefix='test_s3_')
+    saved = _install_fake_boto()
+    try:
+        data = ''.join([chr(ord('a') + i) for i in range(25)])
+        _objects[('bucket', 'study/s1/func.nii')] = data
+        transporter = s3.S3Transporter(temp_dir, 's3://bucket/study',
+                                       n_threads=3,
+                                       cache=DownloadCache(
+                os.path.join(temp_dir, 'cache')))
+        transporter.part_size = 10
+        path = transporter.get('s1/func.nii')
+        yield assert_equal(path, os.path.join(temp_dir, 's1', 'func.nii'))
+        yield assert_equal(open(path).read(), data)
+        # the parts are downloaded with ranged requests and reassembled
+        yield assert_equal(sorted([call[1]['Range'] \
+                                       for call in _get_calls('get_file')]),
+                           ['bytes=0-9', 'bytes=10-19', 'bytes=20-24'])
+        # the cached file is reused until the object is replaced
+        del _calls[:]
+        path = transporter.get('s1/func.nii', 'copy/func.nii')
+        yield assert_equal(open(path).read(), data)
+        yield assert_equal(_get_calls('get_key'), [('study/s1/func.nii',)])
+        yield assert_equal(_get_calls('get_file'), [])
+        _objects[('bucket', 'study/s1/func.nii')] = 'replaced'
+        path = transporter.get('s1/func.nii', 'new/func.nii')
+        yield assert_equal(open(path).read(), 'replaced')
+        yield assert_equal(_get_calls('get_file'),
+                           [('study/s1/func.nii', None)])
+    finally:
+        _restore_boto(saved)
+        rmtree(temp_dir)
+
+@parametric
+def test_s3_put():
+    temp_dir = mkdtemp(prefix='test_s3_')
+    saved = _install_fake_boto()
+    try:
+        data = ''.join([chr(ord('a') + i) for i in range(25)])
+        local = os.path.join(temp_dir, 'stats.nii')
+        open(local, 'wb').write(data)
+        transporter = s3.S3Transporter(temp_dir, 's3://bucket/study',
+                                       n_threads=3)
+        transporter.part_size = 10
+        transporter.put('results/stats.nii', local)
+        # large files are uploaded in parts
+        yield assert_equal(_get_calls('initiate_multipart_upload'),
+                           [('study/results/stats.nii',)])
+        yield assert_equal(sorted(_get_calls('upload_part_from_file')),
+                           [('study/results/stats.nii', 1),
+                            ('study/results/stats.nii', 2),
+                            ('study/results/stats.nii', 3)])
+        yield assert_equal(_objects[('bucket', 'study/results/stats.nii')],
+                           data)
+        transporter.put('results/small.nii', local, n_threads=1)
+        yield assert_equal(_get_calls('send_file'),
+                           [('study/results/small.nii',)])
+        yield assert_equal(_objects[('bucket', 'study/results/small.nii')],
+                           data)
+    finally:
+        _restore_boto(saved)
+        rmtree(temp_dir)
+
+@parametric
+def test_s3_etag():
+    saved = _install_fake_boto()
+    try:
+        _objects[('bucket', 'data/func.nii')] = 'func'
+        yield assert_equal(s3.s3_etag('s3://bucket/data/func.nii'),
+                           '"%s"' % md5('func').hexdigest())
+        yield assert_equal(s3.s3_etag('s3://bucket/data/missing.nii'), None)
+        # errors of the server do not stop the hashing of a node
+        yield assert_equal(s3.s3_etag('s3://forbidden/data/func.nii'), None)
+        s3._transporters.clear()
+        del os.environ['AWS_ACCESS_KEY']
+        yield assert_equal(s3.s3_etag('s3://bucket/data/func.nii'), None)
+        yield assert_equal(nib._hash_s3_uri('s3://bucket/data/func.nii'),
+                           None)
+    finally:
+        _restore_boto(saved)
+
+class InputSpec(nib.TraitedSpec):
+    in_file = nib.File(exists=True, desc='a file')
+
+class OutputSpec(nib.TraitedSpec):
+    out_file = nib.File(exists=True, desc='a file')
+
+class CopyInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        open('out.txt', 'wt').write(open(self.inputs.in_file).read())
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath('out.txt')
+        return outputs
+
+@parametric
+def test_s3_stage_node_inputs():
+    temp_dir = mkdtemp(prefix='test_s3_')
+    saved = _install_fake_boto()
+    try:
+        _objects[('bucket', 'data/func.nii')] = 'func'
+        node = pe.Node(interface=CopyInterface(), name='copy')
+        node.inputs.in_file = 's3://bucket/data/func.nii'
+        node.base_dir = temp_dir
+        result = node.run()
+        staged = os.path.join(temp_dir, 'copy', '_s3', 'bucket', 'data',
+                              'func.nii')
+        yield assert_true(os.path.exists(staged))
+        yield assert_equal(node.inputs.in_file, staged)
+        yield assert_equal(open(result.outputs.out_file).read(), 'func')
+        yield assert_equal(len(_get_calls('get_file')), 1)
+    finally:
+        _restore_boto(saved)
+        rmtree(temp_dir)
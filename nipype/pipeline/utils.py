@@ -5,7 +5,8 @@
 The `Pipeline` class provides core functionality for batch processing. 
 """
 
-from copy import deepcopy
+from copy import copy, deepcopy
+from itertools import islice
 import logging
 import os
 
@@ -13,8 +14,11 @@ from nipype.utils.misc import package_check
 package_check('networkx', '1.0')
 import networkx as nx
 
-from nipype.interfaces.base import CommandLine
-from nipype.utils.filemanip import fname_presuffix
+from nipype.interfaces.base import CommandLine, Bunch
+from nipype.interfaces.utility import IdentityInterface
+from nipype.utils.config import config
+from nipype.utils.filemanip import fname_presuffix, loadpkl, savepkl, md5
+from nipype.utils.misc import isdefined
 
 logger = logging.getLogger('workflow')
 
@@ -41,6 +45,23 @@ def walk(children, level=0, path=None, usename=True):
         for child_paths in walk(tail, level+1, path, usename):
             yield child_paths
         
+def _clone_graph(graph):
+    """Copy a graph without copying the interfaces of its nodes
+
+    Every node is replaced by its `_lazy_copy`, which shares the interface
+    with the original until the copy modifies it. The edge data are copied.
+
+    Returns
+    -------
+    The copied graph and a dict mapping the original nodes to their copies.
+    """
+    clones = dict([(node, node._lazy_copy()) for node in graph.nodes()])
+    newgraph = nx.DiGraph()
+    newgraph.add_nodes_from(clones.values())
+    for u, v, data in graph.edges_iter(data=True):
+        newgraph.add_edge(clones[u], clones[v], deepcopy(data))
+    return newgraph, clones
+
 def _create_pickleable_graph(graph, show_connectinfo=False):
     """Create a graph that can be pickled.
 
@@ -162,7 +183,8 @@ def _get_valid_pathstr(pathstr):
     pathstr = pathstr.replace(',', '.')
     return pathstr
 
-def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables):
+def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
+                  paramsets=None, start=0):
     """Merges two graphs that share a subset of nodes.
 
     If the subgraph needs to be replicated for multiple iterables, the
@@ -183,6 +205,11 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables):
     Identifier of a node for which parameterization has been sought
     iterables : dict of functions
     see `pipeline.NodeWrapper` for iterable requirements
+    paramsets : list of dicts
+    parameter combinations to use instead of all combinations of the
+    iterables
+    start : int
+    index of the first parameter combination
 
     Returns
     -------
@@ -192,30 +219,26 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables):
     """
     # Retrieve edge information connecting nodes of the subgraph to other
     # nodes of the supergraph.
-    supernodes = supergraph.nodes()
-    ids = [n._id for n in supernodes]
+    subgraphnodes = set(subgraph.nodes())
     edgeinfo = {}
-    for n in subgraph.nodes():
-        nidx = ids.index(n._id)
-        for edge in supergraph.in_edges_iter(supernodes[nidx]):
-                #make sure edge is not part of subgraph
-            if edge[0] not in subgraph.nodes():
-                if n._id not in edgeinfo.keys():
-                    edgeinfo[n._id] = []
-                edgeinfo[n._id].append((edge[0],
-                                       supergraph.get_edge_data(*edge)))
+    for n in subgraphnodes:
+        for u, _, data in supergraph.in_edges_iter(n, data=True):
+            #make sure edge is not part of subgraph
+            if u not in subgraphnodes:
+                edgeinfo.setdefault(n, []).append((u, data))
+    iternode = [n for n in subgraphnodes if n._id == nodeid][0]
     supergraph.remove_nodes_from(nodes)
     # Add copies of the subgraph depending on the number of iterables
-    for i, params in enumerate(walk(iterables.items())):
-        Gc = deepcopy(subgraph)
-        ids = [n._id for n in Gc.nodes()]
-        nodeidx = ids.index(nodeid)
+    if paramsets is None:
+        paramsets = walk(iterables.items())
+    for i, params in enumerate(paramsets, start):
+        Gc, clones = _clone_graph(subgraph)
         paramstr = ''
         for key, val in sorted(params.items()):
             paramstr = '_'.join((paramstr, key,
                                  _get_valid_pathstr(str(val)))) #.replace(os.sep, '_')))
-            Gc.nodes()[nodeidx].set_input(key, val)
-        for n in Gc.nodes():
+            clones[iternode].set_input(key, val)
+        for n in Gc.nodes_iter():
             """
             update parameterization of the node to reflect the location of
             the output directory.  For example, if the iterables along a
@@ -229,52 +252,197 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables):
                 n.parameterization = paramlist + n.parameterization
             else:
                 n.parameterization = paramlist
-        supergraph.add_nodes_from(Gc.nodes())
-        supergraph.add_edges_from(Gc.edges(data=True))
-        for node in Gc.nodes():
-            if node._id in edgeinfo.keys():
-                for info in edgeinfo[node._id]:
-                    supergraph.add_edges_from([(info[0], node, info[1])])
+        supergraph.add_nodes_from(Gc.nodes_iter())
+        supergraph.add_edges_from(Gc.edges_iter(data=True))
+        for n, node in clones.items():
+            if n in edgeinfo:
+                for info in edgeinfo[n]:
+                    supergraph.add_edge(info[0], node, info[1])
             node._id += str(i)
     return supergraph
 
-def _generate_expanded_graph(graph_in):
+def _iterables_dict(iterables):
+    """Convert the iterables of a node to a dict of functions
+    """
+    if isinstance(iterables, tuple):
+        iterables = [iterables]
+    if isinstance(iterables, list):
+        iterables = dict(map(lambda(x):(x[0], lambda:x[1]), iterables))
+    return iterables
+
+def _subgraph(graph, nodes):
+    """Return the subgraph of `graph` induced by `nodes`
+
+    Unlike `graph.subgraph` of networkx 1.0, only the edges of `nodes` are
+    visited, so the expansion of many small subgraphs stays linear.
+    """
+    subgraph = nx.DiGraph()
+    subgraph.add_nodes_from(nodes)
+    for u in nodes:
+        for _, v, data in graph.out_edges_iter(u, data=True):
+            if v in subgraph:
+                subgraph.add_edge(u, v, data)
+    return subgraph
+
+def _generate_expanded_graph(graph_in, paramsets=None):
     """Generates an expanded graph based on node parameterization
     
     Parameterization is controlled using the `iterables` field of the
     pipeline elements.  Thus if there are two nodes with iterables a=[1,2]
     and b=[3,4] this procedure will generate a graph with sub-graphs
     parameterized as (a=1,b=3), (a=1,b=4), (a=2,b=3) and (a=2,b=4). 
+
+    `paramsets` optionally maps a node to a tuple (start, list of parameter
+    dicts) that replaces the combinations of the iterables of that node.
     """
     logger.debug("PE: expanding iterables")
-    moreiterables = True
     # convert list of tuples to dict fields
     for node in graph_in.nodes():
-        if isinstance(node.iterables, tuple):
-            node.iterables = [node.iterables]
-    for node in graph_in.nodes():
-        if isinstance(node.iterables, list):
-            node.iterables = dict(map(lambda(x):(x[0], lambda:x[1]),
-                                      node.iterables))
-    while moreiterables:
-        nodes = nx.topological_sort(graph_in)
-        nodes.reverse()
-        inodes = [node for node in nodes if len(node.iterables.keys())>0]
-        if inodes:
-            node = inodes[0]
-            iterables = node.iterables.copy()
-            node.iterables = {}
-            node._id += 'I'
-            subnodes = nx.dfs_preorder(graph_in, node)
-            subgraph = graph_in.subgraph(subnodes)
-            graph_in = _merge_graphs(graph_in, subnodes,
-                                     subgraph, node._id,
-                                     iterables)
-        else:
-            moreiterables = False
+        node.iterables = _iterables_dict(node.iterables)
+    # Expanding a node only copies its descendants, so the nodes preceding
+    # it in topological order remain in the graph and a single sort suffices
+    nodes = nx.topological_sort(graph_in)
+    nodes.reverse()
+    inodes = [node for node in nodes if len(node.iterables.keys())>0]
+    for node in inodes:
+        iterables = node.iterables.copy()
+        start, params = 0, None
+        if paramsets and node in paramsets:
+            start, params = paramsets[node]
+        node.iterables = {}
+        node._id += 'I'
+        subnodes = nx.dfs_preorder(graph_in, node)
+        subgraph = _subgraph(graph_in, subnodes)
+        graph_in = _merge_graphs(graph_in, subnodes,
+                                 subgraph, node._id,
+                                 iterables, paramsets=params, start=start)
     logger.debug("PE: expanding iterables ... done")
     return graph_in
 
+def _generate_expanded_batches(graph_in, batch_size):
+    """Generates expanded graphs for batches of parameterizations
+
+    The combinations of the iterables of the first node with iterables (in
+    topological order) are generated lazily and split into batches of at
+    most `batch_size` combinations. Every expanded graph contains one batch;
+    the iterables of all other nodes are expanded completely. The flat
+    graph `graph_in` is not modified.
+    """
+    inodes = [node for node in nx.topological_sort(graph_in) \
+                  if _iterables_dict(node.iterables)]
+    if not inodes:
+        yield _generate_expanded_graph(_clone_graph(graph_in)[0])
+        return
+    paramsets = walk(_iterables_dict(inodes[0].iterables).items())
+    start = 0
+    while True:
+        batch = list(islice(paramsets, batch_size))
+        if not batch:
+            break
+        logger.debug('PE: expanding parameterizations %d-%d of %s' % \
+                         (start, start + len(batch) - 1, inodes[0]))
+        graph, clones = _clone_graph(graph_in)
+        yield _generate_expanded_graph(graph,
+                                       paramsets={clones[inodes[0]]: \
+                                                      (start, batch)})
+        start += len(batch)
+
+def _static_output(graph, node, sourceinfo):
+    """Return whether an output of a node is known before the node runs
+    and its value
+
+    The outputs of IdentityInterface nodes are known if the corresponding
+    input is set (e.g., by iterables) or connected to a known output.
+    """
+    if not isinstance(node._interface, IdentityInterface):
+        return False, None
+    field = sourceinfo
+    if isinstance(sourceinfo, tuple):
+        field = sourceinfo[0]
+    connected = False
+    for u, _, data in graph.in_edges_iter(node, data=True):
+        for source, dest in data['connect']:
+            if dest == field:
+                connected, val = _static_output(graph, u, source)
+                if not connected:
+                    return False, None
+    if not connected:
+        val = getattr(node.inputs, field)
+        if not isdefined(val):
+            return False, None
+    if isinstance(sourceinfo, tuple):
+        val = sourceinfo[1](val, *sourceinfo[2:])
+    return True, val
+
+def _static_inputs(graph, node):
+    """Return the inputs of a node if they are all known before running
+    or None
+    """
+    inputs = node.inputs.get()
+    for u, _, data in graph.in_edges_iter(node, data=True):
+        for sourceinfo, dest in data['connect']:
+            known, val = _static_output(graph, u, sourceinfo)
+            if not known:
+                return None
+            inputs[dest] = val
+    return inputs
+
+def _select_batch_output(values, index, func=None, *args):
+    """Return the output of one copy from the outputs of a batch node"""
+    val = values[index]
+    if func:
+        val = func(val, *args)
+    return val
+
+def _merge_batch_nodes(graph):
+    """Replace the copies of a node that supports batch mode by one node
+
+    Expanding iterables copies a node once per parameterization. If the
+    interface of the copies returns an interface resolving all of them
+    from `batch_interface` (see `DataGrabber`), they are replaced by a node
+    running that interface. The successors of every copy are connected to
+    its item of the list outputs of the batch node. Copies whose inputs
+    depend on outputs of other nodes than IdentityInterfaces are kept.
+    """
+    groups = {}
+    for node in graph.nodes():
+        if node.parameterization and not hasattr(node, 'iterfield') and \
+                hasattr(node._interface, 'batch_interface'):
+            groups.setdefault((node._hierarchy, node.name), []).append(node)
+    for nodes in groups.values():
+        if len(nodes) < 2:
+            continue
+        nodes.sort(key=lambda node: node.parameterization)
+        inputsets = [_static_inputs(graph, node) for node in nodes]
+        if None in inputsets:
+            continue
+        interface = nodes[0]._interface.batch_interface(inputsets)
+        if interface is None:
+            continue
+        logger.debug('PE: merging %d copies of %s' % (len(nodes), nodes[0]))
+        batchnode = nodes[0]._lazy_copy()
+        batchnode._interface = interface
+        batchnode._interface_shared = False
+        batchnode.parameterization = None
+        batchnode._id = nodes[0].name
+        graph.add_node(batchnode)
+        for i, node in enumerate(nodes):
+            for _, v, data in graph.out_edges_iter(node, data=True):
+                connect = []
+                for sourceinfo, dest in data['connect']:
+                    if isinstance(sourceinfo, tuple):
+                        sourceinfo = (sourceinfo[0], _select_batch_output,
+                                      i) + sourceinfo[1:]
+                    else:
+                        sourceinfo = (sourceinfo, _select_batch_output, i)
+                    connect.append((sourceinfo, dest))
+                if graph.has_edge(batchnode, v):
+                    graph[batchnode][v]['connect'].extend(connect)
+                else:
+                    graph.add_edge(batchnode, v, connect=connect)
+        graph.remove_nodes_from(nodes)
+    return graph
+
 def export_graph(graph_in, base_dir=None, show = False, use_execgraph=False,
                  show_connectinfo=False, dotfilename='graph.dot'):
     """ Displays the graph layout of the pipeline
@@ -346,6 +514,61 @@ def _report_nodes_not_run(notrun):
         logger.info("***********************************")
 
 
+_compresslevels = dict(gzip=9, fast=1, none=0)
+
+def save_resultfile(resultsfile, result, environ_dir=None):
+    """Save the result of a node
+
+    The file is compressed as set by the result_compression option of the
+    config file. If `environ_dir` is given, the environment of the runtime
+    is saved only once in that directory, named after its hash, and
+    `runtime.environ_file` of the saved result refers to it relative to the
+    directory of `resultsfile`. `load_resultfile` restores the environment.
+    """
+    compression = config.get('execution', 'result_compression').lower()
+    if compression not in _compresslevels:
+        raise ValueError('Unknown result compression: %s' % compression)
+    runtime = getattr(result, 'runtime', None)
+    if environ_dir and isinstance(getattr(runtime, 'environ', None), dict):
+        environ = runtime.environ
+        environ_file = os.path.join(environ_dir, 'environ_%s.pklz' % \
+                                        md5(str(sorted(environ.items()))
+                                            ).hexdigest())
+        if not os.path.exists(environ_file):
+            if not os.path.exists(environ_dir):
+                try:
+                    os.makedirs(environ_dir)
+                except OSError:
+                    # created by another process
+                    pass
+            tmpfile = '%s_%d_tmp.pklz' % (environ_file[:-5], os.getpid())
+            savepkl(tmpfile, environ)
+            os.rename(tmpfile, environ_file)
+        result = copy(result)
+        result.runtime = Bunch(**runtime.dictcopy())
+        result.runtime.environ = None
+        result.runtime.environ_file = os.path.relpath(
+            environ_file, os.path.dirname(os.path.abspath(resultsfile)))
+    savepkl(resultsfile, result, _compresslevels[compression])
+
+def load_resultfile(resultsfile):
+    """Load the result of a node saved with `save_resultfile`
+
+    The environment saved separately is restored into `runtime.environ`.
+    """
+    result = loadpkl(resultsfile)
+    runtime = getattr(result, 'runtime', None)
+    environ_file = getattr(runtime, 'environ_file', None)
+    if environ_file and runtime.environ is None:
+        environ_file = os.path.join(os.path.dirname(os.path.abspath(
+                    resultsfile)), environ_file)
+        try:
+            runtime.environ = loadpkl(environ_file)
+        except Exception, e:
+            logger.warn('Could not read the environment %s: %s' % \
+                            (environ_file, e))
+    return result
+
 def make_output_dir(outdir):
     """Make the output_dir if it doesn't exist.
 
@@ -4,7 +4,7 @@
 Created on 20 Apr 2010
 
 logging options : INFO, DEBUG
-hash_method : content, timestamp
+hash_method : content, fast, timestamp
 
 @author: Chris Filo Gorgolewski
 '''
@@ -22,6 +22,18 @@ stop_on_first_crash = false
 hash_method = content
 single_thread_matlab = true
 run_in_series = false
+iterables_batch_size = 0
+hash_cache_file =
+hash_cache_size = 10000
+result_cache_dir =
+result_cache_max_gb = 0
+result_cache_link = reflink
+result_compression = gzip
+provenance = full
+copy_staging = reflink
+file_index_dir =
+download_cache_dir =
+download_cache_max_gb = 0
 """)
 
 config = ConfigParser.ConfigParser()
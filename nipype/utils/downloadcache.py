@@ -0,0 +1,126 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Cache of files downloaded from remote storage
+
+Data sources that download files (e.g., XNATSource) download them again in
+every working directory. If the ``download_cache_dir`` option of the
+execution section of the config file is set, downloaded files are stored in
+that directory, keyed by their URI and a checksum (or other version
+information) reported by the server, so that every version of a file is
+downloaded once. The least recently used files are removed when the cache
+exceeds ``download_cache_max_gb``.
+"""
+import logging
+import os
+import shutil
+from glob import glob
+from thread import get_ident
+
+from nipype.utils.config import config
+from nipype.utils.filemanip import md5
+
+fmlogger = logging.getLogger("filemanip")
+
+class DownloadCache(object):
+    """Content addressed store of downloaded files
+
+    Parameters
+    ----------
+    root : str
+        directory of the cache
+    max_gb : float
+        size of the cache above which the least recently used files are
+        removed when a file is added (default: 0, unlimited)
+
+    Examples
+    --------
+
+    >>> cache = DownloadCache('/data/nipype_downloads') # doctest: +SKIP
+    >>> path = cache.get(uri, etag, lambda dest: fetch(uri, dest)) # doctest: +SKIP
+
+    """
+
+    def __init__(self, root, max_gb=0):
+        self.root = os.path.abspath(root)
+        self.max_gb = max_gb
+
+    def _entry_dir(self, uri, version):
+        key = md5('%s\n%s' % (uri, version)).hexdigest()
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, uri, version, download):
+        """Return the path of the cached file of `uri`
+
+        If the file is not cached in the given `version`, `download` is
+        called with the path to write the file to. Files are stored under
+        the last component of `uri`.
+        """
+        entrydir = self._entry_dir(uri, version)
+        filename = os.path.join(entrydir,
+                                os.path.basename(uri.rstrip('/')) or 'file')
+        if os.path.exists(filename):
+            # the modification time of the entry orders the files by use
+            os.utime(entrydir, None)
+            return filename
+        tmpdir = '%s.%d.%d' % (entrydir, os.getpid(), get_ident())
+        if not os.path.exists(tmpdir):
+            os.makedirs(tmpdir)
+        try:
+            fmlogger.debug('Downloading %s' % uri)
+            download(os.path.join(tmpdir, os.path.basename(filename)))
+            try:
+                os.rename(tmpdir, entrydir)
+            except OSError:
+                # another process or thread stored the same file
+                if not os.path.exists(filename):
+                    raise
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        if self.max_gb:
+            self.prune(self.max_gb)
+        return filename
+
+    def entries(self):
+        """Return (path, size, last use) of the cached files, least recently
+        used first"""
+        entries = []
+        for entrydir in glob(os.path.join(self.root, '??', '*')):
+            if '.' in os.path.basename(entrydir):
+                # an incomplete download
+                continue
+            try:
+                atime = os.path.getmtime(entrydir)
+                for name in os.listdir(entrydir):
+                    filename = os.path.join(entrydir, name)
+                    entries.append((filename, os.path.getsize(filename),
+                                    atime))
+            except OSError:
+                continue
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def prune(self, max_gb):
+        """Remove the least recently used files until the cache is smaller
+        than `max_gb`. Returns the number of removed files.
+        """
+        entries = self.entries()
+        total = sum([entry[1] for entry in entries])
+        maxsize = max_gb * 1024 ** 3
+        removed = 0
+        for filename, size, _ in entries:
+            if total <= maxsize:
+                break
+            shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+def get_download_cache():
+    """Return the download cache configured in the config file or None"""
+    root = config.get('execution', 'download_cache_dir').strip()
+    if not root:
+        return None
+    return DownloadCache(os.path.expanduser(root),
+                         max_gb=config.getfloat('execution',
+                                                'download_cache_max_gb'))
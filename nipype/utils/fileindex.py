@@ -0,0 +1,185 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Index of the files in a directory tree
+
+Every DataGrabber run globs its templates, i.e., lists the directories of
+the data store again. On network file systems listing large directories
+is slow, and a workflow with many subjects lists the same directories once
+per subject and output field.
+
+A file index keeps the listing of every directory it has visited together
+with the modification time of the directory. Templates are matched against
+the listings in memory; a directory is only listed again when its
+modification time changed, i.e., when entries were added, removed or
+renamed. If the ``file_index_dir`` option of the execution section of the
+config file is set, the listings are also stored in that directory and
+shared by all processes and subsequent runs.
+"""
+import fnmatch
+import glob
+import logging
+import os
+from time import time
+
+from nipype.utils.config import config
+from nipype.utils.filemanip import loadpkl, savepkl, md5
+
+fmlogger = logging.getLogger("filemanip")
+
+class FileIndex(object):
+    """Cached directory listings of a directory tree
+
+    Parameters
+    ----------
+    root : str
+        directory of the tree
+    filename : str
+        file storing the listings across processes (default: keep the
+        listings in memory only)
+
+    Examples
+    --------
+
+    >>> index = FileIndex('/data/study') # doctest: +SKIP
+    >>> index.scan() # doctest: +SKIP
+    >>> index.glob('/data/study/s1/func/*.nii') # doctest: +SKIP
+    ['/data/study/s1/func/f3.nii', '/data/study/s1/func/f5.nii']
+
+    """
+
+    def __init__(self, root, filename=None):
+        self.root = os.path.abspath(root)
+        self.filename = filename
+        self.listings = 0
+        self._dirs = {}
+        self._dirty = False
+        if filename and os.path.exists(filename):
+            try:
+                index = loadpkl(filename)
+                if index['root'] == self.root:
+                    self._dirs = index['dirs']
+            except Exception, e:
+                fmlogger.debug('Could not read file index %s: %s' % \
+                                   (filename, e))
+
+    def scan(self):
+        """List every directory of the tree that changed since its last
+        listing. Symbolic links to directories are not followed."""
+        for dirpath, dirnames, _ in os.walk(self.root):
+            self._listdir(os.path.relpath(dirpath, self.root))
+        self.save()
+
+    def glob(self, pattern):
+        """Return the paths matching `pattern` like :func:`glob.glob`
+
+        Patterns outside of the root directory or that are not normalized
+        are passed to :func:`glob.glob`.
+        """
+        if os.path.normpath(pattern) != pattern or \
+                not pattern.startswith(self.root + os.sep):
+            return glob.glob(pattern)
+        parts = pattern[len(self.root) + 1:].split(os.sep)
+        dirs = ['.']
+        for part in parts[:-1]:
+            subdirs = []
+            for reldir in dirs:
+                if glob.has_magic(part):
+                    names = _filter(self._listdir(reldir), part)
+                else:
+                    names = [part]
+                for name in names:
+                    subdir = _join(reldir, name)
+                    if os.path.isdir(os.path.join(self.root, subdir)):
+                        subdirs.append(subdir)
+            dirs = subdirs
+        matches = []
+        for reldir in dirs:
+            names = self._listdir(reldir)
+            if glob.has_magic(parts[-1]):
+                names = _filter(names, parts[-1])
+            elif names is not None and parts[-1] in names:
+                names = [parts[-1]]
+            else:
+                names = []
+            for name in names:
+                matches.append(os.path.join(self.root, _join(reldir, name)))
+        return matches
+
+    def save(self):
+        """Store the listings if a file is set and they changed"""
+        if not self.filename or not self._dirty:
+            return
+        tmpfile = '%s.%d' % (self.filename, os.getpid())
+        try:
+            savepkl(tmpfile, dict(root=self.root, dirs=self._dirs))
+            os.rename(tmpfile, self.filename)
+            self._dirty = False
+        except (IOError, OSError), e:
+            fmlogger.debug('Could not write file index %s: %s' % \
+                               (self.filename, e))
+
+    def _listdir(self, reldir):
+        """Return the names in `reldir` or None if it is not a directory
+
+        The directory is only listed if its modification time changed.
+        """
+        path = os.path.join(self.root, reldir)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._forget(reldir)
+            return None
+        if reldir in self._dirs and self._dirs[reldir][0] == mtime:
+            return self._dirs[reldir][1]
+        try:
+            names = os.listdir(path)
+        except OSError:
+            self._forget(reldir)
+            return None
+        self.listings += 1
+        if time() - mtime < 2:
+            # changes within the resolution of the modification time of
+            # some file systems would go unnoticed
+            mtime = None
+        self._dirs[reldir] = (mtime, names)
+        self._dirty = True
+        return names
+
+    def _forget(self, reldir):
+        if reldir in self._dirs:
+            del self._dirs[reldir]
+            self._dirty = True
+
+def _join(reldir, name):
+    if reldir == '.':
+        return name
+    return os.path.join(reldir, name)
+
+def _filter(names, pattern):
+    """Filter names like glob, which hides dot files"""
+    if names is None:
+        return []
+    if pattern[0] != '.':
+        names = [name for name in names if name[0] != '.']
+    return fnmatch.filter(names, pattern)
+
+_indexes = {}
+
+def get_file_index(root):
+    """Return the file index of `root`
+
+    The index is stored in the ``file_index_dir`` of the config file if
+    it is set.
+    """
+    root = os.path.abspath(root)
+    indexdir = config.get('execution', 'file_index_dir').strip()
+    filename = None
+    if indexdir:
+        indexdir = os.path.abspath(os.path.expanduser(indexdir))
+        if not os.path.exists(indexdir):
+            os.makedirs(indexdir)
+        filename = os.path.join(indexdir,
+                                'index_%s.pklz' % md5(root).hexdigest())
+    if root not in _indexes or _indexes[root].filename != filename:
+        _indexes[root] = FileIndex(root, filename)
+    return _indexes[root]
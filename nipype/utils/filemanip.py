@@ -3,11 +3,19 @@
 """Miscellaneous file manipulation functions
 
 """
+import cPickle
+import gzip
 import os
 import re
 import shutil
+import sys
 from glob import glob
 import logging
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from nipype.utils.config import config
 from nipype.utils.misc import isdefined
 # The md5 module is deprecated in Python 2.6, but hashlib is only
 # available as an external package for versions of python before 2.6.
@@ -155,6 +163,32 @@ def hash_infile(afile, chunk_len=8192):
         md5hex = md5obj.hexdigest()
     return md5hex
 
+def hash_infile_fast(afile, nblocks=16, block_len=65536):
+    """ Computes md5 hash of the size and sampled blocks of a file
+
+    The hash covers the size of the file, its first block (containing the
+    header of most image formats) and `nblocks` blocks at evenly spaced
+    offsets, including the last block. Files smaller than the sampled
+    blocks are hashed completely, like in `hash_infile`. Changes that leave
+    the size and all sampled blocks intact are not detected.
+    """
+    md5hex = None
+    if os.path.isfile(afile):
+        size = os.path.getsize(afile)
+        if size <= (nblocks + 1) * block_len:
+            return hash_infile(afile, chunk_len=block_len)
+        md5obj = md5()
+        md5obj.update(str(size))
+        fp = file(afile, 'rb')
+        md5obj.update(fp.read(block_len))
+        step = (size - block_len) / nblocks
+        for i in range(1, nblocks + 1):
+            fp.seek(i * step)
+            md5obj.update(fp.read(block_len))
+        fp.close()
+        md5hex = md5obj.hexdigest()
+    return md5hex
+
 def hash_timestamp(afile):
     """ Computes md5 hash of the timestamp of a file """
     md5hex = None
@@ -167,7 +201,33 @@ def hash_timestamp(afile):
         md5hex = md5obj.hexdigest()
     return md5hex
 
-def copyfile(originalfile, newfile, copy=False):
+# ioctl request cloning the extents of a file (Linux, btrfs/xfs)
+FICLONE = 0x40049409
+
+def _reflink(originalfile, newfile):
+    """Create ``newfile`` as a copy-on-write clone of ``originalfile``
+
+    Returns False if the file system does not support it.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        src = open(originalfile, 'rb')
+        try:
+            dst = open(newfile, 'wb')
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    except (IOError, OSError):
+        if os.path.exists(newfile):
+            os.unlink(newfile)
+        return False
+    return True
+
+def copyfile(originalfile, newfile, copy=False, staging=None):
     """Copy or symlink ``originalfile`` to ``newfile``.
 
     Parameters
@@ -179,11 +239,18 @@ def copyfile(originalfile, newfile, copy=False):
     copy : Bool
         specifies whether to copy or symlink files
         (default=False) but only for posix systems
-         
+    staging : str
+        how copies are made: 'copy' copies the data, 'reflink' creates a
+        copy-on-write clone if the file system supports it and 'hardlink'
+        also tries a hard link before copying. Hard links share the data
+        with the original, which must therefore not be modified in place.
+        (default: the copy_staging option of the config file)
+
     Returns
     -------
-    None
-    
+    method : str
+        'symlink', 'reflink', 'hardlink' or 'copy'
+
     """
     if os.path.lexists(newfile):
         fmlogger.warn("File: %s already exists, overwriting with %s, copy:%d" \
@@ -192,20 +259,42 @@ def copyfile(originalfile, newfile, copy=False):
         if os.path.lexists(newfile):
             os.unlink(newfile)
         os.symlink(originalfile,newfile)
+        method = 'symlink'
     else:
-        try:
-            shutil.copyfile(originalfile, newfile)
-        except shutil.Error, e:
-            fmlogger.warn(e.message)
-        
+        if staging is None:
+            staging = config.get('execution', 'copy_staging').lower()
+        if staging not in ['copy', 'reflink', 'hardlink']:
+            raise ValueError('Unknown copy staging: %s' % staging)
+        method = 'copy'
+        if os.path.lexists(newfile) and (os.path.islink(newfile) or \
+                os.path.realpath(newfile) != os.path.realpath(originalfile)):
+            # do not write through links into other files
+            os.unlink(newfile)
+        if staging != 'copy' and not os.path.lexists(newfile) and \
+                _reflink(originalfile, newfile):
+            method = 'reflink'
+        elif staging == 'hardlink' and not os.path.lexists(newfile):
+            try:
+                os.link(originalfile, newfile)
+                method = 'hardlink'
+            except OSError:
+                pass
+        if method == 'copy':
+            try:
+                shutil.copyfile(originalfile, newfile)
+            except shutil.Error, e:
+                fmlogger.warn(e.message)
+    fmlogger.debug('Staged %s as %s (%s)' % (originalfile, newfile, method))
+
     if originalfile.endswith(".img"):
         hdrofile = originalfile[:-4] + ".hdr"
         hdrnfile = newfile[:-4] + ".hdr"
         matofile = originalfile[:-4] + ".mat"
         if os.path.exists(matofile):
             matnfile = newfile[:-4] + ".mat"
-            copyfile(matofile, matnfile, copy)
-        copyfile(hdrofile, hdrnfile, copy)
+            copyfile(matofile, matnfile, copy, staging)
+        copyfile(hdrofile, hdrnfile, copy, staging)
+    return method
 
 def copyfiles(filelist, dest, copy=False):
     """Copy or symlink files in ``filelist`` to ``dest`` directory.
@@ -309,6 +398,35 @@ def load_json(filename):
     fp.close()
     return data
 
+def loadpkl(infile):
+    """Load a zipped or plain cPickled file
+
+    Compressed files are recognized by their content, not their name.
+    """
+    pkl_file = open(infile, 'rb')
+    compressed = pkl_file.read(2) == '\x1f\x8b'
+    pkl_file.close()
+    if compressed:
+        pkl_file = gzip.open(infile, 'rb')
+    else:
+        pkl_file = open(infile, 'rb')
+    result = cPickle.load(pkl_file)
+    pkl_file.close()
+    return result
+
+def savepkl(filename, record, compresslevel=9):
+    """Save an object to a zipped or plain cPickled file
+
+    Files ending with pklz are compressed with gzip unless `compresslevel`
+    is 0. The highest pickle protocol is used.
+    """
+    if filename.endswith('pklz') and compresslevel:
+        pkl_file = gzip.open(filename, 'wb', compresslevel)
+    else:
+        pkl_file = open(filename, 'wb')
+    cPickle.dump(record, pkl_file, cPickle.HIGHEST_PROTOCOL)
+    pkl_file.close()
+
 def loadflat(infile, *args):
     """Load an npz file into a dict
     """
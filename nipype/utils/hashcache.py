@@ -0,0 +1,237 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Cache of file hashes
+
+Hashing the content of an input file requires reading the whole file, and
+the same files are hashed every time the inputs of a node are hashed. The
+cache stores the hash of a file under its path, inode, size and
+modification time, so that an unchanged file is read only once.
+
+The hashes are kept in memory and, if the ``hash_cache_file`` option of
+the execution section of the config file is set, in a sqlite database
+that is shared by all processes using the same file. Both are limited to
+``hash_cache_size`` entries; the least recently used entries are evicted.
+The cache can be used from several threads.
+"""
+import logging
+import os
+import threading
+from time import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from nipype.utils.config import config
+from nipype.utils.filemanip import (hash_infile, hash_infile_fast,
+                                    hash_timestamp)
+
+fmlogger = logging.getLogger("filemanip")
+
+class FileHashCache(object):
+    """Least recently used cache of file hashes
+
+    Parameters
+    ----------
+    filename : str
+        sqlite database storing the hashes across processes (default: keep
+        the hashes in memory only)
+    maxsize : int
+        maximum number of hashes to store
+
+    Examples
+    --------
+
+    >>> cache = FileHashCache()
+    >>> hash = cache.get_hash('functional.nii', 'content', hash_infile) # doctest: +SKIP
+    >>> cache.hits, cache.misses # doctest: +SKIP
+    (0, 1)
+
+    """
+
+    def __init__(self, filename=None, maxsize=10000):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+        self._tick = 0
+        # guards the memory cache and the counters
+        self._lock = threading.Lock()
+        # sqlite connections cannot be shared by threads
+        self._local = threading.local()
+        self._db_inserts = 0
+        self._db_failed = False
+
+    def get_hash(self, afile, method, hashfunc):
+        """Return the hash of a file computed by `hashfunc`
+
+        The hash is only computed if no hash is stored for the current
+        state of the file. `method` distinguishes hashes of different
+        functions.
+        """
+        stat = os.stat(afile)
+        key = (os.path.abspath(afile), stat.st_ino, stat.st_size,
+               stat.st_mtime, method)
+        hash = self._lookup(key)
+        if hash is None:
+            hash = hashfunc(afile)
+            self._store(key, hash)
+        return hash
+
+    def clear(self):
+        """Remove all hashes and reset the counters"""
+        self._lock.acquire()
+        try:
+            self._memory = {}
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+        db = self._connect()
+        if db:
+            try:
+                db.execute('DELETE FROM hashes')
+                db.commit()
+            except sqlite3.Error, e:
+                fmlogger.debug('Could not clear hash cache: %s' % e)
+
+    def _lookup(self, key):
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            if key in self._memory:
+                self._memory[key][1] = self._tick
+                self.hits += 1
+                return self._memory[key][0]
+        finally:
+            self._lock.release()
+        db = self._connect()
+        if not db:
+            self._count_miss()
+            return None
+        try:
+            row = db.execute('SELECT hash FROM hashes WHERE path=? AND '
+                             'inode=? AND size=? AND mtime=? AND method=?',
+                             key).fetchone()
+            if row is None:
+                self._count_miss()
+                return None
+            db.execute('UPDATE hashes SET atime=? WHERE path=? AND '
+                       'method=?', (time(), key[0], key[4]))
+            db.commit()
+        except sqlite3.Error, e:
+            fmlogger.debug('Could not read hash cache: %s' % e)
+            self._count_miss()
+            return None
+        self._lock.acquire()
+        try:
+            self.hits += 1
+            self._remember(key, str(row[0]))
+        finally:
+            self._lock.release()
+        return str(row[0])
+
+    def _count_miss(self):
+        self._lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+    def _store(self, key, hash):
+        self._lock.acquire()
+        try:
+            self._remember(key, hash)
+            self._db_inserts += 1
+            prune = self._db_inserts % 100 == 0
+        finally:
+            self._lock.release()
+        db = self._connect()
+        if not db:
+            return
+        try:
+            db.execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)',
+                       key + (hash, time()))
+            if prune:
+                db.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid '
+                           'FROM hashes ORDER BY atime DESC LIMIT -1 '
+                           'OFFSET ?)', (self.maxsize,))
+            db.commit()
+        except sqlite3.Error, e:
+            fmlogger.debug('Could not write hash cache: %s' % e)
+
+    def _remember(self, key, hash):
+        """Add a hash to the memory cache; the lock must be held"""
+        self._memory[key] = [hash, self._tick]
+        if len(self._memory) > self.maxsize:
+            # evict the least recently used tenth
+            ticks = sorted([item[1] for item in self._memory.values()])
+            oldest = ticks[max(1, len(ticks) / 10) - 1]
+            for oldkey, item in self._memory.items():
+                if item[1] <= oldest:
+                    del self._memory[oldkey]
+
+    def _connect(self):
+        """Return the database connection of this thread or None"""
+        if not self.filename or sqlite3 is None or self._db_failed:
+            return None
+        # connections must not be shared with other threads or forked
+        # processes
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            try:
+                db = sqlite3.connect(self.filename, timeout=30)
+                db.execute('CREATE TABLE IF NOT EXISTS hashes '
+                           '(path TEXT, inode INTEGER, size INTEGER, '
+                           'mtime REAL, method TEXT, hash TEXT, '
+                           'atime REAL, PRIMARY KEY (path, method))')
+                db.commit()
+            except sqlite3.Error, e:
+                fmlogger.warn('Could not open hash cache %s: %s' % \
+                                  (self.filename, e))
+                self._db_failed = True
+                return None
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_hash_cache():
+    """Return the file hash cache configured in the config file
+
+    Threads calling this at the same time get the same cache.
+    """
+    global _cache
+    filename = config.get('execution', 'hash_cache_file').strip()
+    if filename:
+        filename = os.path.abspath(os.path.expanduser(filename))
+    else:
+        filename = None
+    maxsize = config.getint('execution', 'hash_cache_size')
+    _cache_lock.acquire()
+    try:
+        if _cache is None or _cache.filename != filename:
+            _cache = FileHashCache(filename, maxsize=maxsize)
+        _cache.maxsize = maxsize
+        return _cache
+    finally:
+        _cache_lock.release()
+
+def hash_file(afile, method=None):
+    """Hash a file with the hash_method of the config file
+
+    Content and fast hashes are looked up in the file hash cache.
+    """
+    if method is None:
+        method = config.get('execution', 'hash_method').lower()
+    if method == 'timestamp':
+        return hash_timestamp(afile)
+    elif method == 'content':
+        return get_hash_cache().get_hash(afile, method, hash_infile)
+    elif method == 'fast':
+        return get_hash_cache().get_hash(afile, method, hash_infile_fast)
+    raise Exception("Unknown hash method: %s" % method)
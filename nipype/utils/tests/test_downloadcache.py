@@ -0,0 +1,63 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from tempfile import mkdtemp
+from shutil import rmtree, copyfileobj
+import threading
+import urllib2
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from nipype.testing import assert_equal, assert_true, parametric
+from nipype.utils.downloadcache import DownloadCache
+
+class DirectoryHandler(SimpleHTTPRequestHandler):
+    directory = None
+
+    def translate_path(self, path):
+        return os.path.join(self.directory, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+def _serve(directory):
+    """Serve `directory` over HTTP on a free local port"""
+    class Handler(DirectoryHandler):
+        pass
+    Handler.directory = directory
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+@parametric
+def test_download_cache():
+    tmpdir = mkdtemp()
+    os.mkdir(os.path.join(tmpdir, 'remote'))
+    open(os.path.join(tmpdir, 'remote', 'f.nii'), 'wt').write('first')
+    server = _serve(os.path.join(tmpdir, 'remote'))
+    url = 'http://127.0.0.1:%d/f.nii' % server.server_address[1]
+    downloads = []
+    def download(dest):
+        downloads.append(dest)
+        copyfileobj(urllib2.urlopen(url), open(dest, 'wb'))
+    try:
+        cache = DownloadCache(os.path.join(tmpdir, 'cache'))
+        fname = cache.get(url, 'size:5', download)
+        yield assert_equal(os.path.basename(fname), 'f.nii')
+        yield assert_equal(open(fname).read(), 'first')
+        yield assert_equal(cache.get(url, 'size:5', download), fname)
+        yield assert_equal(len(downloads), 1)
+        # a new version is downloaded again
+        open(os.path.join(tmpdir, 'remote', 'f.nii'), 'wt').write('second')
+        fname2 = cache.get(url, 'size:6', download)
+        yield assert_equal(open(fname2).read(), 'second')
+        yield assert_equal(len(downloads), 2)
+        yield assert_equal(len(cache.entries()), 2)
+        yield assert_equal(cache.prune(0), 2)
+        yield assert_true(not os.path.exists(fname2))
+    finally:
+        server.shutdown()
+        server.server_close()
+        rmtree(tmpdir)
@@ -0,0 +1,68 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import glob
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, parametric
+from nipype.utils.fileindex import FileIndex
+
+def _make_tree(root):
+    for sid in ['s1', 's2', '.hidden']:
+        os.makedirs(os.path.join(root, sid, 'func'))
+        for fname in ['struct.nii', os.path.join('func', 'f3.nii'),
+                      os.path.join('func', 'f5.nii')]:
+            open(os.path.join(root, sid, fname), 'wt').close()
+    _age(root)
+
+def _age(root):
+    """Date back the directories so that their listings are kept"""
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (0, 0))
+
+@parametric
+def test_file_index_glob():
+    root = mkdtemp()
+    _make_tree(root)
+    index = FileIndex(root)
+    for template in ['*', '*/struct.nii', 's1/func/*.nii', '*/*/f?.nii',
+                     's2/func/f5.nii', 's3/func/*.nii', '.*/func/*',
+                     's1/struct.nii/*', 's[12]/*']:
+        pattern = os.path.join(root, template)
+        yield assert_equal(sorted(index.glob(pattern)),
+                           sorted(glob.glob(pattern)))
+    listings = index.listings
+    yield assert_equal(listings, 6)
+    yield assert_equal(sorted(index.glob(os.path.join(root, '*', 'func',
+                                                      '*.nii'))),
+                       sorted(glob.glob(os.path.join(root, '*', 'func',
+                                                     '*.nii'))))
+    yield assert_equal(index.listings, listings)
+    # new files are found
+    open(os.path.join(root, 's1', 'func', 'f7.nii'), 'wt').close()
+    yield assert_equal(len(index.glob(os.path.join(root, 's1', 'func',
+                                                   '*.nii'))), 3)
+    yield assert_equal(index.listings, listings + 1)
+    # patterns outside of the tree are globbed
+    yield assert_equal(index.glob(os.path.join(root, '..', '*')),
+                       glob.glob(os.path.join(root, '..', '*')))
+    rmtree(root)
+
+@parametric
+def test_file_index_file():
+    root = mkdtemp()
+    _make_tree(os.path.join(root, 'data'))
+    filename = os.path.join(root, 'index.pklz')
+    index = FileIndex(os.path.join(root, 'data'), filename)
+    index.scan()
+    yield assert_equal(index.listings, 7)
+    index = FileIndex(os.path.join(root, 'data'), filename)
+    yield assert_equal(len(index.glob(os.path.join(root, 'data', '*',
+                                                   'func', '*.nii'))), 4)
+    yield assert_equal(index.listings, 0)
+    # removed directories are forgotten
+    rmtree(os.path.join(root, 'data', 's2'))
+    yield assert_equal(len(index.glob(os.path.join(root, 'data', '*',
+                                                   'func', '*.nii'))), 2)
+    rmtree(root)
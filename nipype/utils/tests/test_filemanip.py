@@ -9,7 +9,9 @@ from nipype.utils.filemanip import (save_json, load_json, loadflat,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    cleandir, split_filename)
+                                    cleandir, split_filename,
+                                    hash_infile, hash_infile_fast,
+                                    loadpkl, savepkl)
 
 import numpy as np
 
@@ -59,6 +61,33 @@ def test_check_forhash():
     yield assert_false, result
     yield assert_equal, hash, None
 
+def test_hash_infile_fast():
+    fd, fname = mkstemp()
+    os.close(fd)
+    fp = file(fname, 'wb')
+    fp.write('a' * 1000)
+    fp.close()
+    # small files are hashed completely
+    yield assert_equal, hash_infile_fast(fname), hash_infile(fname)
+    fp = file(fname, 'wb')
+    fp.write('a' * 100000)
+    fp.close()
+    hash = hash_infile_fast(fname, nblocks=4, block_len=1000)
+    yield assert_false, hash == hash_infile(fname)
+    # a change in the last block is detected, one between blocks is not
+    fp = file(fname, 'r+b')
+    fp.seek(99999)
+    fp.write('b')
+    fp.close()
+    hash2 = hash_infile_fast(fname, nblocks=4, block_len=1000)
+    yield assert_false, hash == hash2
+    fp = file(fname, 'r+b')
+    fp.seek(40000)
+    fp.write('b')
+    fp.close()
+    yield assert_equal, hash_infile_fast(fname, nblocks=4, block_len=1000), hash2
+    os.unlink(fname)
+
 def _temp_analyze_files():
     """Generate temporary analyze file pair."""
     fd, orig_img = mkstemp(suffix = '.img')
@@ -87,6 +116,25 @@ def test_copyfile():
     os.unlink(orig_img)
     os.unlink(orig_hdr)
 
+def test_copyfile_staging():
+    orig_img, orig_hdr = _temp_analyze_files()
+    pth, fname = os.path.split(orig_img)
+    new_img = os.path.join(pth, 'newfile.img')
+    new_hdr = os.path.join(pth, 'newfile.hdr')
+    method = copyfile(orig_img, new_img, copy=True, staging='hardlink')
+    yield assert_true, method in ['reflink', 'hardlink']
+    if method == 'hardlink':
+        yield assert_equal, os.stat(new_hdr).st_ino, os.stat(orig_hdr).st_ino
+    # a real copy replaces the hard link instead of writing through it
+    yield assert_equal, copyfile(orig_img, new_img, copy=True,
+                                 staging='copy'), 'copy'
+    yield assert_false, os.stat(new_hdr).st_ino == os.stat(orig_hdr).st_ino
+    yield assert_true, copyfile(orig_img, new_img, copy=True,
+                                staging='reflink') in ['reflink', 'copy']
+    yield assert_equal, copyfile(orig_img, new_img), 'symlink'
+    for fname in [orig_img, orig_hdr, new_img, new_hdr]:
+        os.unlink(fname)
+
 def test_copyfiles():
     orig_img1, orig_hdr1 = _temp_analyze_files()
     orig_img2, orig_hdr2 = _temp_analyze_files()
@@ -153,6 +201,17 @@ def test_json():
     os.unlink(name)
     yield assert_equal, sorted(adict.items()), sorted(new_dict.items())
 
+def test_pkl():
+    adict = dict(a='one', b=[1, 2])
+    fd, name = mkstemp(suffix='.pklz')
+    os.close(fd)
+    for compresslevel in [9, 1, 0]:
+        savepkl(name, adict, compresslevel)
+        yield assert_equal, loadpkl(name), adict
+    # uncompressed despite the name
+    yield assert_false, open(name, 'rb').read(2) == '\x1f\x8b'
+    os.unlink(name)
+
 def test_loadflat():
     alist = [dict(a='one', c='three', b='two'),
              dict(a='one', c='three', b='two')]
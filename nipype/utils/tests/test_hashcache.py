@@ -0,0 +1,92 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from multiprocessing.pool import ThreadPool
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, assert_true, parametric, skipif
+from nipype.utils.filemanip import hash_infile
+from nipype.utils.hashcache import FileHashCache, sqlite3
+
+def _write(fname, content):
+    fp = open(fname, 'wt')
+    fp.write(content)
+    fp.close()
+
+@parametric
+def test_hash_cache():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'file.txt')
+    _write(fname, 'first')
+    cache = FileHashCache()
+    hash = cache.get_hash(fname, 'content', hash_infile)
+    yield assert_equal(hash, hash_infile(fname))
+    yield assert_equal(cache.get_hash(fname, 'content', hash_infile), hash)
+    yield assert_equal((cache.hits, cache.misses), (1, 1))
+    # a modified file is hashed again
+    _write(fname, 'second file')
+    yield assert_equal(cache.get_hash(fname, 'content', hash_infile),
+                       hash_infile(fname))
+    yield assert_equal((cache.hits, cache.misses), (1, 2))
+    rmtree(tmpdir)
+
+@parametric
+def test_hash_cache_eviction():
+    tmpdir = mkdtemp()
+    cache = FileHashCache(maxsize=10)
+    fnames = []
+    for i in range(11):
+        fnames.append(os.path.join(tmpdir, 'file%d.txt' % i))
+        _write(fnames[-1], str(i))
+        cache.get_hash(fnames[-1], 'content', hash_infile)
+    yield assert_equal(len(cache._memory), 10)
+    # the least recently used file was evicted
+    cache.get_hash(fnames[1], 'content', hash_infile)
+    yield assert_equal(cache.hits, 1)
+    cache.get_hash(fnames[0], 'content', hash_infile)
+    yield assert_equal(cache.misses, 12)
+    rmtree(tmpdir)
+
+@skipif(sqlite3 is None)
+def test_hash_cache_database():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'file.txt')
+    _write(fname, 'content')
+    dbfile = os.path.join(tmpdir, 'hashes.db')
+    cache = FileHashCache(dbfile)
+    hash = cache.get_hash(fname, 'content', hash_infile)
+    # a second process finds the hash in the database
+    cache = FileHashCache(dbfile)
+    yield assert_equal, cache.get_hash(fname, 'content', hash_infile), hash
+    yield assert_equal, (cache.hits, cache.misses), (1, 0)
+    cache.clear()
+    cache = FileHashCache(dbfile)
+    cache.get_hash(fname, 'content', hash_infile)
+    yield assert_equal, cache.misses, 1
+    rmtree(tmpdir)
+
+@skipif(sqlite3 is None)
+def test_hash_cache_threads():
+    tmpdir = mkdtemp()
+    fnames = []
+    for i in range(20):
+        fnames.append(os.path.join(tmpdir, 'file%d.txt' % i))
+        _write(fnames[-1], str(i))
+    dbfile = os.path.join(tmpdir, 'hashes.db')
+    cache = FileHashCache(dbfile, maxsize=10)
+    pool = ThreadPool(4)
+    hashes = pool.map(lambda fname: cache.get_hash(fname, 'content',
+                                                   hash_infile),
+                      fnames * 5)
+    pool.close()
+    pool.join()
+    yield assert_equal, hashes, [hash_infile(fname) for fname in fnames] * 5
+    yield assert_equal, cache.hits + cache.misses, 100
+    yield assert_true, len(cache._memory) <= 10
+    # the hashes stored by the threads are in the database
+    cache = FileHashCache(dbfile)
+    for fname in fnames:
+        cache.get_hash(fname, 'content', hash_infile)
+    yield assert_equal, cache.misses, 0
+    rmtree(tmpdir)
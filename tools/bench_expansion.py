@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Measure the time needed to expand the iterables of a workflow.
+
+Builds workflows in which a source node fans out to `fanout` branches,
+each starting with a node that iterates over three values, and times the
+creation of the flat and the expanded execution graph.
+
+Usage::
+
+    python tools/bench_expansion.py [fanout ...]
+
+"""
+import logging
+import sys
+from time import time
+
+import nipype.pipeline.engine as pe
+from nipype.pipeline.utils import _clone_graph, _generate_expanded_graph
+from nipype.interfaces.utility import IdentityInterface
+
+def synthetic_workflow(fanout, depth=3):
+    """A source node feeding `fanout` chains of `depth` nodes whose first
+    node iterates over three values"""
+    workflow = pe.Workflow(name='bench')
+    source = pe.Node(IdentityInterface(fields=['a']), name='source')
+    for i in range(fanout):
+        prev = source
+        for j in range(depth):
+            node = pe.Node(IdentityInterface(fields=['a', 'b']),
+                           name='node%d_%d' % (i, j))
+            if j == 0:
+                node.iterables = ('b', range(3))
+            workflow.connect(prev, 'a', node, 'a')
+            prev = node
+    return workflow
+
+def main(fanouts):
+    logging.getLogger('workflow').setLevel(logging.WARNING)
+    print '%10s %10s %12s' % ('fanout', 'nodes', 'seconds')
+    for fanout in fanouts:
+        workflow = synthetic_workflow(fanout)
+        t0 = time()
+        workflow._create_flat_graph()
+        graph = _generate_expanded_graph(_clone_graph(workflow._flatgraph)[0])
+        print '%10d %10d %12.3f' % (fanout, graph.number_of_nodes(),
+                                    time() - t0)
+
+if __name__ == '__main__':
+    fanouts = [int(arg) for arg in sys.argv[1:]]
+    if not fanouts:
+        fanouts = [100, 200, 400, 800]
+    main(fanouts)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Compare matching DataGrabber templates with glob and with a file index.
+
+Creates a temporary tree of subjects, each with a few runs of functional
+images and a structural image, and matches six templates per subject with
+`glob.glob` and with a `FileIndex` (a first, cold pass that lists the
+directories and a second, warm pass that only checks their modification
+times). Also counts the directory listings of every method, which dominate
+the time on network file systems. On a local disk listings are cheap and
+the index is not faster than glob.
+
+Usage::
+
+    python tools/bench_file_index.py [n_subjects ...]
+
+"""
+import glob
+import os
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype.utils.fileindex import FileIndex
+
+templates = ['%s/func/run*/f*.nii', '%s/func/run1/f1.nii', '%s/anat/*.nii',
+             '%s/anat/struct.nii', '%s/dwi/*.bv?', '%s/*/*.txt']
+
+def make_tree(root, n_subjects):
+    for i in range(n_subjects):
+        sid = 's%04d' % i
+        for subdir, names in [('func/run1', ['f1.nii', 'f2.nii']),
+                              ('func/run2', ['f1.nii', 'f2.nii']),
+                              ('anat', ['struct.nii', 'notes.txt']),
+                              ('dwi', ['dwi.nii', 'dwi.bval', 'dwi.bvec'])]:
+            os.makedirs(os.path.join(root, sid, subdir))
+            for name in names:
+                open(os.path.join(root, sid, subdir, name), 'wt').close()
+    # directories modified just now are listed again
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (0, 0))
+
+class CountListings(object):
+    def __init__(self):
+        self.count = 0
+        self._listdir = os.listdir
+
+    def __call__(self, path):
+        self.count += 1
+        return self._listdir(path)
+
+def match_all(globfunc, root, n_subjects):
+    for i in range(n_subjects):
+        for template in templates:
+            globfunc(os.path.join(root, template % ('s%04d' % i)))
+
+def main(sizes):
+    print '%10s %20s %20s %20s' % ('subjects', 'glob s (lists)',
+                                   'cold index s (lists)',
+                                   'warm index s (lists)')
+    for n_subjects in sizes:
+        root = mkdtemp()
+        make_tree(root, n_subjects)
+        index = FileIndex(root)
+        results = []
+        counter = CountListings()
+        os.listdir = counter
+        try:
+            for globfunc in [glob.glob, index.glob, index.glob]:
+                counter.count = 0
+                t0 = time()
+                match_all(globfunc, root, n_subjects)
+                results.append('%10.3f (%6d)' % (time() - t0, counter.count))
+        finally:
+            os.listdir = counter._listdir
+        rmtree(root)
+        print '%10d %20s %20s %20s' % tuple([n_subjects] + results)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]]
+    if not sizes:
+        sizes = [100, 500]
+    main(sizes)
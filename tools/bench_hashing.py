@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Compare the throughput of the content and fast hash methods.
+
+Writes temporary files of the given sizes (in MB) and hashes each of them
+with `hash_infile` (md5 of the whole file) and `hash_infile_fast` (md5 of
+the size and sampled blocks). The files are hashed right after they were
+written and are therefore likely in the page cache; on cold caches the
+difference is larger.
+
+Usage::
+
+    python tools/bench_hashing.py [size_mb ...]
+
+"""
+import os
+import sys
+from tempfile import mkstemp
+from time import time
+
+from nipype.utils.filemanip import hash_infile, hash_infile_fast
+
+def make_file(size_mb):
+    fd, fname = mkstemp(suffix='.img')
+    block = os.urandom(1024 * 1024)
+    fp = os.fdopen(fd, 'wb')
+    for i in range(size_mb):
+        fp.write(block)
+    fp.close()
+    return fname
+
+def main(sizes):
+    print '%10s %16s %16s' % ('MB', 'content MB/s', 'fast MB/s')
+    for size_mb in sizes:
+        fname = make_file(size_mb)
+        rates = []
+        for func in [hash_infile, hash_infile_fast]:
+            t0 = time()
+            func(fname)
+            rates.append(size_mb / max(time() - t0, 1e-6))
+        os.unlink(fname)
+        print '%10d %16.1f %16.1f' % (size_mb, rates[0], rates[1])
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]]
+    if not sizes:
+        sizes = [10, 100, 500]
+    main(sizes)
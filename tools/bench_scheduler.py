@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Measure the scheduling overhead of the distributed plugin base.
+
+Builds layered synthetic execution graphs and runs them through a plugin
+whose jobs finish immediately, so that the measured time is spent only in
+the dependency bookkeeping of the scheduler.
+
+Usage::
+
+    python tools/bench_scheduler.py [nnodes ...]
+
+"""
+import logging
+import sys
+from time import time
+
+import networkx as nx
+
+from nipype.pipeline.plugins.base import DistributedPluginBase
+
+class DummyNode(object):
+    """Minimal stand-in for a pipeline node"""
+
+    def __init__(self, jobid):
+        self._id = 'node%d' % jobid
+        self._result = None
+
+    def _get_hashval(self):
+        return None, self._id
+
+class NullPlugin(DistributedPluginBase):
+    """Plugin whose jobs finish as soon as they are submitted"""
+
+    def _submit_job(self, node, updatehash=False):
+        self._task_done(node._id)
+        return node._id
+
+    def _get_result(self, taskid):
+        return dict(result=None, traceback=None)
+
+def synthetic_graph(nnodes, width=100, fanin=2):
+    """Layers of `width` nodes each depending on `fanin` nodes of the
+    previous layer"""
+    graph = nx.DiGraph()
+    nodes = [DummyNode(i) for i in range(nnodes)]
+    graph.add_nodes_from(nodes)
+    for i in range(width, nnodes):
+        layerstart = (i / width - 1) * width
+        for j in range(fanin):
+            src = nodes[layerstart + (i + j) % width]
+            graph.add_edge(src, nodes[i], connect=[])
+    return graph
+
+def main(sizes):
+    logging.getLogger('workflow').setLevel(logging.WARNING)
+    print '%10s %10s %12s' % ('nodes', 'edges', 'seconds')
+    for nnodes in sizes:
+        graph = synthetic_graph(nnodes)
+        t0 = time()
+        NullPlugin().run(graph)
+        print '%10d %10d %12.3f' % (nnodes, graph.number_of_edges(),
+                                    time() - t0)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]]
+    if not sizes:
+        sizes = [1000, 10000, 50000]
+    main(sizes)